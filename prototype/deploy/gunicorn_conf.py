@@ -1,3 +1,12 @@
 import multiprocessing
+import os
+
 preload_app = True
+# each worker has its own database pool (see SQLALCHEMY_POOL_SIZE) so Postgres needs to
+# accept workers * (SQLALCHEMY_POOL_SIZE + SQLALCHEMY_MAX_OVERFLOW) connections
 workers = multiprocessing.cpu_count() * 2 + 1
+
+# settings written by the tsung pool_size_test task
+_loadtest_config = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'instance', 'loadtest_config.py')
+if os.path.exists(_loadtest_config):
+    raw_env = ['APP_CONFIG_FILE={}'.format(os.path.normpath(_loadtest_config))]
@@ -8,9 +8,74 @@ SQLALCHEMY_ECHO = False
 SECRET_KEY = 'testkey'
 SQLALCHEMY_DATABASE_URI = 'postgresql://postgres:@localhost/receiver'
 
+# database connections for each worker process (see mobile_endpoint.pool). Every
+# greenlet in a worker shares them so requests wait for one once size + overflow
+# are in use, for up to SQLALCHEMY_POOL_TIMEOUT seconds.
+SQLALCHEMY_POOL_SIZE = 10
+SQLALCHEMY_MAX_OVERFLOW = 10
+SQLALCHEMY_POOL_TIMEOUT = 30
+# test connections with a SELECT 1 when they're checked out
+SQLALCHEMY_POOL_PRE_PING = False
+# milliseconds before Postgres cancels a statement, None for no limit
+SQLALCHEMY_STATEMENT_TIMEOUT = None
+# the database is behind pgbouncer in transaction pooling mode so nothing is set
+# for the session (including the statement timeout)
+SQLALCHEMY_PGBOUNCER = False
+# log checkouts that wait longer than this many seconds for a connection and a
+# summary of the waits every SQLALCHEMY_POOL_STATS_INTERVAL seconds
+SQLALCHEMY_POOL_SLOW_CHECKOUT = 0.5
+SQLALCHEMY_POOL_STATS_INTERVAL = 60
+
 REDIS_URL = "redis://localhost:6379/0"
 
 RESTORE_DIR = 'restore_tmp'
+# generate restores while they're sent instead of writing them to RESTORE_DIR first
+STREAMING_RESTORE = False
+# get the case payload in its own thread (a greenlet under gevent) while the rest of
+# the restore is put together
+CONCURRENT_RESTORE_PROVIDERS = False
+# how many of a restoring user's dirty owners can have their case footprints worked
+# out at once. Each one uses its own database connection.
+RESTORE_FOOTPRINT_WORKERS = 4
+# write case XML straight to strings instead of building ElementTrees for it
+# (see mobile_endpoint.case.xml.serializer)
+FAST_CASE_XML = False
+# save each case's restore XML along with it when forms are submitted so that
+# restores can send it as it is instead of generating it again
+STORED_CASE_XML = False
+
+# where restore payloads are cached so retried restores don't regenerate them
+# (see mobile_endpoint.restore.cache). Set to None to turn caching off.
+RESTORE_CACHE = 'redis'
+# defaults to a 'cache' directory in RESTORE_DIR
+RESTORE_CACHE_DIR = None
+# the least recently used payloads are deleted to keep the cache under this many bytes
+RESTORE_CACHE_MAX_SIZE = 1024 * 1024 * 1024
+
+# parse form XML, datetimes and case blocks in a single pass (see mobile_endpoint.form.parser)
+STREAMING_FORM_PARSER = False
+
+# save every Nth sync log for a phone in full and the ones in between as the changes
+# from the log before them (SQL only). 1 saves them all in full. Run
+# 'manage.py compact_synclogs' after changing it to re-save the existing ones.
+SYNCLOG_SNAPSHOT_INTERVAL = 1
+
+# save the case ids in sync logs as one string of sorted 16 byte UUIDs instead of a
+# list (see mobile_endpoint.synclog.packed), optionally compressed with zlib. Logs
+# with ids that aren't UUIDs are still saved as lists.
+PACKED_SYNCLOG_CASE_IDS = False
+PACKED_SYNCLOG_COMPRESSION = False
+
+# write the ownership cleanliness flags for a submission with a single
+# INSERT ... ON CONFLICT statement instead of through the ORM. Needs Postgres 9.5.
+UPSERT_CLEANLINESS_FLAGS = False
+
+# queue the cases changed by a submission instead of checking their child cases for
+# other owners while it's processed (SQL only). Run 'manage.py process_dirtiness_checks'
+# to work through the queue; restores treat the owners of queued cases (before and after
+# the submission) as dirty until they're checked. Empty the queue after turning it off.
+# Needs Postgres 9.5.
+DEFERRED_DIRTINESS_CHECKS = False
 
 # couch settings
 COUCH_URI = 'http://localhost:5984'
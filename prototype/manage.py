@@ -8,7 +8,8 @@ patch_path()
 from flask.ext.script import Manager, Server
 from flask.ext.script.commands import ShowUrls, Clean
 from mobile_endpoint import create_app
-from mobile_endpoint.models import db, FormData, CaseData, CaseIndex, Synclog, OwnershipCleanlinessFlag
+from mobile_endpoint.models import db, FormData, CaseData, CaseIndex, Synclog, OwnershipCleanlinessFlag, \
+    PendingDirtinessCheck
 from mobile_endpoint.backends.mongo.models import MongoForm, MongoCase, MongoSynclog
 
 app = create_app()
@@ -27,7 +28,7 @@ def make_shell_context():
     """
 
     context = dict(app=app, db=db)
-    for class_ in [FormData, CaseData, CaseIndex, Synclog, OwnershipCleanlinessFlag]:
+    for class_ in [FormData, CaseData, CaseIndex, Synclog, OwnershipCleanlinessFlag, PendingDirtinessCheck]:
         context[class_.__name__] = class_
     return context
 
@@ -37,5 +38,49 @@ def syncmongo():
     MongoCase.ensure_indexes()
     MongoSynclog.ensure_indexes()
 
+@manager.option('-b', '--backend', dest='backend', default='sql', help='sql, couch or mongo')
+def check_synclog_hashes(backend):
+    """
+    Compare the state hash saved with each sync log with one worked out from all of its cases
+    """
+    from mobile_endpoint.backends.manager import get_dao
+    from mobile_endpoint.synclog.models import get_state_hash_mismatches
+
+    mismatches = 0
+    for synclog, saved_hash, recomputed_hash in get_state_hash_mismatches(get_dao(backend).iter_synclogs()):
+        mismatches += 1
+        print '{}: saved {} but should be {}'.format(synclog.id, saved_hash, recomputed_hash)
+    print '{} sync logs with the wrong state hash'.format(mismatches)
+
+@manager.command
+def compact_synclogs():
+    """
+    Re-save the SQL sync logs in the format the SYNCLOG_SNAPSHOT_INTERVAL setting asks for
+    """
+    from mobile_endpoint import models
+    print '{} sync logs re-saved'.format(models.compact_synclogs())
+
+@manager.option('-s', '--batch-size', dest='batch_size', default=1000, type=int)
+@manager.option('-p', '--poll', dest='poll', default=0, type=float,
+                help='keep checking for new work every POLL seconds once the queue is empty')
+def process_dirtiness_checks(batch_size, poll):
+    """
+    Work out the cleanliness flags queued by SQL submissions when DEFERRED_DIRTINESS_CHECKS is on
+    """
+    import time
+    from mobile_endpoint.backends.manager import get_dao, BACKEND_SQL
+    from mobile_endpoint.case.case_processing import process_pending_dirtiness_checks
+
+    dao = get_dao(BACKEND_SQL)
+    total = 0
+    while True:
+        processed = process_pending_dirtiness_checks(dao, batch_size)
+        total += processed
+        if not processed:
+            if not poll:
+                break
+            time.sleep(poll)
+    print '{} dirtiness checks processed'.format(total)
+
 if __name__ == "__main__":
     manager.run()
@@ -0,0 +1,9 @@
+function(doc) {
+    if(doc.doc_type == "CommCareCase") {
+        if (doc.indices) {
+            for (var i = 0; i < doc.indices.length; i++) {
+                emit([doc.domain, doc.indices[i].referenced_id], doc.owner_id);
+            }
+        }
+    }
+}
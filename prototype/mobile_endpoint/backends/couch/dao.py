@@ -3,28 +3,31 @@ from couchdbkit import ResourceNotFound
 import dateutil
 from mobile_endpoint.backends.couch.models import CouchForm, CouchCase, \
     CouchSynclog
-from mobile_endpoint.dao import AbsctractDao, to_generic
+from mobile_endpoint.dao import AbsctractDao, to_generic, get_stored_case_xml
 from mobile_endpoint.exceptions import NotFound
-from mobile_endpoint.utils import get_with_lock, json_format_datetime
+from mobile_endpoint.utils import get_with_lock, json_format_datetime, get_case_lock_key
 
 
 class CouchDao(AbsctractDao):
 
-    def commit_atomic_submission(self, xform, case_result):
+    def commit_atomic_submissions(self, xforms, case_result):
 
         docs_by_db = defaultdict(list)
 
-        # form
-        is_new, form = CouchForm.from_generic(xform)
-        docs_by_db[CouchForm.get_db()].append(form.to_json())
+        # forms
+        for xform in xforms:
+            is_new, form = CouchForm.from_generic(xform)
+            docs_by_db[CouchForm.get_db()].append(form.to_json())
 
         # cases
         cases = case_result.cases if case_result else []
         for case in cases:
-            docs_by_db[CouchCase.get_db()].append(CouchCase.from_generic(case)[1].to_json())
+            _, doc = CouchCase.from_generic(case)
+            doc.xml_fragments = get_stored_case_xml(case)
+            docs_by_db[CouchCase.get_db()].append(doc.to_json())
 
-        synclog = case_result.synclog if case_result else None
-        if synclog:
+        synclogs = case_result.synclogs if case_result else []
+        for synclog in synclogs:
             _, log = CouchSynclog.from_generic(synclog)
             docs_by_db[CouchSynclog.get_db()].append(log.to_json())
 
@@ -51,6 +54,11 @@ class CouchDao(AbsctractDao):
         _, synclog = CouchSynclog.from_generic(generic)
         synclog.save()
 
+    def iter_synclogs(self):
+        for row in CouchSynclog.get_db().view('_all_docs', include_docs=True):
+            if not row['id'].startswith('_design'):
+                yield CouchSynclog.wrap(row['doc']).to_generic()
+
     @to_generic
     def get_form(self, id):
         try:
@@ -67,7 +75,7 @@ class CouchDao(AbsctractDao):
                 return None
 
         if lock:
-            return get_with_lock('case_lock_{}'.format(id), lambda: _get_case(id))
+            return get_with_lock(get_case_lock_key(id), lambda: _get_case(id))
         else:
             None, _get_case(id)
 
@@ -76,21 +84,40 @@ class CouchDao(AbsctractDao):
 
     @to_generic
     def get_cases(self, case_ids, ordered=False):
-        for row in CouchCase.view('_all_docs', keys=case_ids, include_docs=True):
-            yield row
+        # _all_docs returns rows in the order of the keys, with an error row for missing docs
+        for row in CouchCase.get_db().view('_all_docs', keys=list(case_ids), include_docs=True):
+            if row.get('doc'):
+                yield CouchCase.wrap(row['doc'])
+            elif ordered:
+                yield None
+
+    def get_compact_cases(self, case_ids):
+        for row in CouchCase.get_db().view('_all_docs', keys=list(case_ids), include_docs=True):
+            if row.get('doc'):
+                yield CouchCase.compact_from_couch(row['doc'])
 
-    @to_generic
     def get_reverse_indexed_cases(self, domain, case_ids):
         """
         Given a base list of case ids, gets all cases that reference the given cases (child cases)
         """
         keys = [[domain, case_id, 'reverse_index'] for case_id in case_ids]
-        return CouchCase.view(
+        for row in CouchCase.get_db().view(
             'cases/related',
             keys=keys,
             reduce=False,
             include_docs=True,
-        )
+        ):
+            yield CouchCase.compact_from_couch(row['doc'])
+
+    def get_reverse_index_owners(self, domain, case_ids):
+        return [
+            (row['id'], row['value'], row['key'][1]) for row in CouchCase.get_db().view(
+                'cases/reverse_index_owners',
+                keys=[[domain, case_id] for case_id in case_ids],
+                reduce=False,
+                include_docs=False,
+            )
+        ]
 
     def get_open_case_ids(self, domain, owner_id):
         return [row['id'] for row in CouchCase.get_db().view(
@@ -115,6 +142,21 @@ class CouchDao(AbsctractDao):
             )
         ]
 
+    def get_open_case_ids_for_owners(self, domain, owner_ids):
+        return [row['id'] for row in CouchCase.get_db().view(
+            'cases/by_owner',
+            keys=[[domain, owner_id, False] for owner_id in owner_ids],
+            reduce=False,
+            include_docs=False
+        )]
+
+    def get_case_ids_modified_with_owners_since(self, domain, owner_ids, reference_date):
+        # views can't be queried for more than one key range at a time
+        return [
+            case_id for owner_id in owner_ids
+            for case_id in self.get_case_ids_modified_with_owner_since(domain, owner_id, reference_date)
+        ]
+
     def get_indexed_case_ids(self, domain, case_ids):
         """
         Given a base list of case ids, gets all ids of cases they reference (parent cases)
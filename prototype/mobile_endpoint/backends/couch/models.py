@@ -1,11 +1,15 @@
+import base64
+
 from couchdbkit import Document
 from jsonobject.properties import DateTimeProperty, StringProperty, ListProperty, BooleanProperty, \
     DictProperty
+from mobile_endpoint.case.compact import CompactCase
 from mobile_endpoint.case.models import CommCareCase
 from mobile_endpoint.form.models import XFormInstance
 from mobile_endpoint.models import ToFromGeneric
 from mobile_endpoint.synclog.checksum import Checksum
 from mobile_endpoint.synclog.models import SimplifiedSyncLog, IndexTree
+from mobile_endpoint.synclog.packed import PackedUUIDSet, get_packed_case_ids
 
 
 class CouchForm(Document, ToFromGeneric):
@@ -61,6 +65,8 @@ class CouchCase(Document, ToFromGeneric):
     server_modified_on = DateTimeProperty()
     version = StringProperty()
     indices = ListProperty(CouchCaseIndex)
+    # restore XML rendered when the case was saved (see CouchDao.commit_atomic_submissions)
+    xml_fragments = DictProperty(default=None)
 
     @staticmethod
     def get_app_name():
@@ -69,8 +75,18 @@ class CouchCase(Document, ToFromGeneric):
     def to_generic(self):
         json = self.to_json()
         json['id'] = json.pop('_id')
+        json.pop('xml_fragments', None)
         return CommCareCase.wrap(json)
 
+    @staticmethod
+    def compact_from_couch(doc):
+        """
+        Build a CompactCase straight from the raw document without wrapping it
+        """
+        doc['id'] = doc.pop('_id')
+        xml_fragments = doc.pop('xml_fragments', None)
+        return CompactCase(doc, xml_fragments=xml_fragments)
+
     @classmethod
     def from_generic(cls, generic, xform=None, **kwargs):
         if hasattr(generic, '_self'):
@@ -97,6 +113,9 @@ class CouchSynclog(Document, ToFromGeneric):
     owner_ids_on_phone = ListProperty(StringProperty)
     case_ids_on_phone = ListProperty(StringProperty)
     dependent_case_ids_on_phone = ListProperty(StringProperty)
+    # the case ids packed into one base64 string instead (see PACKED_SYNCLOG_CASE_IDS)
+    packed_case_ids = StringProperty()
+    packed_dependent_case_ids = StringProperty()
     index_tree = DictProperty()
 
     @staticmethod
@@ -108,6 +127,12 @@ class CouchSynclog(Document, ToFromGeneric):
         return Checksum(initial_checksum=self.hash)
 
     def to_generic(self):
+        if self.packed_case_ids is not None:
+            case_ids = PackedUUIDSet(base64.b64decode(self.packed_case_ids)).to_set()
+            dependent_case_ids = PackedUUIDSet(base64.b64decode(self.packed_dependent_case_ids)).to_set()
+        else:
+            case_ids = set(self.case_ids_on_phone)
+            dependent_case_ids = set(self.dependent_case_ids_on_phone)
         synclog = SimplifiedSyncLog(
             id=self._id,
             date=self.date,
@@ -115,8 +140,8 @@ class CouchSynclog(Document, ToFromGeneric):
             user_id=self.user_id,
             previous_log_id=self.previous_log_id,
             owner_ids_on_phone=set(self.owner_ids_on_phone),
-            case_ids_on_phone=set(self.case_ids_on_phone),
-            dependent_case_ids_on_phone=set(self.dependent_case_ids_on_phone),
+            case_ids_on_phone=case_ids,
+            dependent_case_ids_on_phone=dependent_case_ids,
             index_tree=IndexTree(indices=self.index_tree or {})
         )
         synclog._hash = self.hash
@@ -139,6 +164,15 @@ class CouchSynclog(Document, ToFromGeneric):
                 new_att = list(new_att)
             setattr(self, att, new_att)
 
+        packed_case_ids = get_packed_case_ids(generic.case_ids_on_phone)
+        packed_dependent_case_ids = get_packed_case_ids(generic.dependent_case_ids_on_phone)
+        if packed_case_ids is not None and packed_dependent_case_ids is not None:
+            self.packed_case_ids = base64.b64encode(packed_case_ids)
+            self.packed_dependent_case_ids = base64.b64encode(packed_dependent_case_ids)
+            self.case_ids_on_phone = self.dependent_case_ids_on_phone = []
+        else:
+            self.packed_case_ids = self.packed_dependent_case_ids = None
+
         self.index_tree = generic.index_tree.indices
         self.hash = generic.get_state_hash().hash
 
@@ -16,6 +16,10 @@ def get_submit_url(backend, domain):
     }[backend]
 
 
+def get_batch_submit_url(backend, domain):
+    return '{}/batch'.format(get_submit_url(backend, domain))
+
+
 def get_dao(backend):
     return {
         BACKEND_SQL: SQLDao,
@@ -1,37 +1,33 @@
 from uuid import UUID
 from mongoengine import DoesNotExist
-from mobile_endpoint.dao import AbsctractDao, to_generic
+from mobile_endpoint.dao import AbsctractDao, to_generic, get_stored_case_xml
 from mobile_endpoint.backends.mongo.models import MongoForm, MongoCase, \
     MongoSynclog
 from mobile_endpoint.exceptions import NotFound
-from mobile_endpoint.utils import get_with_lock
+from mobile_endpoint.restore.cleanliness import FootprintInfo
+from mobile_endpoint.utils import get_with_lock, get_case_lock_key
 
 
 class MongoDao(AbsctractDao):
 
-    def commit_atomic_submission(self, xform, case_result):
+    def commit_atomic_submissions(self, xforms, case_result):
         # Ideally, the forms, cases, and synclogs would be saved all-or-nothing
 
-        # form
-        _, form = MongoForm.from_generic(xform)
-        form.save()
+        # forms
+        _bulk_upsert(MongoForm, [MongoForm.from_generic(xform)[1] for xform in xforms])
 
         # cases
         cases = case_result.cases if case_result else []
-        if cases:
-            collection = MongoCase._get_collection()
-            bulkop = collection.initialize_unordered_bulk_op()
-            for case in cases:
-                mcase = MongoCase.from_generic(case)[1]
-                mcase.validate()
-                case_son = mcase.to_mongo()
-                case_id = case_son.get('_id')
-                bulkop.find({'_id': case_id}).upsert().replace_one(case_son)
-            bulkop.execute()
-
-        # synclog
-        synclog = case_result.synclog if case_result else None
-        if synclog:
+        case_docs = []
+        for case in cases:
+            _, doc = MongoCase.from_generic(case)
+            doc.xml_fragments = get_stored_case_xml(case)
+            case_docs.append(doc)
+        _bulk_upsert(MongoCase, case_docs)
+
+        # synclogs
+        synclogs = case_result.synclogs if case_result else []
+        for synclog in synclogs:
             _, log = MongoSynclog.from_generic(synclog)
             log.save()
 
@@ -55,7 +51,7 @@ class MongoDao(AbsctractDao):
             except DoesNotExist:
                 return None
         if lock:
-            return get_with_lock('case_lock_{}'.format(id), lambda: _get_case(id))
+            return get_with_lock(get_case_lock_key(id), lambda: _get_case(id))
         else:
             None, _get_case(id)
 
@@ -80,14 +76,30 @@ class MongoDao(AbsctractDao):
             yield c
 
 
-    @to_generic
+    def get_compact_cases(self, case_ids):
+        # skip building the mongoengine documents
+        for doc in MongoCase.objects(id__in=case_ids).as_pymongo():
+            yield MongoCase.compact_from_mongo(doc)
+
     def get_reverse_indexed_cases(self, domain, case_ids):
         """
         Given a base list of case ids, gets all cases that reference the given cases (child cases)
         """
         cases = MongoCase.objects(domain=domain, indices__referenced_id__in=case_ids)
-        for c in cases:
-            yield c
+        for doc in cases.only('id', 'domain', 'owner_id', 'closed', 'indices').as_pymongo():
+            yield MongoCase.compact_from_mongo(doc)
+
+    def get_reverse_index_owners(self, domain, case_ids):
+        case_ids = [UUID(case_id) for case_id in case_ids]
+        cases = MongoCase.objects(domain=domain, indices__referenced_id__in=case_ids)
+        referenced_ids = set(case_ids)
+        return [
+            (unicode(doc['_id']), doc.get('owner_id') and unicode(doc['owner_id']),
+             unicode(index['referenced_id']))
+            for doc in cases.only('id', 'owner_id', 'indices__referenced_id').as_pymongo()
+            for index in doc.get('indices', [])
+            if index.get('referenced_id') in referenced_ids
+        ]
 
     def get_open_case_ids(self, domain, owner_id):
         assert isinstance(owner_id, basestring)
@@ -106,6 +118,26 @@ class MongoDao(AbsctractDao):
             ).only('id')
         ]
 
+    def get_open_case_ids_for_owners(self, domain, owner_ids):
+        return [
+            unicode(c.id) for c in
+            MongoCase.objects(
+                domain=domain,
+                owner_id__in=[UUID(owner_id) for owner_id in owner_ids],
+                closed=False
+            ).only('id')
+        ]
+
+    def get_case_ids_modified_with_owners_since(self, domain, owner_ids, reference_date):
+        return [
+            unicode(c.id) for c in
+            MongoCase.objects(
+                domain=domain,
+                owner_id__in=[UUID(owner_id) for owner_id in owner_ids],
+                server_modified_on__gt=reference_date
+            ).only('id')
+        ]
+
     def get_indexed_case_ids(self, domain, case_ids):
         """
         Given a base list of case ids, gets all ids of cases they reference (parent cases)
@@ -117,6 +149,44 @@ class MongoDao(AbsctractDao):
             parent_ids |= set(unicode(i.referenced_id) for i in c.indices)
         return list(parent_ids)
 
+    def get_case_footprint_info(self, domain, owner_id):
+        """
+        Groups the ids referenced by the owner's open cases into one document and
+        follows the indices from there with a single ``$graphLookup`` (needs MongoDB
+        3.4 or later) so parents shared by several cases are only walked once.
+        The ids are taken from the indices rather than the cases they find so that
+        references to missing cases are still included, the same as
+        ``get_indexed_case_ids``.
+        """
+        pipeline = [
+            {'$match': {'domain': domain, 'owner_id': UUID(owner_id), 'closed': False}},
+            {'$project': {'indices.referenced_id': 1}},
+            {'$unwind': {'path': '$indices', 'preserveNullAndEmptyArrays': True}},
+            {'$group': {
+                '_id': None,
+                'base_ids': {'$addToSet': '$_id'},
+                'referenced_ids': {'$addToSet': '$indices.referenced_id'},
+            }},
+            {'$graphLookup': {
+                'from': MongoCase._get_collection_name(),
+                'startWith': '$referenced_ids',
+                'connectFromField': 'indices.referenced_id',
+                'connectToField': '_id',
+                'restrictSearchWithMatch': {'domain': domain},
+                'as': 'referenced',
+            }},
+            {'$project': {'base_ids': 1, 'referenced_ids': 1, 'referenced.indices.referenced_id': 1}},
+        ]
+        base_ids = set()
+        all_ids = set()
+        for doc in MongoCase._get_collection().aggregate(pipeline):
+            base_ids |= set(unicode(case_id) for case_id in doc['base_ids'])
+            all_ids |= set(unicode(case_id) for case_id in doc['referenced_ids'])
+            for case in doc['referenced']:
+                all_ids |= set(unicode(index['referenced_id']) for index in case.get('indices', []))
+        all_ids |= base_ids
+        return FootprintInfo(base_ids=base_ids, all_ids=all_ids)
+
     def get_last_modified_dates(self, domain, case_ids):
         """
         Given a list of case IDs, return a dict where the keys are the case ids
@@ -141,3 +211,22 @@ class MongoDao(AbsctractDao):
     def save_synclog(self, generic):
         _, synclog = MongoSynclog.from_generic(generic)
         synclog.save()
+
+    def iter_synclogs(self):
+        for synclog in MongoSynclog.objects.all():
+            yield synclog.to_generic()
+
+
+def _bulk_upsert(document_cls, documents):
+    """
+    Save all the documents of one type with a single unordered bulk operation.
+    """
+    if not documents:
+        return
+
+    bulkop = document_cls._get_collection().initialize_unordered_bulk_op()
+    for document in documents:
+        document.validate()
+        son = document.to_mongo()
+        bulkop.find({'_id': son.get('_id')}).upsert().replace_one(son)
+    bulkop.execute()
@@ -1,11 +1,13 @@
 import datetime
 from uuid import UUID
 from mongoengine import *
+from mobile_endpoint.case.compact import CompactCase
 from mobile_endpoint.case.models import CommCareCase
 from mobile_endpoint.form.models import XFormInstance
 from mobile_endpoint.models import ToFromGeneric
 from mobile_endpoint.synclog.checksum import Checksum
 from mobile_endpoint.synclog.models import SimplifiedSyncLog, IndexTree
+from mobile_endpoint.synclog.packed import PackedUUIDSet, get_packed_case_ids
 
 
 class MongoForm(Document, ToFromGeneric):
@@ -63,6 +65,7 @@ class MongoCase(DynamicDocument, ToFromGeneric):
             'domain',
             'owner_id',
             'closed',
+            ('domain', 'indices.referenced_id'),
         ],
     }
     id = UUIDField(primary_key=True)
@@ -72,21 +75,21 @@ class MongoCase(DynamicDocument, ToFromGeneric):
     server_modified_on = DateTimeField()
     version = StringField()
     indices = ListField(EmbeddedDocumentField(MongoCaseIndex))
+    # restore XML rendered when the case was saved (see MongoDao.commit_atomic_submissions)
+    xml_fragments = DictField(default=None)
 
     def to_generic(self):
-        dict = self.to_mongo().to_dict()
-
-        # TODO: This is such a hack...
-        for key, value in dict.items():
-            if isinstance(value, datetime.datetime):
-                dict[key] = value.isoformat()
-            if isinstance(value, UUID):
-                dict[key] = str(value)
-        for index in dict['indices']:
-            index['referenced_id'] = str(index['referenced_id'])
-        dict['id'] = dict.pop('_id')
-
-        return CommCareCase.wrap(dict)
+        case_json = _case_json(self.to_mongo().to_dict())
+        case_json.pop('xml_fragments', None)
+        return CommCareCase.wrap(case_json)
+
+    @staticmethod
+    def compact_from_mongo(doc):
+        """
+        Build a CompactCase straight from the raw document e.g. from ``as_pymongo()``
+        """
+        xml_fragments = doc.pop('xml_fragments', None)
+        return CompactCase(_case_json(doc), xml_fragments=xml_fragments)
 
     @classmethod
     def from_generic(cls, generic, xform=None, **kwargs):
@@ -106,6 +109,19 @@ class MongoCase(DynamicDocument, ToFromGeneric):
         return new, self
 
 
+def _case_json(doc):
+    # TODO: This is such a hack...
+    for key, value in doc.items():
+        if isinstance(value, datetime.datetime):
+            doc[key] = value.isoformat()
+        if isinstance(value, UUID):
+            doc[key] = str(value)
+    for index in doc.get('indices', []):
+        index['referenced_id'] = str(index['referenced_id'])
+    doc['id'] = doc.pop('_id')
+    return doc
+
+
 class MongoSynclog(Document):
     # TODO: This is basically the same as Synclog. Reuse code.
 
@@ -120,6 +136,9 @@ class MongoSynclog(Document):
     owner_ids_on_phone = ListField(UUIDField())
     case_ids_on_phone = ListField(UUIDField())
     dependent_case_ids_on_phone = ListField(UUIDField())
+    # the case ids packed into one string instead (see PACKED_SYNCLOG_CASE_IDS)
+    packed_case_ids = BinaryField()
+    packed_dependent_case_ids = BinaryField()
     index_tree = DictField()
 
     @property
@@ -127,6 +146,12 @@ class MongoSynclog(Document):
         return Checksum(initial_checksum=self.hash)
 
     def to_generic(self):
+        if self.packed_case_ids is not None:
+            case_ids = PackedUUIDSet(self.packed_case_ids).to_set()
+            dependent_case_ids = PackedUUIDSet(self.packed_dependent_case_ids).to_set()
+        else:
+            case_ids = set(unicode(i) for i in self.case_ids_on_phone)
+            dependent_case_ids = set(unicode(i) for i in self.dependent_case_ids_on_phone)
         synclog = SimplifiedSyncLog(
             id=self.id and unicode(self.id),  # this converts UUIDs to strings, but preserves None
             date=self.date,
@@ -134,8 +159,8 @@ class MongoSynclog(Document):
             user_id=self.user_id and unicode(self.user_id),
             previous_log_id=self.previous_log_id and unicode(self.previous_log_id),
             owner_ids_on_phone=set(unicode(i) for i in self.owner_ids_on_phone),
-            case_ids_on_phone=set(unicode(i) for i in self.case_ids_on_phone),
-            dependent_case_ids_on_phone=set(unicode(i) for i in self.dependent_case_ids_on_phone),
+            case_ids_on_phone=case_ids,
+            dependent_case_ids_on_phone=dependent_case_ids,
             index_tree=IndexTree(indices=self.index_tree or {})
         )
         synclog._hash = self.hash
@@ -158,6 +183,13 @@ class MongoSynclog(Document):
                 new_att = list(new_att)
             setattr(self, att, new_att)
 
+        self.packed_case_ids = get_packed_case_ids(generic.case_ids_on_phone)
+        self.packed_dependent_case_ids = get_packed_case_ids(generic.dependent_case_ids_on_phone)
+        if self.packed_case_ids is not None and self.packed_dependent_case_ids is not None:
+            self.case_ids_on_phone = self.dependent_case_ids_on_phone = []
+        else:
+            self.packed_case_ids = self.packed_dependent_case_ids = None
+
         self.index_tree = generic.index_tree.indices
         self.hash = generic.get_state_hash().hash
 
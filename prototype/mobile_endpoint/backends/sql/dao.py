@@ -1,18 +1,30 @@
+from collections import defaultdict
+import json
 from uuid import UUID
 
-from sqlalchemy.orm import contains_eager, defer
-from sqlalchemy.sql import exists
-from mobile_endpoint.dao import AbsctractDao, to_generic
+from sqlalchemy import Text
+from sqlalchemy.orm import contains_eager, defer, joinedload, subqueryload
+from sqlalchemy.sql import cast, exists, literal
+from mobile_endpoint.case.compact import CompactCase
+from mobile_endpoint.dao import AbsctractDao, to_generic, to_compact, get_stored_case_xml
 
 from mobile_endpoint.exceptions import NotFound
 from mobile_endpoint.models import db, Synclog, FormData, CaseData, CaseIndex, cls_for_doc_type
-from mobile_endpoint.utils import get_with_lock
+from mobile_endpoint.restore.cleanliness import FootprintInfo
+from mobile_endpoint.utils import get_with_lock, get_case_lock_key
 
+# how many rows iter_compact_cases fetches from the server side cursor at a time
+CASE_STREAM_BATCH_SIZE = 100
+# how many rows iter_synclogs fetches at a time. Sync logs hold every case ID on
+# the phone so they're much bigger than case rows.
+SYNCLOG_STREAM_BATCH_SIZE = 20
 
 class SQLDao(AbsctractDao):
-    def commit_atomic_submission(self, xform, case_result):
+    queues_dirtiness_checks = True
+
+    def commit_atomic_submissions(self, xforms, case_result):
         cases = case_result.cases if case_result else []
-        synclog = case_result.synclog if case_result else None
+        synclogs = case_result.synclogs if case_result else []
 
         with db.session.begin(subtransactions=True):
 
@@ -21,12 +33,21 @@ class SQLDao(AbsctractDao):
                     for index in case.indices:
                         yield CaseIndex.from_generic(index, case.domain, case.id)
 
-            new_form, xform_sql = cls_for_doc_type(xform.doc_type).from_generic(xform)
-            case_docs = map(lambda doc: CaseData.from_generic(doc, xform_sql), cases)
+            combined = []
+            forms_by_id = {}
+            for xform in xforms:
+                new_form, xform_sql = cls_for_doc_type(xform.doc_type).from_generic(xform)
+                forms_by_id[xform.id] = xform_sql
+                combined.append((new_form, xform_sql))
+
+            for case in cases:
+                case_forms = [forms_by_id[form_id] for form_id in case.xform_ids if form_id in forms_by_id]
+                is_new, case_sql = CaseData.from_generic(case, xforms=case_forms)
+                case_sql.xml_fragments = get_stored_case_xml(case)
+                combined.append((is_new, case_sql))
 
-            combined = [(new_form, xform_sql)] + case_docs + list(get_indices())
-            if synclog:
-                combined.append(Synclog.from_generic(synclog))
+            combined.extend(get_indices())
+            combined.extend(Synclog.from_generic(synclog) for synclog in synclogs)
 
             for is_new, doc in combined:
                 if is_new:
@@ -35,7 +56,6 @@ class SQLDao(AbsctractDao):
             if case_result:
                 case_result.commit_dirtiness_flags()
 
-
     def commit_restore(self, restore_state):
         synclog_generic = restore_state.current_sync_log
         if synclog_generic:
@@ -57,23 +77,32 @@ class SQLDao(AbsctractDao):
             _, synclog = Synclog.from_generic(generic)
             db.session.add(synclog)
 
+    def iter_synclogs(self):
+        for synclog in Synclog.query.yield_per(SYNCLOG_STREAM_BATCH_SIZE):
+            yield synclog.to_generic()
+
     @to_generic
     def get_form(self, id):
         return FormData.query.get(id)
 
     @to_generic
     def get_case(self, id, lock=False):
+        def _get_case():
+            # to_generic needs the indices so get them in the same query
+            return CaseData.query.options(joinedload('indices')).get(id)
+
         if lock:
-            return get_with_lock('case_lock_{}'.format(id), lambda: CaseData.query.get(id))
+            return get_with_lock(get_case_lock_key(id), _get_case)
         else:
-            None, CaseData.query.get(id)
+            return _get_case()
 
     def case_exists(self, id):
         return CaseData.query.session.query(exists().where(CaseData.id == id)).scalar()
 
     @to_generic
     def get_cases(self, case_ids, ordered=False):
-        cases = CaseData.query.filter(CaseData.id.in_(case_ids)).all()
+        # load the indices for all the cases with one more query instead of one per case
+        cases = CaseData.query.filter(CaseData.id.in_(case_ids)).options(subqueryload('indices')).all()
         if ordered:
             # SQL won't return the rows in any particular order so we need to order them ourselves
             index_map = {UUID(id_): index for index, id_ in enumerate(case_ids)}
@@ -85,15 +114,60 @@ class SQLDao(AbsctractDao):
 
         return cases
 
-    @to_generic
+    @to_compact
+    def get_compact_cases(self, case_ids):
+        return CaseData.query.filter(CaseData.id.in_(case_ids)).options(subqueryload('indices')).all()
+
+    def iter_compact_cases(self, case_ids):
+        """
+        Reads the cases through a server side cursor and only decodes each case's
+        JSON as it's iterated over instead of loading ORM objects for all of them.
+        """
+        indices = defaultdict(list)
+        for index in CaseIndex.query.filter(CaseIndex.case_id.in_(case_ids)):
+            indices[index.case_id].append(index.to_compact())
+
+        rows = CaseData.query.with_entities(
+            CaseData.id,
+            CaseData.domain,
+            CaseData.closed,
+            CaseData.owner_id,
+            CaseData.server_modified_on,
+            CaseData.xml_fragments,
+            # psycopg2 would decode JSONB for the whole batch as it's fetched
+            cast(CaseData.case_json, Text),
+        ).filter(
+            CaseData.id.in_(case_ids)
+        ).execution_options(stream_results=True).yield_per(CASE_STREAM_BATCH_SIZE)
+
+        for id, domain, closed, owner_id, server_modified_on, xml_fragments, case_json in rows:
+            yield CompactCase(
+                json.loads(case_json),
+                indices=indices.pop(id, []),
+                xml_fragments=xml_fragments,
+                id=id,
+                domain=domain,
+                closed=closed,
+                owner_id=owner_id,
+                server_modified_on=server_modified_on,
+            )
+
+    @to_compact
     def get_reverse_indexed_cases(self, domain, case_ids):
         return CaseData.query.join('indices')\
             .filter(CaseIndex.domain == domain, CaseIndex.referenced_id.in_(case_ids))\
             .options(
                 contains_eager('indices'),
-                defer(CaseData.case_json)
+                defer(CaseData.case_json),
+                defer(CaseData.xml_fragments)
         ).all()
 
+    def get_reverse_index_owners(self, domain, case_ids):
+        return db.session.query(CaseIndex.case_id, CaseData.owner_id, CaseIndex.referenced_id)\
+            .join(CaseData, CaseData.id == CaseIndex.case_id)\
+            .filter(CaseIndex.domain == domain, CaseIndex.referenced_id.in_(case_ids))\
+            .all()
+
     def get_open_case_ids(self, domain, owner_id):
         return [row[0] for row in CaseData.query.with_entities(CaseData.id).filter(
             CaseData.domain == domain,
@@ -108,12 +182,57 @@ class SQLDao(AbsctractDao):
             CaseData.server_modified_on > reference_date
         )]
 
+    def get_open_case_ids_for_owners(self, domain, owner_ids):
+        return [row[0] for row in CaseData.query.with_entities(CaseData.id).filter(
+            CaseData.domain == domain,
+            CaseData.owner_id.in_(owner_ids),
+            CaseData.closed == False
+        )]
+
+    def get_case_ids_modified_with_owners_since(self, domain, owner_ids, reference_date):
+        return [row[0] for row in CaseData.query.with_entities(CaseData.id).filter(
+            CaseData.domain == domain,
+            CaseData.owner_id.in_(owner_ids),
+            CaseData.server_modified_on > reference_date
+        )]
+
     def get_indexed_case_ids(self, domain, case_ids):
         return [row[0] for row in CaseIndex.query.with_entities(CaseIndex.referenced_id).filter(
             CaseIndex.domain == domain,
             CaseIndex.case_id.in_(case_ids),
         )]
 
+    def get_case_footprint_info(self, domain, owner_id):
+        """
+        Follows the indices from the owner's open cases with a recursive query. Each
+        row is flagged with whether it came from the base set so a case that is both
+        open and referenced by another open case comes back twice.
+        """
+        footprint = db.session.query(
+            CaseData.id.label('case_id'), literal(True).label('is_base')
+        ).filter(
+            CaseData.domain == domain,
+            CaseData.owner_id == owner_id,
+            CaseData.closed == False
+        ).cte('footprint', recursive=True)
+        indexed = footprint.alias('indexed')
+        # UNION rather than UNION ALL so that cycles in the indices don't recurse forever
+        footprint = footprint.union(
+            db.session.query(CaseIndex.referenced_id, literal(False)).filter(
+                CaseIndex.domain == domain,
+                CaseIndex.case_id == indexed.c.case_id,
+                CaseIndex.referenced_id != None,
+            )
+        )
+
+        base_ids = set()
+        all_ids = set()
+        for case_id, is_base in db.session.query(footprint.c.case_id, footprint.c.is_base):
+            all_ids.add(case_id)
+            if is_base:
+                base_ids.add(case_id)
+        return FootprintInfo(base_ids=base_ids, all_ids=all_ids)
+
     def get_last_modified_dates(self, domain, case_ids):
         """
         Given a list of case IDs, return a dict where the ids are keys and the
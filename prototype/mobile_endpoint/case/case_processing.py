@@ -1,8 +1,9 @@
-from collections import namedtuple
+from collections import namedtuple, defaultdict
 import copy
 from datetime import datetime
 import logging
 from uuid import UUID
+from flask import current_app
 from sqlalchemy import or_
 
 from mobile_endpoint.case import const
@@ -12,37 +13,60 @@ from mobile_endpoint.dao import CaseDbCache
 from mobile_endpoint.exceptions import ReconciliationError
 from mobile_endpoint.form.form_processing import is_deprecation
 from mobile_endpoint.form.models import XFormInstance
-from mobile_endpoint.models import OwnershipCleanlinessFlag, db
-from mobile_endpoint.restore.cleanliness import should_create_flags_on_submission
+from mobile_endpoint.models import OwnershipCleanlinessFlag, PendingDirtinessCheck, db
+from mobile_endpoint.restore.cleanliness import should_create_flags_on_submission, should_defer_dirtiness_checks
 
 
 logger = logging.getLogger(__name__)
 
 
 def process_cases_in_form(xform, dao):
-    with CaseDbCache(dao, domain=xform['domain'],
-                     lock=True, deleted_ok=True, xforms=[xform]) as case_db:
-        case_result = _get_or_update_cases([xform], case_db)
+    return process_cases_in_forms([xform], dao)
+
+
+def process_cases_in_forms(xforms, dao):
+    """
+    Process the cases in a batch of forms from the same domain together.
+
+    All the forms share one case cache so each case is only loaded (and locked) once
+    no matter how many of the forms touch it.
+    """
+    domain = xforms[0]['domain']
+    with CaseDbCache(dao, domain=domain,
+                     lock=True, deleted_ok=True, xforms=xforms) as case_db:
+        case_db.populate(set(
+            case_update.id for xform in xforms for case_update in get_case_updates(xform) if case_update.id
+        ))
+
+        case_result = _get_or_update_cases(xforms, case_db)
         cases = case_result.cases
+        xforms_by_id = {xform.id: xform for xform in xforms}
 
         for case in cases:
             case['server_modified_on'] = datetime.utcnow()
             case_db.mark_changed(case)
             if not case.check_action_order():
                 try:
-                    case.reconcile_actions(rebuild=True, xforms={xform.id: xform})
+                    case.reconcile_actions(rebuild=True, xforms=xforms_by_id)
                 except ReconciliationError:
                     pass
 
         # TODO prototype: check that cases haven't been modified since we loaded them (why not use locking?)
 
-        if xform.last_sync_token:
-            relevant_log = case_db.dao.get_synclog(xform.last_sync_token)
-            if relevant_log:
-                if relevant_log.update_phone_lists(xform, cases):
-                    case_result.set_synclog(relevant_log)
+        synclogs = {}
+        for xform in xforms:
+            if xform.last_sync_token:
+                if xform.last_sync_token not in synclogs:
+                    synclogs[xform.last_sync_token] = case_db.dao.get_synclog(xform.last_sync_token)
+                    case_db.num_db_reads += 1
+                relevant_log = synclogs[xform.last_sync_token]
+                if relevant_log:
+                    if relevant_log.update_phone_lists(xform, cases):
+                        case_result.add_synclog(relevant_log)
 
         case_result.set_cases(case_db.get_changed())
+        case_result.num_db_reads = case_db.num_db_reads
+        logger.debug('Processed cases for %s form(s) with %s DB reads', len(xforms), case_db.num_db_reads)
         return case_result
 
 
@@ -54,8 +78,13 @@ def _get_or_update_cases(xforms, case_db):
     """
     # have to apply the deprecations before the updates
     sorted_forms = sorted(xforms, key=lambda f: 0 if is_deprecation(f) else 1)
+    defer_dirtiness_checks = should_defer_dirtiness_checks(case_db.dao)
+    previous_owners = {}
     for xform in sorted_forms:
         for case_update in get_case_updates(xform):
+            if defer_dirtiness_checks and case_update.id not in previous_owners:
+                previous_case = case_db.get(case_update.id)
+                previous_owners[case_update.id] = previous_case.owner_id if previous_case else None
             case_doc = _get_or_update_model(case_update, xform, case_db)
             if case_doc:
                 # normalize UUID format
@@ -67,6 +96,13 @@ def _get_or_update_cases(xforms, case_db):
     # this prevents indices that end up in the cache from being added to the return value
     touched_cases = copy.copy(case_db.cache)
 
+    # index targets are only read so load them all at once without locking them
+    case_db.populate({
+        index['referenced_id']
+        for case in touched_cases.values() for index in case['indices']
+        if index['referenced_id']
+    }, lock=False)
+
     # once we've gotten through everything, validate all indices
     # and check for new dirtiness flags
     def _validate_indices(case):
@@ -91,23 +127,52 @@ def _get_or_update_cases(xforms, case_db):
             dirtiness_flags.append(DirtinessFlag(case.id, case.owner_id))
         return dirtiness_flags
 
-    def _get_dirtiness_flags_for_child_cases(domain, cases):
-        child_cases = case_db.dao.get_reverse_indexed_cases(domain, [c['id'] for c in cases])
-        case_owner_map = dict((case.id, case.owner_id) for case in cases)
-        for child_case in child_cases:
-            for index in child_case.indices:
-                if (index.referenced_id in case_owner_map
-                        and child_case.owner_id != case_owner_map[index.referenced_id]):
-                    yield DirtinessFlag(child_case.id, child_case.owner_id)
-
-    dirtiness_flags = [flag for case in case_db.cache.values() for flag in _validate_indices(case)]
+    dirtiness_flags = [flag for case in touched_cases.values() for flag in _validate_indices(case)]
     domain = getattr(case_db, 'domain', None)
     track_cleanliness = True #should_track_cleanliness(domain)
+    pending_dirtiness_checks = None
     if track_cleanliness and touched_cases:
         # only do this extra step if the toggle is enabled since we know we aren't going to
         # care about the dirtiness flags otherwise.
-        dirtiness_flags += list(_get_dirtiness_flags_for_child_cases(domain, touched_cases.values()))
-    return CaseProcessingResult(domain, touched_cases.values(), dirtiness_flags, track_cleanliness)
+        case_owner_map = dict((case.id, case.owner_id) for case in touched_cases.values())
+        if defer_dirtiness_checks:
+            # queued with the flags and done by 'manage.py process_dirtiness_checks'
+            pending_dirtiness_checks = {
+                case_id: (owner_id, previous_owners.get(case_id)) for case_id, owner_id in case_owner_map.items()
+            }
+        else:
+            dirtiness_flags += list(get_child_case_dirtiness_flags(case_db.dao, domain, case_owner_map))
+            case_db.num_db_reads += 1
+    return CaseProcessingResult(domain, touched_cases.values(), dirtiness_flags, track_cleanliness,
+                                pending_dirtiness_checks)
+
+
+def get_child_case_dirtiness_flags(dao, domain, case_owner_map):
+    """
+    Yields a flag for each case that indexes one of the cases in ``case_owner_map``
+    (case id -> owner id) and has a different owner to it.
+    """
+    for child_id, child_owner_id, referenced_id in dao.get_reverse_index_owners(domain, list(case_owner_map)):
+        if referenced_id in case_owner_map and child_owner_id != case_owner_map[referenced_id]:
+            yield DirtinessFlag(child_id, child_owner_id)
+
+
+def process_pending_dirtiness_checks(dao, batch_size=1000):
+    """
+    Works out the flags for the child cases of a batch of the cases queued by submissions
+    when DEFERRED_DIRTINESS_CHECKS is on (SQL only). A case queued more than once in the batch is only
+    checked once, against its latest owner. Returns the number of queued checks processed.
+    """
+    with db.session.begin():
+        pending = PendingDirtinessCheck.claim(batch_size)
+        case_owners_by_domain = defaultdict(dict)
+        for check in pending:
+            case_owners_by_domain[check.domain][check.case_id] = check.owner_id
+
+        for domain, case_owner_map in case_owners_by_domain.items():
+            flags = list(get_child_case_dirtiness_flags(dao, domain, case_owner_map))
+            CaseProcessingResult(domain, [], flags, True).commit_dirtiness_flags()
+    return len(pending)
 
 
 # Lightweight class used to store the dirtyness of a case/owner pair.
@@ -118,12 +183,16 @@ class CaseProcessingResult(object):
     """
     Lightweight class used to collect results of case processing
     """
-    def __init__(self, domain, cases, dirtiness_flags, track_cleanliness):
+    def __init__(self, domain, cases, dirtiness_flags, track_cleanliness, pending_dirtiness_checks=None):
         self.domain = domain
         self.cases = cases
         self.dirtiness_flags = dirtiness_flags
         self.track_cleanliness = track_cleanliness
-        self.synclog = None
+        # case id -> (owner id, previous owner id) for the cases whose child cases still need checking
+        self.pending_dirtiness_checks = pending_dirtiness_checks or {}
+        self.synclogs = []
+        # how many times the DB was read from to process the cases
+        self.num_db_reads = 0
 
     def get_clean_owner_ids(self):
         dirty_flags = self.get_flags_to_save()
@@ -132,8 +201,9 @@ class CaseProcessingResult(object):
     def set_cases(self, cases):
         self.cases = cases
 
-    def set_synclog(self, synclog):
-        self.synclog = synclog
+    def add_synclog(self, synclog):
+        if not any(log is synclog for log in self.synclogs):
+            self.synclogs.append(synclog)
 
     def get_flags_to_save(self):
         return {f.owner_id: f.case_id for f in self.dirtiness_flags}
@@ -145,6 +215,17 @@ class CaseProcessingResult(object):
         if self.track_cleanliness and self.domain:
             flags_to_save = self.get_flags_to_save()
             with db.session.begin(subtransactions=True):
+                if self.pending_dirtiness_checks:
+                    PendingDirtinessCheck.queue(self.domain, self.pending_dirtiness_checks)
+
+                if current_app.config.get('UPSERT_CLEANLINESS_FLAGS'):
+                    if should_create_flags_on_submission(self.domain):
+                        all_touched_ids = set(flags_to_save.keys()) | self.get_clean_owner_ids()
+                        OwnershipCleanlinessFlag.upsert_flags(self.domain, all_touched_ids, flags_to_save)
+                    else:
+                        OwnershipCleanlinessFlag.mark_dirty(self.domain, flags_to_save)
+                    return
+
                 if should_create_flags_on_submission(self.domain):
                     # assert settings.UNIT_TESTING  # this is currently only true when unit testing
                     all_touched_ids = set(flags_to_save.keys()) | self.get_clean_owner_ids()
@@ -214,6 +295,10 @@ def extract_case_blocks(doc):
     """
 
     if isinstance(doc, XFormInstance):
+        case_blocks = getattr(doc, '_case_blocks', None)
+        if case_blocks is not None:
+            # already found by the streaming form parser
+            return list(case_blocks)
         doc = doc.form
     return list(_extract_case_blocks(doc))
 
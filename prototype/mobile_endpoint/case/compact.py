@@ -0,0 +1,211 @@
+"""
+Read only, slotted versions of the case models.
+
+Wrapping a case's JSON in a CommCareCase parses every property and every action
+up front which is most of the cost of loading a case. The restore and
+``get_reverse_indexed_cases`` only look at cases so they use these instead and
+the DAOs build them straight from the stored JSON. The rest of case processing
+still uses CommCareCase.
+
+Use ``to_generic`` to get the full CommCareCase back if it's needed.
+"""
+import string
+
+from jsonobject.api import re_date, re_datetime, re_decimal, re_time
+from jsonobject.properties import DateProperty, DateTimeProperty, DecimalProperty, TimeProperty
+
+from mobile_endpoint.case.models import CommCareCase
+
+
+_DATETIME = DateTimeProperty()
+
+# the conversions JsonObject applies to dynamic string properties, in the same order
+_STRING_CONVERSIONS = (
+    (re_date, DateProperty()),
+    (re_time, TimeProperty()),
+    (re_datetime, _DATETIME),
+    (re_decimal, DecimalProperty()),
+)
+
+# fields stored as columns by some of the backends that can override what's in the JSON
+_CASE_FIELDS = ('id', 'domain', 'closed', 'owner_id', 'user_id', 'server_modified_on')
+
+_STATIC_PROPERTIES = frozenset(CommCareCase.properties())
+
+# dynamic properties have to start with one of these (the same as r'^[a-zA-Z]')
+_PROPERTY_START = frozenset(string.ascii_letters)
+_DIGITS = frozenset(string.digits)
+
+
+def _wrap_datetime(value):
+    if value is None or hasattr(value, 'strftime'):
+        return value
+    return _DATETIME.wrap(value)
+
+
+def _unwrap_datetime(value):
+    if value is None:
+        return None
+    return _DATETIME.unwrap(value)[1]
+
+
+# the same dates tend to come up again and again and parsing them is slow
+_normalized_strings = {}
+_MAX_NORMALIZED_STRINGS = 10000
+
+
+def _normalize_string(value):
+    for pattern, property_ in _STRING_CONVERSIONS:
+        if pattern.match(value):
+            try:
+                return property_.unwrap(property_.wrap(value))[1]
+            except Exception:
+                # the same as jsonobject: leave anything that doesn't convert as it is
+                return value
+    return value
+
+
+def _normalize(value):
+    """
+    Give back a dynamic property value the way it comes out of
+    ``CommCareCase.wrap(...).to_json()`` e.g. '2015-04-08T12:00:01.000000Z'
+    becomes '2015-04-08T12:00:01Z'.
+    """
+    if isinstance(value, basestring):
+        if value[:1] not in _DIGITS:
+            # all of the patterns start with a digit so don't bother trying them
+            return value
+        if value not in _normalized_strings:
+            if len(_normalized_strings) >= _MAX_NORMALIZED_STRINGS:
+                _normalized_strings.clear()
+            _normalized_strings[value] = _normalize_string(value)
+        return _normalized_strings[value]
+    elif isinstance(value, dict):
+        return {key: _normalize(item) for key, item in value.items()}
+    elif isinstance(value, list):
+        return [_normalize(item) for item in value]
+    return value
+
+
+class CompactCaseIndex(object):
+    __slots__ = ('identifier', 'referenced_type', 'referenced_id')
+
+    def __init__(self, identifier, referenced_type, referenced_id):
+        self.identifier = identifier
+        self.referenced_type = referenced_type
+        self.referenced_id = referenced_id
+
+    @classmethod
+    def wrap(cls, index_json):
+        return cls(index_json.get('identifier'), index_json.get('referenced_type'),
+                   index_json.get('referenced_id'))
+
+    def to_json(self):
+        return {
+            'identifier': self.identifier,
+            'referenced_type': self.referenced_type,
+            'referenced_id': self.referenced_id,
+        }
+
+    def __repr__(self):
+        return "CompactCaseIndex(identifier=%r, referenced_type=%r, referenced_id=%r)" % (
+            self.identifier, self.referenced_type, self.referenced_id)
+
+
+class CompactCaseAction(object):
+    """
+    Only the parts of an action needed to decide whether a case needs to sync.
+    """
+    __slots__ = ('action_type', 'xform_id', 'server_date', 'sync_log_id')
+
+    def __init__(self, action_type, xform_id, server_date, sync_log_id):
+        self.action_type = action_type
+        self.xform_id = xform_id
+        self.server_date = server_date
+        self.sync_log_id = sync_log_id
+
+    @classmethod
+    def wrap(cls, action_json):
+        return cls(action_json.get('action_type'), action_json.get('xform_id'),
+                   _wrap_datetime(action_json.get('server_date')), action_json.get('sync_log_id'))
+
+    def __repr__(self):
+        return "{xform}: {type} ({server_date})".format(
+            xform=self.xform_id, type=self.action_type, server_date=self.server_date
+        )
+
+
+class CompactCase(object):
+    """
+    A read only case backed by the case JSON in the same format that
+    ``CommCareCase.wrap`` takes. Fields passed in as keyword arguments
+    (e.g. the ones stored in their own columns) take precedence over the JSON.
+
+    Only the fields the restore and case processing check up front are
+    unpacked. Everything else is read from the JSON when it's asked for.
+
+    ``xml_fragments`` is the restore XML stored with the case, if there is any
+    (see ``case.xml.serializer.get_case_xml_fragments``).
+    """
+    __slots__ = _CASE_FIELDS + ('indices', 'xml_fragments', '_json', '_actions')
+
+    def __init__(self, case_json, indices=None, xml_fragments=None, **fields):
+        self._json = case_json
+        self.xml_fragments = xml_fragments
+        for field in _CASE_FIELDS:
+            setattr(self, field, fields[field] if field in fields else case_json.get(field))
+        self.closed = bool(self.closed)
+        self.server_modified_on = _wrap_datetime(self.server_modified_on)
+        if indices is None:
+            indices = [CompactCaseIndex.wrap(index) for index in case_json.get('indices') or []]
+        self.indices = indices
+        self._actions = None
+
+    @property
+    def case_id(self):
+        return self.id
+
+    @property
+    def name(self):
+        return self._json.get('name')
+
+    @property
+    def type(self):
+        return self._json.get('type')
+
+    @property
+    def external_id(self):
+        return self._json.get('external_id')
+
+    @property
+    def modified_on(self):
+        return _wrap_datetime(self._json.get('modified_on'))
+
+    @property
+    def actions(self):
+        if self._actions is None:
+            self._actions = [CompactCaseAction.wrap(action) for action in self._json.get('actions') or []]
+        return self._actions
+
+    def dynamic_case_properties(self):
+        """(key, value) tuples sorted by key, the same as CommCareCase.dynamic_case_properties"""
+        properties = [
+            (key, _normalize(value)) for key, value in self._json.items()
+            if key[:1] in _PROPERTY_START and key not in _STATIC_PROPERTIES and key != 'id'
+        ]
+        properties.append(('id', self.id))
+        return sorted(properties)
+
+    def to_json(self):
+        case_json = dict(self._json)
+        case_json.update({field: getattr(self, field) for field in _CASE_FIELDS})
+        case_json['server_modified_on'] = _unwrap_datetime(self.server_modified_on)
+        case_json['indices'] = [index.to_json() for index in self.indices]
+        return case_json
+
+    def to_generic(self):
+        return CommCareCase.wrap(self.to_json())
+
+    def __repr__(self):
+        return "%s(name=%r, type=%r, id=%r)" % (
+                self.__class__.__name__, self.name, self.type, self.id)
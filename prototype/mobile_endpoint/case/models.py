@@ -330,7 +330,14 @@ class CommCareCase(JsonObject, IndexHoldingMixIn):
                 self.actions.extend(case_update.get_case_actions(xformdoc))
         else:
             # normal form - just get actions and apply them on the end
-            self.actions.extend(case_update.get_case_actions(xformdoc))
+            new_actions = case_update.get_case_actions(xformdoc)
+            if self._can_apply_in_order(new_actions):
+                self.apply_actions(new_actions, {xformdoc.id: xformdoc})
+                if case_update.version:
+                    self.version = case_update.version
+                return
+
+            self.actions.extend(new_actions)
 
         # rebuild the case
         local_forms = {xformdoc.id: xformdoc}
@@ -340,6 +347,39 @@ class CommCareCase(JsonObject, IndexHoldingMixIn):
         if case_update.version:
             self.version = case_update.version
 
+    def _can_apply_in_order(self, new_actions):
+        """
+        True if the new actions would end up after all the existing actions when the
+        case is rebuilt, in which case applying just them to the current state
+        gives the same result as a full rebuild.
+        """
+        if not self.actions or any(a.deprecated for a in self.actions):
+            return False
+
+        sort_key = _action_sort_key_function(self)
+        try:
+            previous = sort_key(self.actions[-1])
+            for action in new_actions:
+                key = sort_key(action)
+                if key < previous:
+                    return False
+                previous = key
+        except MissingServerDate:
+            return False
+        return True
+
+    def apply_actions(self, new_actions, xforms=None):
+        """
+        Add actions to the end of the case and apply them to the current state
+        without replaying the actions that came before them.
+        """
+        xforms = xforms or {}
+        self.actions.extend(new_actions)
+        for a in copy.deepcopy(list(new_actions)):
+            self._apply_action(a, xforms.get(a.xform_id))
+            if a.xform_id and a.xform_id not in self.xform_ids:
+                self.xform_ids.append(a.xform_id)
+
     def _apply_action(self, action, xform):
         if action.action_type == const.CASE_ACTION_CREATE:
             self.apply_create(action)
@@ -431,38 +471,7 @@ class CommCareCase(JsonObject, IndexHoldingMixIn):
         # this would normally work except we only recently started using the
         # form timestamp as the modification date so we have to do something
         # fancier to deal with old data
-        deduplicated_actions = list(set(self.actions))
-
-        def _further_deduplicate(action_list):
-            def actions_match(a1, a2):
-                # if everything but the server_date match, the actions match.
-                # this will allow for multiple case blocks to be submitted
-                # against the same case in the same form so long as they
-                # are different
-                a1doc = copy.copy(a1._doc)
-                a2doc = copy.copy(a2._doc)
-                a2doc['server_date'] = a1doc['server_date']
-                a2doc['date'] = a1doc['date']
-                return a1doc == a2doc
-
-            ret = []
-            for a in action_list:
-                found_actions = [other for other in ret if actions_match(a, other)]
-                if found_actions:
-                    if len(found_actions) != 1:
-                        error = (u"Case {0} action conflicts "
-                                 u"with multiple other actions: {1}")
-                        raise ReconciliationError(error.format(self.id, a))
-                    match = found_actions[0]
-                    # when they disagree, choose the _earlier_ one as this is
-                    # the one that is likely timestamped with the form's date
-                    # (and therefore being processed later in absolute time)
-                    ret[ret.index(match)] = a if a.server_date < match.server_date else match
-                else:
-                    ret.append(a)
-            return ret
-
-        deduplicated_actions = _further_deduplicate(deduplicated_actions)
+        deduplicated_actions = _deduplicate_actions(list(set(self.actions)))
         sorted_actions = sorted(
             deduplicated_actions,
             key=_action_sort_key_function(self)
@@ -535,6 +544,52 @@ class CommCareCase(JsonObject, IndexHoldingMixIn):
         return self._dynamic_properties.copy()
 
 
+def _deduplicate_actions(action_list):
+    """
+    If everything but the server_date and date match, the actions match.
+    This will allow for multiple case blocks to be submitted against the same
+    case in the same form so long as they are different.
+
+    When actions match keep the one with the _earlier_ server_date as this is
+    the one that is likely timestamped with the form's date (and therefore
+    being processed later in absolute time).
+
+    Matching actions share a key so each action can only ever match one of
+    the actions already kept.
+    """
+    ret = []
+    positions = {}
+    for a in action_list:
+        key = _action_match_key(a)
+        if key in positions:
+            match = ret[positions[key]]
+            if a.server_date < match.server_date:
+                ret[positions[key]] = a
+        else:
+            positions[key] = len(ret)
+            ret.append(a)
+    return ret
+
+
+def _action_match_key(action):
+    doc = dict(action.to_json())
+    doc.pop('server_date', None)
+    doc.pop('date', None)
+    return _freeze(doc)
+
+
+def _freeze(value):
+    """
+    A hashable version of some JSON that is equal to the frozen version of
+    another piece of JSON whenever the two are equal.
+    """
+    if isinstance(value, dict):
+        return frozenset((k, _freeze(v)) for k, v in value.items())
+    elif isinstance(value, list):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+
 def _action_sort_key_function(case):
     def _action_cmp(first_action, second_action):
         # if the forms aren't submitted by the same user, just default to server dates
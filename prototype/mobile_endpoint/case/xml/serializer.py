@@ -0,0 +1,243 @@
+"""
+Case XML for the restore written straight to a string.
+
+``get_case_xml`` builds an ElementTree for each case and then serializes it.
+This writes the same bytes without building the tree first, so it has to follow
+what ``restore.xml.get_case_element`` and ``ElementTree.tostring`` do exactly:
+attributes sorted by name, elements without text or children written as
+``<tag />`` and the same escaping. ``tests/test_case_xml.py`` checks the two
+against golden files.
+
+``get_case_xml_fragments`` renders the V2 XML for a case when it's saved so that
+the restore can send the stored string instead (see the STORED_CASE_XML setting).
+"""
+import logging
+
+from mobile_endpoint.case import const
+from mobile_endpoint.case.xml import V1, V2, V2_NAMESPACE, check_version
+from mobile_endpoint.utils import json_format_datetime
+
+_V1_ROOT = u'<case>'
+_V2_ROOT = u'<case case_id="%%s" date_modified="%%s" user_id="%%s" xmlns="%s">' % V2_NAMESPACE
+_CASE_CLOSE = u'</case>'
+_CLOSE_ELEMENT = u'<close />'
+_ELEMENT = u'<%s>%s</%s>'
+_EMPTY_ELEMENT = u'<%s />'
+_ATTRIBUTE = u' %s="%s"'
+_INDEX = u'<%s case_type="%s">%s</%s>'
+_EMPTY_INDEX = u'<%s case_type="%s" />'
+
+
+def _escape_text(text):
+    if u'&' in text:
+        text = text.replace(u'&', u'&amp;')
+    if u'<' in text:
+        text = text.replace(u'<', u'&lt;')
+    if u'>' in text:
+        text = text.replace(u'>', u'&gt;')
+    return text
+
+
+def _escape_attrib(text):
+    text = _escape_text(text)
+    if u'"' in text:
+        text = text.replace(u'"', u'&quot;')
+    if u'\n' in text:
+        text = text.replace(u'\n', u'&#10;')
+    return text
+
+
+def _element(tag, text):
+    if text:
+        return _ELEMENT % (tag, _escape_text(text), tag)
+    return _EMPTY_ELEMENT % tag
+
+
+def _safe_element(tag, value):
+    # the same as generator.safe_element: falsy values give an empty element
+    return _element(tag, unicode(value) if value else None)
+
+
+class _NeedsElementTree(Exception):
+    pass
+
+
+def _dynamic_element(key, value):
+    # the same as generator.get_dynamic_element
+    if not isinstance(value, dict):
+        return _element(key, unicode(value))
+
+    attrs = sorted((attr[1:], unicode(attr_value)) for attr, attr_value in value.items()
+                   if attr and attr.startswith(u'@'))
+    if any(name.startswith(u'{') for name, _ in attrs):
+        # ElementTree turns '{namespace}name' into a prefix that's declared on the root
+        raise _NeedsElementTree()
+    if not attrs:
+        return _element(key, unicode(value.get('#text', '')))
+
+    start = u'<' + key + u''.join(_ATTRIBUTE % (name, _escape_attrib(attr_value)) for name, attr_value in attrs)
+    text = unicode(value.get('#text', ''))
+    if text:
+        return u'%s>%s</%s>' % (start, _escape_text(text), key)
+    return start + u' />'
+
+
+class _V1Serializer(object):
+
+    def __init__(self, case):
+        self.case = case
+
+    def root(self):
+        return _V1_ROOT
+
+    def header(self):
+        # moved to attributes of the root in v2
+        return [
+            _safe_element(u'case_id', self.case.id),
+            _safe_element(u'date_modified', json_format_datetime(self.case.modified_on)),
+        ]
+
+    def base_properties(self):
+        return [
+            _safe_element(u'case_type_id', self.case.type),
+            _safe_element(u'user_id', self.case.user_id),
+            _safe_element(u'case_name', self.case.name),
+            _safe_element(u'external_id', self.case.external_id),
+        ]
+
+    def custom_properties(self):
+        elements = []
+        if self.case.owner_id:
+            elements.append(_safe_element(u'owner_id', self.case.owner_id))
+        elements.extend(_dynamic_element(key, value) for key, value in self.case.dynamic_case_properties())
+        return elements
+
+    def indices(self):
+        if self.case.indices:
+            logging.info("Tried to add indices to version 1 CaseXML restore. This is not supported. "
+                         "The case id is %s, domain %s." % (self.case.id, self.case.domain))
+        return u''
+
+
+class _V2Serializer(_V1Serializer):
+
+    def root(self):
+        return _V2_ROOT % (
+            _escape_attrib(self.case.id),
+            _escape_attrib(json_format_datetime(self.case.modified_on)),
+            _escape_attrib(self.case.user_id or u''),
+        )
+
+    def header(self):
+        return []
+
+    def base_properties(self):
+        return [
+            _safe_element(u'case_type', self.case.type),
+            _safe_element(u'case_name', self.case.name),
+            _safe_element(u'owner_id', self.case.owner_id or self.case.user_id),
+        ]
+
+    def custom_properties(self):
+        elements = []
+        if self.case.external_id:
+            elements.append(_safe_element(u'external_id', self.case.external_id))
+        elements.extend(_dynamic_element(key, value) for key, value in self.case.dynamic_case_properties())
+        return elements
+
+    def indices(self):
+        if not self.case.indices:
+            return u''
+        # sorted by identifier, the same as V2CaseXMLGenerator.add_indices
+        indices = sorted(self.case.indices, key=lambda index: index.identifier)
+        return u'<index>%s</index>' % u''.join(
+            _INDEX % (
+                index.identifier,
+                _escape_attrib(index.referenced_type),
+                _escape_text(unicode(index.referenced_id)),
+                index.identifier,
+            ) if index.referenced_id else _EMPTY_INDEX % (index.identifier, _escape_attrib(index.referenced_type))
+            for index in indices
+        )
+
+
+SERIALIZER_MAP = {
+    V1: _V1Serializer,
+    V2: _V2Serializer,
+}
+
+
+def get_case_xml_string(case, updates, version=V1):
+    """
+    The same as ``restore.xml.get_case_xml`` without building an ElementTree.
+    """
+    check_version(version)
+    if case is None:
+        logging.error("Can't generate case xml for empty case!")
+        return ""
+
+    try:
+        return _serialize(SERIALIZER_MAP[version](case), updates)
+    except _NeedsElementTree:
+        from mobile_endpoint.restore.xml import get_case_xml
+        return get_case_xml(case, updates, version)
+
+
+def _serialize(serializer, updates):
+    do_create = const.CASE_ACTION_CREATE in updates
+    do_update = const.CASE_ACTION_UPDATE in updates
+    do_purge = const.CASE_ACTION_CLOSE in updates
+
+    parts = serializer.header()
+    if do_create:
+        parts.append(u'<create>%s</create>' % u''.join(serializer.base_properties()))
+
+    if do_update:
+        update_elements = [] if do_create else serializer.base_properties()
+        update_elements.extend(serializer.custom_properties())
+        if update_elements:
+            parts.append(u'<update>%s</update>' % u''.join(update_elements))
+        parts.append(serializer.indices())
+
+    if do_purge:
+        parts.append(_CLOSE_ELEMENT)
+
+    root = serializer.root()
+    body = u''.join(parts)
+    if not body:
+        return (root[:-1] + u' />').encode('utf-8')
+    return (root + body + _CASE_CLOSE).encode('utf-8')
+
+
+def get_case_xml_fragments(case):
+    """
+    The V2 XML for the case when the phone doesn't have it yet and when it does.
+    ``get_case_xml_from_fragments`` adds the close to either of them.
+    """
+    fragments = {
+        const.CASE_ACTION_CREATE: get_case_xml_string(
+            case, [const.CASE_ACTION_CREATE, const.CASE_ACTION_UPDATE], V2),
+        const.CASE_ACTION_UPDATE: get_case_xml_string(case, [const.CASE_ACTION_UPDATE], V2),
+    }
+    return {key: xml.decode('utf-8') for key, xml in fragments.items()}
+
+
+def get_case_xml_from_fragments(fragments, updates, version):
+    """
+    The same as ``get_case_xml_string`` using the XML stored when the case was saved.
+    Returns None if there isn't a stored fragment for the updates and version.
+    """
+    if not fragments or version != V2 or const.CASE_ACTION_UPDATE not in updates:
+        return None
+
+    if const.CASE_ACTION_CREATE in updates:
+        xml = fragments.get(const.CASE_ACTION_CREATE)
+    else:
+        xml = fragments.get(const.CASE_ACTION_UPDATE)
+    if not xml or not xml.endswith(_CASE_CLOSE):
+        return None
+
+    if const.CASE_ACTION_CLOSE in updates:
+        # the close always comes last
+        xml = xml[:-len(_CASE_CLOSE)] + _CLOSE_ELEMENT + _CASE_CLOSE
+    return xml.encode('utf-8')
@@ -2,9 +2,38 @@ from abc import ABCMeta, abstractmethod
 import functools
 import types
 import collections
-import redis
 
+from flask import current_app
+
+from mobile_endpoint.case.xml.serializer import get_case_xml_fragments
 from mobile_endpoint.exceptions import IllegalCaseId
+from mobile_endpoint.utils import acquire_locks, get_case_lock_key, release_locks
+
+
+def _converter(method_name):
+    def decorator(fn):
+        def _wrap(obj):
+            if hasattr(obj, method_name):
+                return getattr(obj, method_name)()
+            else:
+                return obj
+
+        @functools.wraps(fn)
+        def _inner(*args, **kwargs):
+            obj = fn(*args, **kwargs)
+            try:
+                return getattr(obj, method_name)()
+            except AttributeError:
+                pass
+            if isinstance(obj, (list, tuple)):
+                return [_wrap(ob) for ob in obj]
+            elif isinstance(obj, (types.GeneratorType, collections.Iterable)):
+                return (_wrap(ob) for ob in obj)
+            else:
+                return _wrap(obj)
+
+        return _inner
+    return decorator
 
 
 def to_generic(fn):
@@ -12,36 +41,47 @@ def to_generic(fn):
     Helper decorator to convert from a DB type to a generic type by calling 'to_generic'
     on the db type. e.g. FormData to XFormInstance
     """
-    def _wrap(obj):
-        if hasattr(obj, 'to_generic'):
-            return obj.to_generic()
-        else:
-            return obj
-
-    @functools.wraps(fn)
-    def _inner(*args, **kwargs):
-        obj = fn(*args, **kwargs)
-        try:
-            return obj.to_generic()
-        except AttributeError:
-            pass
-        if isinstance(obj, (list, tuple)):
-            return [_wrap(ob) for ob in obj]
-        elif isinstance(obj, (types.GeneratorType, collections.Iterable)):
-            return (_wrap(ob) for ob in obj)
-        else:
-            return _wrap(obj)
+    return _converter('to_generic')(fn)
+
+
+def to_compact(fn):
+    """
+    Helper decorator to convert from a DB type to a read only compact type by calling
+    'to_compact' on the db type. e.g. CaseData to CompactCase
+    """
+    return _converter('to_compact')(fn)
+
+
+def get_stored_case_xml(case):
+    """
+    The restore XML to save along with the case if the STORED_CASE_XML setting
+    is on. Otherwise None, which the backends save too so that XML from an
+    earlier version of the case is never left behind.
+    """
+    if not current_app.config.get('STORED_CASE_XML'):
+        return None
+    return get_case_xml_fragments(case)
 
-    return _inner
 
 class AbsctractDao(object):
     __metaclass__ = ABCMeta
 
-    @abstractmethod
+    # whether the queue of pending dirtiness checks is saved in the same transaction
+    # as the cases (see DEFERRED_DIRTINESS_CHECKS)
+    queues_dirtiness_checks = False
+
     def commit_atomic_submission(self, xform, case_result):
         """
         Commit the transaction
         """
+        self.commit_atomic_submissions([xform], case_result)
+
+    @abstractmethod
+    def commit_atomic_submissions(self, xforms, case_result):
+        """
+        Commit a batch of forms along with the result of processing all of their
+        cases in a single write.
+        """
         pass
 
     @abstractmethod
@@ -56,6 +96,13 @@ class AbsctractDao(object):
     def save_synclog(self, generic):
         pass
 
+    @abstractmethod
+    def iter_synclogs(self):
+        """
+        Every sync log. This is for offline checks, not for serving requests.
+        """
+        pass
+
     @abstractmethod
     def get_form(self, id):
         pass
@@ -72,10 +119,34 @@ class AbsctractDao(object):
     def get_cases(self, case_ids, ordered=False):
         pass
 
+    @abstractmethod
+    def get_compact_cases(self, case_ids):
+        """
+        Same as get_cases but returns read only CompactCase objects
+        for code that doesn't need to update the cases.
+        """
+        pass
+
+    def iter_compact_cases(self, case_ids):
+        """
+        Same as get_compact_cases but for backends that can stream the cases,
+        only reads each one from the database as it's needed.
+        """
+        return self.get_compact_cases(case_ids)
+
     @abstractmethod
     def get_reverse_indexed_cases(self, domain, case_ids):
         """
         Given a base list of case ids, gets all cases that reference the given cases (child cases)
+        as CompactCase objects
+        """
+        pass
+
+    @abstractmethod
+    def get_reverse_index_owners(self, domain, case_ids):
+        """
+        Given a base list of case ids, gets a ``(child_case_id, child_owner_id, referenced_id)``
+        tuple for each index that references one of them without loading the child cases
         """
         pass
 
@@ -91,6 +162,21 @@ class AbsctractDao(object):
         """
         pass
 
+    @abstractmethod
+    def get_open_case_ids_for_owners(self, domain, owner_ids):
+        """
+        Same as get_open_case_ids but for cases owned by any of the owners.
+        """
+        pass
+
+    @abstractmethod
+    def get_case_ids_modified_with_owners_since(self, domain, owner_ids, reference_date):
+        """
+        Same as get_case_ids_modified_with_owner_since but for cases owned by any
+        of the owners.
+        """
+        pass
+
     @abstractmethod
     def get_indexed_case_ids(self, domain, case_ids):
         """
@@ -98,6 +184,17 @@ class AbsctractDao(object):
         """
         pass
 
+    def get_case_footprint_info(self, domain, owner_id):
+        """
+        Get the FootprintInfo for an owner (their open cases and every case those
+        reference, directly or indirectly) in a single query.
+
+        :returns:   None if the backend can't do this in one query, in which case
+                    ``restore.cleanliness.get_case_footprint_info`` follows the
+                    indices one level at a time.
+        """
+        return None
+
     @abstractmethod
     def get_last_modified_dates(self, domain, case_ids):
         """
@@ -127,17 +224,16 @@ class CaseDbCache(object):
         self.lock = lock
         self.locks = []
         self._changed = set()
+        # ids that were looked up in bulk and found not to exist
+        self._missing = set()
+        self.num_db_reads = 0
 
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        for lock in self.locks:
-            if lock:
-                try:
-                    lock.release()
-                except redis.ConnectionError:
-                    pass
+        release_locks(self.locks, degrade_gracefully=True)
+        self.locks = []
 
     def validate_doc(self, doc):
         if self.domain and doc['domain'] != self.domain:
@@ -157,19 +253,17 @@ class CaseDbCache(object):
             raise IllegalCaseId('case_id must not be empty')
         if case_id in self.cache:
             return self.cache[case_id]
-
-        case_doc, lock = self.dao.get_case(case_id, self.lock)
-        if lock:
-            self.locks.append(lock)
-
-        if not case_doc:
+        if case_id in self._missing:
             return None
 
-        self.validate_doc(case_doc)
-        self.cache[case_id] = case_doc
-        return case_doc
+        # The cases being updated are all loaded (and locked) up front so anything
+        # else is only being read. Don't lock it: waiting for another lock while
+        # already holding some could deadlock with another submission.
+        self.populate([case_id], lock=False if self.locks else None)
+        return self.cache.get(case_id)
 
     def set(self, case_id, case):
+        self._missing.discard(case_id)
         self.cache[case_id] = case
 
     def doc_exist(self, case_id):
@@ -178,15 +272,32 @@ class CaseDbCache(object):
     def in_cache(self, case_id):
         return case_id in self.cache
 
-    def populate(self, case_ids):
+    def populate(self, case_ids, lock=None):
         """
         Populates a set of IDs in the cache in bulk.
         Use this if you know you are going to need to access these later for performance gains.
         Does NOT overwrite what is already in the cache if there is already something there.
+
+        If this cache was created with ``lock=True`` the locks for all the IDs are
+        acquired (in one go) before the cases are loaded. Pass ``lock=False`` to skip
+        locking cases that will only be read. Only one locking call is allowed while
+        the cache is holding locks.
         """
-        case_ids = set(case_ids) - set(self.cache.keys())
-        for case in self.dao.get_cases(case_ids):
-            self.set(case['id'], case)
+        case_ids = set(case_ids) - set(self.cache.keys()) - self._missing
+        if not case_ids:
+            return
+
+        if self.lock if lock is None else lock:
+            # all the locks have to be taken in one go to avoid deadlocks
+            assert not self.locks, "CaseDbCache can't take more locks while it's holding some"
+            self.locks.append(acquire_locks([get_case_lock_key(case_id) for case_id in case_ids]))
+
+        self.num_db_reads += 1
+        for case in self.dao.get_cases(list(case_ids)):
+            if case:
+                self.validate_doc(case)
+                self.set(case['id'], case)
+        self._missing |= case_ids - set(self.cache.keys())
 
     def mark_changed(self, case):
         assert self.cache.get(case['id']) is case
@@ -1,12 +1,14 @@
 from datetime import datetime
 import hashlib
+import re
 from uuid import uuid4, UUID
 
-from flask import logging
+from flask import current_app as app, logging
 from werkzeug.exceptions import BadRequest
 from mobile_endpoint.exceptions import DuplicateFormException
 
 from mobile_endpoint.form.models import XFormInstance, doc_types, XFormDuplicate
+from mobile_endpoint.form.parser import parse_form
 from mobile_endpoint.utils import adjust_datetimes, get_with_lock, ReleaseOnError, LockManager
 import xml2json
 
@@ -28,6 +30,9 @@ MULTIPART_EMPTY_PAYLOAD_ERROR = BadRequest((
 ) % FORM_PARAMETER_NAME)
 EMPTY_PAYLOAD_ERROR = BadRequest('Post may not have an empty body\n')
 
+# each form in a concatenated batch must start with its own XML declaration
+XML_DECLARATION = re.compile(r'<\?xml[^>]*\?>')
+
 
 def get_request_metadata(request):
     """
@@ -67,9 +72,56 @@ def get_instance_and_attachments(request):
     return instance, attachments
 
 
-def create_xform(instance_xml, attachments, request_meta, dao):
-    json_form = _get_xform_json(instance_xml)
-    adjust_datetimes(json_form)
+def get_instances(request):
+    """
+    Get all the form instances out of a batch submission. Either:
+
+    * multipart/form-data with one file per form (in the order they were added), or
+    * a request body made up of complete XML documents, one after the other, each
+      starting with an XML declaration.
+
+    Attachments are not supported for batch submissions.
+    """
+    if 'multipart/form-data' in request.headers.get('Content-Type', ''):
+        instances = [item.read().strip() for _, item in request.files.items(multi=True)]
+        if not all(instances):
+            raise MULTIPART_EMPTY_PAYLOAD_ERROR
+    else:
+        instances = split_instances(request.data)
+
+    if not instances:
+        raise EMPTY_PAYLOAD_ERROR
+    return instances
+
+
+def split_instances(data):
+    """
+    >>> split_instances("<?xml version='1.0' ?><a/>\\n<?xml version='1.0' ?><b/>")
+    ["<?xml version='1.0' ?><a/>", "<?xml version='1.0' ?><b/>"]
+    >>> split_instances("<a/>")
+    ['<a/>']
+    """
+    starts = [match.start() for match in XML_DECLARATION.finditer(data)]
+    if not starts or starts[0] != 0:
+        starts.insert(0, 0)
+    ends = starts[1:] + [len(data)]
+    return [chunk for chunk in (data[start:end].strip() for start, end in zip(starts, ends)) if chunk]
+
+
+def create_xform(instance_xml, attachments, request_meta, dao, batch_forms=None):
+    """
+    :param batch_forms: dict of form id to form for forms that were already created from
+                        the same batch submission. These are treated as existing forms
+                        when checking for duplicates since they aren't saved yet.
+    """
+    case_blocks = None
+    if app.config.get('STREAMING_FORM_PARSER'):
+        parsed = parse_form(instance_xml)
+        json_form, case_blocks, id_from_xml = parsed.json, parsed.case_blocks, parsed.instance_id
+    else:
+        json_form = _get_xform_json(instance_xml)
+        adjust_datetimes(json_form)
+        id_from_xml = _extract_meta_field(json_form, ('instanceID', 'uuid'))
 
     xform = XFormInstance(
         # form has to be wrapped
@@ -81,13 +133,19 @@ def create_xform(instance_xml, attachments, request_meta, dao):
     )
 
     xform._md5 = hashlib.md5(instance_xml).hexdigest()
+    if case_blocks is not None:
+        # save having to search the form for them again
+        xform._case_blocks = case_blocks
 
     for key, value in request_meta.items():
         setattr(xform, key, value)
 
-    id_from_xml = _extract_meta_field(json_form, ('instanceID', 'uuid'))
     form_id = id_from_xml or str(uuid4())
     xform['id'] = form_id
+    if batch_forms and form_id in batch_forms:
+        # we already hold the lock for this ID
+        return handle_duplicate_form(xform, batch_forms[form_id])
+
     xform_lock = aquire_xform_lock(xform)
     try:
         with ReleaseOnError(xform_lock.lock):
@@ -0,0 +1,138 @@
+from collections import namedtuple
+from io import BytesIO
+
+from lxml import etree
+
+from mobile_endpoint.case import const
+from mobile_endpoint.utils import adjust_datetime
+
+
+DEVICE_REPORT_XMLNS = "http://code.javarosa.org/devicereport"
+
+ParsedForm = namedtuple('ParsedForm', ['json', 'case_blocks', 'instance_id'])
+
+
+class _Node(object):
+    __slots__ = ('name', 'xmlns', 'value', 'case_blocks')
+
+    def __init__(self, name, xmlns, value):
+        self.name = name
+        self.xmlns = xmlns
+        self.value = value
+        self.case_blocks = []
+
+
+def parse_form(xml_string):
+    """
+    Parse a form submission in a single streaming pass.
+
+    This is equivalent to (and must stay equivalent to) running:
+
+        json_form = _get_xform_json(xml_string)
+        adjust_datetimes(json_form)
+        extract_case_blocks(json_form)
+        _extract_meta_field(json_form, ...)
+
+    but the JSON is built up as the XML is read instead of walking the whole
+    document three times. Case blocks are returned in document order.
+    """
+    stack = []
+    root = None
+    # forms tend to repeat the same tags and dates (e.g. date_modified on every case block)
+    # so only work each one out once
+    tags = {}
+    datetimes = {}
+
+    def split_tag(tag):
+        if tag not in tags:
+            tags[tag] = _split_tag(tag)
+        return tags[tag]
+
+    def adjust(value):
+        if value not in datetimes:
+            datetimes[value] = adjust_datetime(value)
+        return datetimes[value]
+
+    if isinstance(xml_string, unicode):
+        xml_string = xml_string.encode('utf-8')
+
+    for event, elem in etree.iterparse(BytesIO(xml_string), events=('start', 'end')):
+        if event == 'start':
+            xmlns, name = split_tag(elem.tag)
+            value = {}
+            for key, attr_value in elem.attrib.items():
+                value['@' + split_tag(key)[1]] = adjust(attr_value)
+            parent_xmlns = stack[-1].xmlns if stack else None
+            if xmlns and xmlns != parent_xmlns:
+                value['@xmlns'] = xmlns
+            stack.append(_Node(name, xmlns, value))
+            continue
+
+        node = stack.pop()
+        text = elem.text.strip() if elem.text else ''
+        if node.value:
+            if text:
+                node.value['#text'] = adjust(text)
+        else:
+            node.value = adjust(text)
+        # the JSON has everything we need so don't keep the tree around
+        elem.clear()
+
+        if _is_device_report(node.value):
+            node.case_blocks = []
+
+        if not stack:
+            root = node
+            break
+
+        parent = stack[-1]
+        _add_child(parent.value, node.name, node.value)
+        if node.name == const.CASE_TAG:
+            # case blocks don't get searched for nested case blocks
+            if _has_case_id(node.value):
+                parent.case_blocks.append(node.value)
+        else:
+            parent.case_blocks.extend(node.case_blocks)
+
+    json_form = root.value
+    json_form['#type'] = root.name
+    meta = json_form.get('Meta') or json_form.get('meta') or {}
+    return ParsedForm(
+        json=json_form,
+        case_blocks=root.case_blocks,
+        instance_id=_get_first(meta, ('instanceID', 'uuid')),
+    )
+
+
+def _split_tag(tag):
+    if tag[0] == '{':
+        xmlns, name = tag[1:].split('}', 1)
+        return xmlns, name
+    return None, tag
+
+
+def _add_child(value, name, child):
+    if name in value:
+        existing = value[name]
+        if isinstance(existing, list):
+            existing.append(child)
+        else:
+            value[name] = [existing, child]
+    else:
+        value[name] = child
+
+
+def _get_first(meta, fields):
+    for field in fields:
+        if field in meta:
+            return meta[field]
+
+
+def _has_case_id(case_block):
+    return const.CASE_TAG_ID in case_block or const.CASE_ATTR_ID in case_block
+
+
+def _is_device_report(value):
+    return isinstance(value, dict) and (
+        value.get('@xmlns') == DEVICE_REPORT_XMLNS or value.get('xmlns') == DEVICE_REPORT_XMLNS
+    )
@@ -1,16 +1,20 @@
+from collections import defaultdict, namedtuple
 from datetime import datetime
+from flask import current_app
 from flask.ext.migrate import Migrate
-from flask.ext.sqlalchemy import SQLAlchemy
-from sqlalchemy import event
+from sqlalchemy import event, inspect, or_
 from sqlalchemy.dialects.postgresql import UUID, ARRAY, JSONB
 from sqlalchemy.orm.session import object_session
+from mobile_endpoint.case.compact import CompactCase, CompactCaseIndex
 from mobile_endpoint.case.models import CommCareCase, CommCareCaseIndex
 
 from mobile_endpoint.form.models import XFormInstance, doc_types_compressed, compressed_doc_type
+from mobile_endpoint.pool import PooledSQLAlchemy
 from mobile_endpoint.synclog.checksum import Checksum
+from mobile_endpoint.synclog.packed import PackedUUIDSet, get_packed_case_ids
 from mobile_endpoint.synclog.models import SimplifiedSyncLog, IndexTree
 
-db = SQLAlchemy(session_options={'autocommit': True})
+db = PooledSQLAlchemy(session_options={'autocommit': True})
 
 migrate = Migrate()
 
@@ -154,6 +158,8 @@ class CaseData(db.Model, ToFromGeneric):
     version = db.Column(db.Integer(), default=0)
     case_json = db.Column(JSONB(), nullable=False)
     attachments = db.Column(JSONB())
+    # restore XML rendered when the case was saved (see SQLDao.commit_atomic_submissions)
+    xml_fragments = db.Column(JSONB())
 
     forms = db.relationship("FormData", secondary=case_form_link, backref="cases")
 
@@ -174,8 +180,23 @@ class CaseData(db.Model, ToFromGeneric):
         generic._self = self
         return generic
 
+    def to_compact(self):
+        # leave the JSON out if the query deferred it rather than loading it for each row
+        unloaded = inspect(self).unloaded
+        case_json = {} if 'case_json' in unloaded else self.case_json or {}
+        return CompactCase(
+            case_json,
+            indices=[index.to_compact() for index in self.indices],
+            xml_fragments=None if 'xml_fragments' in unloaded else self.xml_fragments,
+            id=self.id,
+            owner_id=self.owner_id,
+            closed=self.closed,
+            domain=self.domain,
+            server_modified_on=self.server_modified_on,
+        )
+
     @classmethod
-    def from_generic(cls, generic, xform=None, **kwargs):
+    def from_generic(cls, generic, xforms=None, **kwargs):
         if hasattr(generic, '_self'):
             self = generic._self
             new = False
@@ -190,7 +211,7 @@ class CaseData(db.Model, ToFromGeneric):
             json.pop(att)
         self.case_json = json
 
-        if xform:
+        for xform in xforms or []:
             self.forms.append(xform)
 
         return new, self
@@ -231,6 +252,9 @@ class CaseIndex(db.Model, ToFromGeneric):
         index._self = self
         return index
 
+    def to_compact(self):
+        return CompactCaseIndex(self.identifier, self.referenced_type, self.referenced_id)
+
     @classmethod
     def from_generic(cls, generic, domain=None, case_id=None, **kwargs):
         if hasattr(generic, '_self'):
@@ -259,10 +283,17 @@ class CaseIndex(db.Model, ToFromGeneric):
             ref_type=self.referenced_type,
             ref_id=self.referenced_id)
 
-db.Index('ix_case_index_referenced_id', CaseIndex.domain, CaseIndex.referenced_id)
+# includes case_id so the reverse index lookups only need the index
+db.Index('ix_case_index_referenced_id', CaseIndex.domain, CaseIndex.referenced_id, CaseIndex.case_id)
 
 
 class Synclog(db.Model, ToFromGeneric):
+    """
+    With the SYNCLOG_SNAPSHOT_INTERVAL setting above 1 most sync logs are saved as
+    just the changes to the cases on the phone since their previous log (``delta``)
+    and only every so often in full. ``delta_depth`` is how many logs back the last
+    full one is, 0 for a log that is saved in full.
+    """
     __tablename__ = 'synclog'
     id = db.Column(UUID(), primary_key=True)
     date = db.Column(db.DateTime(), nullable=False)
@@ -274,12 +305,78 @@ class Synclog(db.Model, ToFromGeneric):
     case_ids_on_phone = db.Column(ARRAY(UUID))
     dependent_case_ids_on_phone = db.Column(ARRAY(UUID))
     index_tree = db.Column(JSONB())
+    # the case ids packed into one string instead (see PACKED_SYNCLOG_CASE_IDS)
+    packed_case_ids = db.Column(db.LargeBinary())
+    packed_dependent_case_ids = db.Column(db.LargeBinary())
+    delta = db.Column(JSONB())
+    delta_depth = db.Column(db.Integer(), nullable=False, default=0, server_default='0')
 
     @property
     def checksum(self):
         return Checksum(initial_checksum=self.hash)
 
+    def get_phone_state(self):
+        """
+        The case ids, dependent case ids and indices on the phone, putting them
+        back together from the last full log and the deltas since if need be.
+        """
+        deltas = []
+        log = self
+        earlier_logs = self._get_earlier_logs() if self.delta_depth else {}
+        while log.delta_depth:
+            deltas.append(log.delta)
+            # the chain can be missing from the earlier logs if the user has synced
+            # from an old sync token in the meantime
+            log = earlier_logs.get(log.previous_log_id) or Synclog.query.get(log.previous_log_id)
+
+        if log.packed_case_ids is not None:
+            case_ids = PackedUUIDSet(log.packed_case_ids).to_set()
+            dependent_case_ids = PackedUUIDSet(log.packed_dependent_case_ids).to_set()
+        else:
+            case_ids = set(log.case_ids_on_phone or [])
+            dependent_case_ids = set(log.dependent_case_ids_on_phone or [])
+        state = _PhoneState(case_ids, dependent_case_ids, dict(log.index_tree or {}))
+        for delta in reversed(deltas):
+            _apply_delta(state, delta)
+        return state
+
+    def _get_earlier_logs(self):
+        """
+        The user's logs before this one, as many as it takes to get back to the last
+        full log if they're all in the same chain, by ID.
+        """
+        logs = Synclog.query.filter(
+            Synclog.user_id == self.user_id,
+            Synclog.date <= self.date,
+            Synclog.id != self.id,
+        ).order_by(Synclog.date.desc()).limit(self.delta_depth)
+        return {log.id: log for log in logs}
+
+    def set_phone_state(self, state, previous_log=None, previous_state=None):
+        """
+        Save the state as the changes from ``previous_log`` or in full if it's None.
+        ``previous_state`` saves getting the previous log's state again if it's known.
+        """
+        if previous_log is not None:
+            self.delta = _get_delta(previous_state or previous_log.get_phone_state(), state)
+            self.delta_depth = previous_log.delta_depth + 1
+            self.case_ids_on_phone = self.dependent_case_ids_on_phone = self.index_tree = None
+            self.packed_case_ids = self.packed_dependent_case_ids = None
+        else:
+            self.delta = None
+            self.delta_depth = 0
+            self.index_tree = state.indices
+            self.packed_case_ids = get_packed_case_ids(state.case_ids)
+            self.packed_dependent_case_ids = get_packed_case_ids(state.dependent_case_ids)
+            if self.packed_case_ids is not None and self.packed_dependent_case_ids is not None:
+                self.case_ids_on_phone = self.dependent_case_ids_on_phone = None
+            else:
+                self.case_ids_on_phone = list(state.case_ids)
+                self.dependent_case_ids_on_phone = list(state.dependent_case_ids)
+                self.packed_case_ids = self.packed_dependent_case_ids = None
+
     def to_generic(self):
+        state = self.get_phone_state()
         synclog = SimplifiedSyncLog(
             id=self.id,
             date=self.date,
@@ -287,9 +384,9 @@ class Synclog(db.Model, ToFromGeneric):
             user_id=self.user_id,
             previous_log_id=self.previous_log_id,
             owner_ids_on_phone=set(self.owner_ids_on_phone or []),
-            case_ids_on_phone=set(self.case_ids_on_phone or []),
-            dependent_case_ids_on_phone=set(self.dependent_case_ids_on_phone or []),
-            index_tree=IndexTree(indices=self.index_tree or {})
+            case_ids_on_phone=state.case_ids,
+            dependent_case_ids_on_phone=state.dependent_case_ids,
+            index_tree=IndexTree(indices=state.indices)
         )
         synclog._hash = self.hash
         synclog._self = self
@@ -300,14 +397,23 @@ class Synclog(db.Model, ToFromGeneric):
         if hasattr(generic, '_self'):
             self = generic._self
             new = False
+            if _get_snapshot_interval() > 1:
+                # logs saved as the changes from this one need to be saved in full
+                # before the state they were based on is changed. There aren't any
+                # with the interval at 1 once compact_synclogs has been run.
+                for child in Synclog.query.filter(Synclog.previous_log_id == self.id, Synclog.delta_depth > 0):
+                    child.set_phone_state(child.get_phone_state())
         else:
             self = cls(id=generic.id)
             new = True
 
-        for att in ['date', 'domain', 'user_id', 'previous_log_id', 'owner_ids_on_phone', 'case_ids_on_phone', 'dependent_case_ids_on_phone']:
+        for att in ['date', 'domain', 'user_id', 'previous_log_id', 'owner_ids_on_phone']:
             setattr(self, att, getattr(generic, att))
 
-        self.index_tree = generic.index_tree.indices
+        state = _PhoneState(
+            generic.case_ids_on_phone, generic.dependent_case_ids_on_phone, generic.index_tree.indices
+        )
+        self.set_phone_state(state, _get_delta_base(generic.previous_log_id))
         self.hash = generic.get_state_hash().hash
         
         return new, self
@@ -322,6 +428,89 @@ class Synclog(db.Model, ToFromGeneric):
                 "previous_log_id='{s.previous_log_id}, "
                 "hash='{s.hash}')").format(s=self)
 
+db.Index('ix_synclog_previous_log_id', Synclog.previous_log_id)
+
+
+_PhoneState = namedtuple('_PhoneState', ['case_ids', 'dependent_case_ids', 'indices'])
+
+
+def _get_snapshot_interval():
+    return current_app.config.get('SYNCLOG_SNAPSHOT_INTERVAL') or 1
+
+
+def _get_delta_base(previous_log_id):
+    """
+    The log to save a log as the changes from, or None if it should be saved in full
+    """
+    interval = _get_snapshot_interval()
+    if not previous_log_id or interval <= 1:
+        return None
+    previous_log = Synclog.query.get(previous_log_id)
+    if previous_log is None or previous_log.delta_depth + 1 >= interval:
+        return None
+    return previous_log
+
+
+def _get_delta(previous, current):
+    changed_indices = {
+        case_id: indices for case_id, indices in current.indices.items()
+        if previous.indices.get(case_id) != indices
+    }
+    changed_indices.update({case_id: None for case_id in previous.indices if case_id not in current.indices})
+    return {
+        'case_ids': [list(current.case_ids - previous.case_ids), list(previous.case_ids - current.case_ids)],
+        'dependent_case_ids': [
+            list(current.dependent_case_ids - previous.dependent_case_ids),
+            list(previous.dependent_case_ids - current.dependent_case_ids),
+        ],
+        'indices': changed_indices,
+    }
+
+
+def _apply_delta(state, delta):
+    added, removed = delta['case_ids']
+    state.case_ids.difference_update(removed)
+    state.case_ids.update(added)
+    added, removed = delta['dependent_case_ids']
+    state.dependent_case_ids.difference_update(removed)
+    state.dependent_case_ids.update(added)
+    for case_id, indices in delta['indices'].items():
+        if indices is None:
+            state.indices.pop(case_id, None)
+        else:
+            state.indices[case_id] = indices
+
+
+def compact_synclogs():
+    """
+    Re-save the sync logs that aren't in the format SYNCLOG_SNAPSHOT_INTERVAL asks for,
+    e.g. the ones saved in full before it was set or after it was changed, one user
+    at a time. Returns how many were re-saved.
+    """
+    resaved = 0
+    for user_id, in db.session.query(Synclog.user_id).distinct().all():
+        with db.session.begin():
+            logs = Synclog.query.filter_by(user_id=user_id).all()
+            log_ids = {log.id for log in logs}
+            next_logs = defaultdict(list)
+            for log in logs:
+                if log.previous_log_id in log_ids:
+                    next_logs[log.previous_log_id].append(log)
+
+            # a log is re-saved before the ones after it, which are given its state.
+            # Re-saving a log doesn't change its state so the logs after it still get theirs.
+            to_resave = [(log, None) for log in logs if log.previous_log_id not in log_ids]
+            while to_resave:
+                log, previous_state = to_resave.pop()
+                state = log.get_phone_state()
+                previous_log = _get_delta_base(log.previous_log_id)
+                delta_depth = previous_log.delta_depth + 1 if previous_log is not None else 0
+                if delta_depth != log.delta_depth:
+                    log.set_phone_state(state, previous_log, previous_state)
+                    resaved += 1
+                to_resave.extend((next_log, state) for next_log in next_logs[log.id])
+    return resaved
+
 
 class OwnershipCleanlinessFlag(db.Model):
     """
@@ -351,8 +540,122 @@ class OwnershipCleanlinessFlag(db.Model):
                 db.session.add(instance)
             return instance
 
+    @classmethod
+    def upsert_flags(cls, domain, owner_ids, hints):
+        """
+        Creates a flag for each owner id that doesn't have one yet, clean unless it's
+        in ``hints`` (owner id -> the case that makes it dirty), and marks the existing
+        flags in ``hints`` dirty unless they already are and have a hint. One statement
+        so concurrent submissions for the same owner don't race on the insert.
+        """
+        if not owner_ids:
+            return
+        params = {'domain': domain, 'now': datetime.utcnow()}
+        values = []
+        # always in the same order so concurrent upserts can't deadlock
+        for i, owner_id in enumerate(sorted(owner_ids)):
+            params['owner_id_%d' % i] = owner_id
+            params['is_clean_%d' % i] = owner_id not in hints
+            params['hint_%d' % i] = hints.get(owner_id)
+            values.append(_FLAG_VALUES.format(i))
+        db.session.execute(db.text(_UPSERT_FLAGS.format(values=', '.join(values))), params)
+
+    @classmethod
+    def mark_dirty(cls, domain, hints):
+        """
+        Marks the existing flags in ``hints`` dirty unless they already are and have a hint
+        without creating any new ones.
+        """
+        if not hints:
+            return
+        params = {'domain': domain, 'now': datetime.utcnow()}
+        values = []
+        for i, owner_id in enumerate(sorted(hints)):
+            params['owner_id_%d' % i] = owner_id
+            params['hint_%d' % i] = hints[owner_id]
+            values.append(_DIRTY_VALUES.format(i))
+        db.session.execute(db.text(_MARK_DIRTY.format(values=', '.join(values))), params)
+
+
+_FLAG_VALUES = '(:domain, CAST(:owner_id_{0} AS uuid), :is_clean_{0}, :now, CAST(:hint_{0} AS uuid))'
+_UPSERT_FLAGS = """
+    INSERT INTO ownership_cleanliness_flag AS flag (domain, owner_id, is_clean, last_checked, hint)
+    VALUES {values}
+    ON CONFLICT (domain, owner_id) DO UPDATE
+    SET is_clean = FALSE, hint = EXCLUDED.hint, last_checked = EXCLUDED.last_checked
+    WHERE EXCLUDED.hint IS NOT NULL AND (flag.is_clean OR flag.hint IS NULL)
+"""
+_DIRTY_VALUES = '(CAST(:owner_id_{0} AS uuid), CAST(:hint_{0} AS uuid))'
+_MARK_DIRTY = """
+    UPDATE ownership_cleanliness_flag AS flag
+    SET is_clean = FALSE, hint = dirty.hint, last_checked = :now
+    FROM (VALUES {values}) AS dirty (owner_id, hint)
+    WHERE flag.domain = :domain AND flag.owner_id = dirty.owner_id
+    AND (flag.is_clean OR flag.hint IS NULL)
+"""
+
 
 @event.listens_for(OwnershipCleanlinessFlag, "before_update")
 def gen_default(mapper, connection, instance):
     if object_session(instance).is_modified(instance, include_collections=False):
         instance.last_checked = datetime.utcnow()
+
+
+class PendingDirtinessCheck(db.Model):
+    """
+    A case changed by a submission whose child cases haven't been checked for
+    other owners yet (see the DEFERRED_DIRTINESS_CHECKS setting).
+
+    Child cases are checked against the cases they index when they're submitted so
+    the check can only find new dirty owners if the case's owner changed, and then
+    it's the children that had its previous owner. Restores treat the case's owner
+    and previous owner as dirty while the check is pending. Child cases submitted
+    before the case they index existed aren't covered until it's done.
+    """
+    __tablename__ = 'pending_dirtiness_check'
+    id = db.Column(db.BigInteger(), primary_key=True)
+    domain = db.Column(db.Text(), nullable=False, index=True)
+    case_id = db.Column(UUID(), nullable=False)
+    owner_id = db.Column(UUID())
+    previous_owner_id = db.Column(UUID())
+
+    @classmethod
+    def queue(cls, domain, checks):
+        """
+        :param checks:  dict of case id -> (owner id, owner id before the submission)
+        """
+        db.session.execute(cls.__table__.insert().values([
+            {'domain': domain, 'case_id': case_id, 'owner_id': owner_id, 'previous_owner_id': previous_owner_id}
+            for case_id, (owner_id, previous_owner_id) in checks.items()
+        ]))
+
+    @classmethod
+    def get_pending_owner_ids(cls, domain, owner_ids):
+        """
+        The owners out of ``owner_ids`` that pending checks could make dirty
+        """
+        owner_ids = set(owner_ids)
+        rows = db.session.query(cls.owner_id, cls.previous_owner_id).filter(
+            cls.domain == domain,
+            or_(cls.owner_id.in_(owner_ids), cls.previous_owner_id.in_(owner_ids)),
+        ).distinct()
+        return {owner_id for row in rows for owner_id in row if owner_id in owner_ids}
+
+    @classmethod
+    def claim(cls, batch_size):
+        """
+        Deletes up to ``batch_size`` of the oldest checks and returns them in the order
+        they were queued. Checks another transaction has claimed are skipped so
+        workers can run side by side, and they're back in the queue if the
+        transaction is rolled back.
+        """
+        rows = db.session.execute(db.text(_CLAIM_DIRTINESS_CHECKS), {'batch_size': batch_size})
+        return sorted(rows, key=lambda row: row.id)
+
+
+_CLAIM_DIRTINESS_CHECKS = """
+    DELETE FROM pending_dirtiness_check WHERE id IN (
+        SELECT id FROM pending_dirtiness_check ORDER BY id LIMIT :batch_size FOR UPDATE SKIP LOCKED
+    )
+    RETURNING id, domain, case_id, owner_id
+"""
@@ -0,0 +1,147 @@
+"""
+Database connection pool settings.
+
+Under gevent every greenlet in a worker process shares the worker's pool, so once
+more requests are using the database than SQLALCHEMY_POOL_SIZE +
+SQLALCHEMY_MAX_OVERFLOW the rest wait for a connection to be returned (for up to
+SQLALCHEMY_POOL_TIMEOUT seconds). Each gunicorn worker has its own pool so
+Postgres (or pgbouncer) needs to accept workers * (size + overflow) connections.
+
+``TimedQueuePool`` records how long each checkout waited in ``checkout_stats``,
+logs slow ones and logs a summary every SQLALCHEMY_POOL_STATS_INTERVAL seconds.
+``configure_pool`` sets up the other settings on the engine:
+
+* SQLALCHEMY_POOL_PRE_PING: test each connection with a ``SELECT 1`` when it's
+  checked out and reconnect if it's gone (e.g. after a database restart)
+* SQLALCHEMY_STATEMENT_TIMEOUT: milliseconds before Postgres cancels a statement
+* SQLALCHEMY_PGBOUNCER: the database is behind pgbouncer in transaction pooling
+  mode. Each transaction can run on a different server connection so nothing
+  can be set for the session. psycopg2 doesn't use server side prepared
+  statements so the statement timeout is the only thing this turns off; set it
+  on the database role instead.
+"""
+import logging
+import time
+
+from flask.ext.sqlalchemy import SQLAlchemy
+from sqlalchemy import event, exc, select
+from sqlalchemy.pool import QueuePool
+
+logger = logging.getLogger(__name__)
+
+
+class CheckoutStats(object):
+    """
+    How long checkouts from the pools in this process have waited for a connection
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.checkouts = 0
+        self.timeouts = 0
+        self.total_wait = 0.
+        self.max_wait = 0.
+        self.last_logged = time.time()
+
+    def record(self, wait, timed_out=False):
+        self.checkouts += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+        if timed_out:
+            self.timeouts += 1
+
+    def as_dict(self):
+        return {
+            'checkouts': self.checkouts,
+            'timeouts': self.timeouts,
+            'mean_wait': self.total_wait / self.checkouts if self.checkouts else 0.,
+            'max_wait': self.max_wait,
+        }
+
+
+checkout_stats = CheckoutStats()
+
+
+class TimedQueuePool(QueuePool):
+    """
+    QueuePool that records how long each checkout waits. That includes opening a
+    new connection when the pool doesn't have a free one.
+    """
+    slow_checkout = None
+    stats_interval = None
+
+    def _do_get(self):
+        start = time.time()
+        timed_out = False
+        try:
+            return super(TimedQueuePool, self)._do_get()
+        except exc.TimeoutError:
+            timed_out = True
+            raise
+        finally:
+            self._record_checkout(time.time() - start, timed_out)
+
+    def _record_checkout(self, wait, timed_out):
+        checkout_stats.record(wait, timed_out)
+        if timed_out or (self.slow_checkout is not None and wait > self.slow_checkout):
+            logger.warning('Waited %.3fs for a database connection. %s', wait, self.status())
+        if self.stats_interval and time.time() - checkout_stats.last_logged > self.stats_interval:
+            logger.info('Database connection checkouts: %s', checkout_stats.as_dict())
+            checkout_stats.reset()
+
+    def recreate(self):
+        pool = super(TimedQueuePool, self).recreate()
+        pool.slow_checkout = self.slow_checkout
+        pool.stats_interval = self.stats_interval
+        return pool
+
+
+class PooledSQLAlchemy(SQLAlchemy):
+    """
+    Flask-SQLAlchemy with the pool settings from this module for Postgres
+    """
+
+    def apply_driver_hacks(self, app, info, options):
+        super(PooledSQLAlchemy, self).apply_driver_hacks(app, info, options)
+        if not info.drivername.startswith('postgresql'):
+            return
+
+        options['poolclass'] = TimedQueuePool
+        statement_timeout = app.config.get('SQLALCHEMY_STATEMENT_TIMEOUT')
+        if statement_timeout and app.config.get('SQLALCHEMY_PGBOUNCER'):
+            logger.warning("SQLALCHEMY_STATEMENT_TIMEOUT isn't used with SQLALCHEMY_PGBOUNCER. "
+                           "Set statement_timeout on the database role instead.")
+        elif statement_timeout:
+            # sent when connecting so it doesn't need a query of its own
+            options.setdefault('connect_args', {})['options'] = '-c statement_timeout=%d' % statement_timeout
+
+
+def configure_pool(app, engine):
+    pool = engine.pool
+    if isinstance(pool, TimedQueuePool):
+        pool.slow_checkout = app.config.get('SQLALCHEMY_POOL_SLOW_CHECKOUT')
+        pool.stats_interval = app.config.get('SQLALCHEMY_POOL_STATS_INTERVAL')
+    if app.config.get('SQLALCHEMY_POOL_PRE_PING'):
+        event.listen(engine, 'engine_connect', _ping_connection)
+
+
+def _ping_connection(connection, branch):
+    if branch:
+        # the connection it's a branch of has been tested already
+        return
+
+    # don't let the ping close the connection if it's used for a single statement
+    should_close_with_result = connection.should_close_with_result
+    connection.should_close_with_result = False
+    try:
+        connection.scalar(select([1]))
+    except exc.DBAPIError as e:
+        if e.connection_invalidated:
+            # the pool has been emptied so this opens a new connection
+            connection.scalar(select([1]))
+        else:
+            raise
+    finally:
+        connection.should_close_with_result = should_close_with_result
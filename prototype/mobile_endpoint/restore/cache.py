@@ -0,0 +1,212 @@
+"""
+Cached restore payloads.
+
+Phones that time out or lose their connection part way through a restore retry it
+and without a cache every retry generates the whole payload again. Payloads are
+cached against:
+
+* the user and version for initial syncs (only if they were slow to generate)
+* the sync log and version for steady state syncs
+
+The store is picked with the ``RESTORE_CACHE`` setting. The default keeps track
+of the keys in Redis (so they expire) and the payloads as files in
+``RESTORE_CACHE_DIR``, which is kept under ``RESTORE_CACHE_MAX_SIZE`` by deleting
+the least recently used payloads.
+"""
+import hashlib
+import logging
+import os
+import shutil
+from uuid import uuid4
+
+from flask import current_app as app
+
+from mobile_endpoint.case.xml import LEGAL_VERSIONS
+from mobile_endpoint.extensions import redis_store
+
+logger = logging.getLogger(__name__)
+
+CACHE_REDIS = 'redis'
+
+# the default for RESTORE_CACHE_MAX_SIZE
+DEFAULT_MAX_SIZE = 1024 * 1024 * 1024  # 1GB
+
+
+def get_initial_cache_key(user_id, version):
+    return hashlib.md5('ota-restore-{user}-{version}'.format(
+        user=user_id,
+        version=version,
+    )).hexdigest()
+
+
+def get_sync_log_cache_key(sync_log_id, version):
+    return 'ota-restore-sync-{sync_log}-{version}'.format(
+        sync_log=sync_log_id,
+        version=version,
+    )
+
+
+class RestoreCache(object):
+    """
+    Base class for restore payload stores. Payloads are passed around as the
+    path to a file containing the whole payload.
+    """
+    enabled = True
+
+    def get(self, key):
+        """
+        :returns:   The path to the cached payload or None if there isn't one
+        """
+        raise NotImplementedError()
+
+    def set(self, key, payload_path, timeout):
+        """
+        Cache the payload in ``payload_path`` for ``timeout`` seconds. The file
+        itself belongs to the caller and can be deleted afterwards.
+        """
+        raise NotImplementedError()
+
+    def delete(self, keys):
+        raise NotImplementedError()
+
+
+class DummyRestoreCache(RestoreCache):
+    """
+    Doesn't cache anything.
+    """
+    enabled = False
+
+    def get(self, key):
+        return None
+
+    def set(self, key, payload_path, timeout):
+        pass
+
+    def delete(self, keys):
+        pass
+
+
+class RedisFileRestoreCache(RestoreCache):
+    """
+    Keeps the name of each payload file in Redis with an expiry and the payloads
+    themselves in ``directory``.
+    """
+    KEY_PREFIX = 'restore-payload-'
+    EXTENSION = '.xml'
+
+    def __init__(self, redis_client, directory, max_size):
+        self.redis = redis_client
+        self.directory = directory
+        self.max_size = max_size
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+
+    def _redis_key(self, key):
+        return '{}{}'.format(self.KEY_PREFIX, key)
+
+    def _get_path(self, filename):
+        return os.path.join(self.directory, filename)
+
+    def get(self, key):
+        filename = self.redis.get(self._redis_key(key))
+        if not filename:
+            return None
+
+        path = self._get_path(filename)
+        try:
+            # mark it as recently used so it's the last to be evicted
+            os.utime(path, None)
+        except OSError:
+            # already evicted
+            return None
+        return path
+
+    def set(self, key, payload_path, timeout):
+        filename = uuid4().hex + self.EXTENSION
+        path = self._get_path(filename)
+        try:
+            # the payload is usually on the same file system so avoid copying it
+            os.link(payload_path, path)
+        except (OSError, AttributeError):
+            shutil.copyfile(payload_path, path)
+
+        previous = self.redis.getset(self._redis_key(key), filename)
+        self.redis.expire(self._redis_key(key), timeout)
+        if previous:
+            self._remove(previous)
+        self.evict()
+
+    def delete(self, keys):
+        if not keys:
+            return
+        redis_keys = [self._redis_key(key) for key in keys]
+        filenames = self.redis.mget(redis_keys)
+        self.redis.delete(*redis_keys)
+        for filename in filenames:
+            if filename:
+                self._remove(filename)
+
+    def _remove(self, filename):
+        try:
+            os.remove(self._get_path(filename))
+        except OSError:
+            pass
+
+    def evict(self):
+        evict_payloads(self.directory, self.max_size)
+
+
+def evict_payloads(directory, max_size):
+    """
+    Delete the least recently used files in the directory until the total size
+    of what's left is no more than ``max_size`` bytes.
+
+    :returns:   list of the names of the files that were deleted
+    """
+    payloads = []
+    for filename in os.listdir(directory):
+        try:
+            stat = os.stat(os.path.join(directory, filename))
+        except OSError:
+            continue
+        payloads.append((stat.st_mtime, stat.st_size, filename))
+
+    total_size = sum(size for _, size, _ in payloads)
+    evicted = []
+    for _, size, filename in sorted(payloads):
+        if total_size <= max_size:
+            break
+        try:
+            os.remove(os.path.join(directory, filename))
+        except OSError:
+            pass
+        total_size -= size
+        evicted.append(filename)
+
+    if evicted:
+        logger.info('Evicted %s cached restore payloads from %s', len(evicted), directory)
+    return evicted
+
+
+def get_restore_cache():
+    cache_type = app.config.get('RESTORE_CACHE')
+    if cache_type == CACHE_REDIS:
+        return RedisFileRestoreCache(
+            redis_store,
+            app.config.get('RESTORE_CACHE_DIR') or os.path.join(app.config['RESTORE_DIR'], 'cache'),
+            app.config.get('RESTORE_CACHE_MAX_SIZE', DEFAULT_MAX_SIZE),
+        )
+    elif not cache_type:
+        return DummyRestoreCache()
+    raise ValueError('Unknown restore cache: {}'.format(cache_type))
+
+
+def invalidate_cached_payloads(sync_log_id, user_id):
+    """
+    Invalidate the payloads that were cached for a sync log and any initial sync
+    payloads for its user, in every version.
+    """
+    get_restore_cache().delete(
+        [get_sync_log_cache_key(sync_log_id, version) for version in LEGAL_VERSIONS] +
+        [get_initial_cache_key(user_id, version) for version in LEGAL_VERSIONS]
+    )
@@ -1,5 +1,6 @@
 from collections import namedtuple
 from datetime import datetime
+from flask import current_app
 from mobile_endpoint.exceptions import IllegalCaseId
 from mobile_endpoint.models import OwnershipCleanlinessFlag
 
@@ -30,6 +31,14 @@ def should_create_flags_on_submission(domain):
     """
     return True
 
+
+def should_defer_dirtiness_checks(dao):
+    """
+    Whether child case dirtiness checks are queued by submissions instead of done
+    while they're processed (see the DEFERRED_DIRTINESS_CHECKS setting).
+    """
+    return bool(current_app.config.get('DEFERRED_DIRTINESS_CHECKS')) and dao.queues_dirtiness_checks
+
 #
 # def set_cleanliness_flags_for_domain(domain, force_full=False):
 #     """
@@ -122,6 +131,10 @@ def get_case_footprint_info(dao, domain, owner_id):
       2) doesn't return full blown case objects but just IDs
       3) differentiates between the base set and the complete list
     """
+    footprint_info = dao.get_case_footprint_info(domain, owner_id)
+    if footprint_info is not None:
+        return footprint_info
+
     all_case_ids = set()
     # get base set of cases (anything open with this owner id)
     open_case_ids = dao.get_open_case_ids(domain, owner_id)
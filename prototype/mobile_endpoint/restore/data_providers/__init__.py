@@ -19,6 +19,7 @@ def get_long_running_providers():
     """
     Get restore providers that are expected to run for a long time.
 
-    These have different API semantics to be able to support asynchronous calls in hte future.
+    These have different API semantics so that they can be run concurrently with the other
+    providers (see the CONCURRENT_RESTORE_PROVIDERS setting).
     """
     return [CasePayloadProvider()]
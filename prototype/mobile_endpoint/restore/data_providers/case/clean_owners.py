@@ -1,13 +1,15 @@
 from collections import defaultdict
 from copy import copy
 from functools import partial
+from itertools import ifilter
 from datetime import datetime
-from mobile_endpoint.case.models import CommCareCase
-from mobile_endpoint.models import OwnershipCleanlinessFlag
-from mobile_endpoint.restore.cleanliness import get_case_footprint_info
-from mobile_endpoint.restore.data_providers.case.load_testing import append_update_to_response
+from flask import current_app as app
+from mobile_endpoint.models import OwnershipCleanlinessFlag, PendingDirtinessCheck
+from mobile_endpoint.restore.cleanliness import get_case_footprint_info, should_defer_dirtiness_checks
+from mobile_endpoint.restore.data_providers.case.load_testing import get_update_elements
 from mobile_endpoint.restore.data_providers.case.utils import get_case_sync_updates, CaseStub
 from mobile_endpoint.synclog.models import SimplifiedSyncLog, LOG_FORMAT_SIMPLIFIED, IndexTree
+from mobile_endpoint.utils import map_in_app_context
 
 
 def get_owner_id(case):
@@ -41,6 +43,11 @@ class CleanOwnerCaseSyncOperation(object):
                     OwnershipCleanlinessFlag.owner_id.in_(self.restore_state.owner_ids),
                 )
             )
+            if should_defer_dirtiness_checks(self.dao):
+                # the checks still to be done could make these owners dirty
+                for owner_id in PendingDirtinessCheck.get_pending_owner_ids(
+                        self.restore_state.domain, self.restore_state.owner_ids):
+                    self._cleanliness_flags[owner_id] = False
         return self._cleanliness_flags
 
     def is_clean(self, owner_id):
@@ -48,9 +55,29 @@ class CleanOwnerCaseSyncOperation(object):
 
     def get_payload(self):
         response = self.restore_state.restore_class()
-        case_ids_to_sync = set()
-        for owner_id in self.restore_state.owner_ids:
-            case_ids_to_sync = case_ids_to_sync | set(self.get_case_ids_for_owner(owner_id))
+        if self.restore_state.params.include_item_count:
+            # the count goes at the start of the restore so work out which cases are
+            # syncing first. Their XML is still only generated as it's sent.
+            response.extend(CaseElements(list(self.get_case_sync_updates()), self.restore_state))
+        else:
+            response.extend(self.get_elements())
+        return response
+
+    def get_elements(self):
+        """
+        Yields the case elements for the restore. The sync log is only updated
+        once all of them have been generated.
+        """
+        for update in self.get_case_sync_updates():
+            for element in get_update_elements(update, self.restore_state):
+                yield element
+
+    def get_case_sync_updates(self):
+        """
+        Yields a CaseSyncUpdate for each case that needs to sync. The sync log
+        is only updated once all of them have been generated.
+        """
+        case_ids_to_sync = self.get_case_ids_for_owners(self.restore_state.owner_ids)
 
         if (not self.restore_state.is_initial and
                 any([not self.is_clean(owner_id) for owner_id in self.restore_state.owner_ids])):
@@ -69,16 +96,17 @@ class CleanOwnerCaseSyncOperation(object):
         all_dependencies_syncing = set()
         while case_ids_to_sync:
             ids = pop_ids(case_ids_to_sync, chunk_size)
-            case_batch = filter(
+            # cases are handled one at a time as they're read so only the ids are kept around
+            case_batch = ifilter(
                 partial(case_needs_to_sync, last_sync_log=self.restore_state.last_sync_log),
-                self.dao.get_cases(ids)
+                self.dao.iter_compact_cases(ids)
             )
             updates = get_case_sync_updates(
                 self.restore_state.domain, case_batch, self.restore_state.last_sync_log
             )
             for update in updates:
                 case = update.case
-                append_update_to_response(response, update, self.restore_state)
+                yield update
 
                 # update the indices in the new sync log
                 if case.indices:
@@ -109,8 +137,10 @@ class CleanOwnerCaseSyncOperation(object):
         self.restore_state.current_sync_log.log_format = LOG_FORMAT_SIMPLIFIED
         index_tree = IndexTree(indices=all_indices)
         case_ids_on_phone = all_syncing
+        previous_log = None
         primary_cases_syncing = all_syncing - all_dependencies_syncing
         if not self.restore_state.is_initial:
+            previous_log = self.restore_state.last_sync_log
             case_ids_on_phone = case_ids_on_phone | self.restore_state.last_sync_log.case_ids_on_phone
             # subtract primary cases from dependencies since they must be newly primary
             all_dependencies_syncing = all_dependencies_syncing | (
@@ -119,25 +149,58 @@ class CleanOwnerCaseSyncOperation(object):
             )
             index_tree = self.restore_state.last_sync_log.index_tree.apply_updates(index_tree)
 
-        self.restore_state.current_sync_log.case_ids_on_phone = case_ids_on_phone
+        self.restore_state.current_sync_log.set_case_ids_on_phone(case_ids_on_phone, previous_log)
         self.restore_state.current_sync_log.dependent_case_ids_on_phone = all_dependencies_syncing
         self.restore_state.current_sync_log.index_tree = index_tree
 
-        return response
-
-    def get_case_ids_for_owner(self, owner_id):
-        if self.is_clean(owner_id):
+    def get_case_ids_for_owners(self, owner_ids):
+        """
+        The base set of case ids to sync for the owners. The clean owners' cases are
+        fetched in a single query and the dirty owners' footprints are worked out
+        concurrently (see the RESTORE_FOOTPRINT_WORKERS setting).
+        """
+        domain = self.restore_state.domain
+        clean_owner_ids = [owner_id for owner_id in owner_ids if self.is_clean(owner_id)]
+        dirty_owner_ids = [owner_id for owner_id in owner_ids if not self.is_clean(owner_id)]
+
+        case_ids = set()
+        if clean_owner_ids:
             if self.restore_state.is_initial:
                 # for a clean owner's initial sync the base set is just the open ids
-                return set(self.dao.get_open_case_ids(self.restore_state.domain, owner_id))
+                case_ids.update(self.dao.get_open_case_ids_for_owners(domain, clean_owner_ids))
             else:
                 # for a clean owner's steady state sync, the base set is anything modified since last sync
-                return set(self.dao.get_case_ids_modified_with_owner_since(
-                    self.restore_state.domain, owner_id, self.restore_state.last_sync_log.date
+                case_ids.update(self.dao.get_case_ids_modified_with_owners_since(
+                    domain, clean_owner_ids, self.restore_state.last_sync_log.date
                 ))
-        else:
-            # right now just return the whole footprint and do any filtering later
-            return get_case_footprint_info(self.dao, self.restore_state.domain, owner_id).all_ids
+
+        # for dirty owners just use the whole footprint and do any filtering later
+        footprints = map_in_app_context(
+            partial(get_case_footprint_info, self.dao, domain),
+            dirty_owner_ids,
+            app.config.get('RESTORE_FOOTPRINT_WORKERS', 1),
+        )
+        for footprint_info in footprints:
+            case_ids.update(footprint_info.all_ids)
+        return case_ids
+
+
+class CaseElements(object):
+    """
+    The case elements for a list of CaseSyncUpdates. The number of elements is
+    known up front but the XML is only generated as they're iterated over.
+    """
+    def __init__(self, updates, restore_state):
+        self.updates = updates
+        self.restore_state = restore_state
+
+    def __len__(self):
+        return len(self.updates) * self.restore_state.loadtest_factor
+
+    def __iter__(self):
+        for update in self.updates:
+            for element in get_update_elements(update, self.restore_state):
+                yield element
 
 
 def _is_live(case, restore_state):
@@ -1,5 +1,7 @@
 from copy import deepcopy
+from flask import current_app as app
 from mobile_endpoint.case.models import CommCareCase
+from mobile_endpoint.case.xml.serializer import get_case_xml_string, get_case_xml_from_fragments
 from mobile_endpoint.restore.data_providers.case.utils import CaseSyncUpdate
 from mobile_endpoint.restore.xml import get_case_element
 
@@ -20,7 +22,7 @@ def transform_loadtest_update(update, factor):
     """
     def _map_id(id, count):
         return '{}-{}'.format(id, count)
-    case = CommCareCase.wrap(deepcopy(update.case._doc))
+    case = CommCareCase.wrap(deepcopy(update.case.to_json()))
     case.id = _map_id(case.id, factor)
     for index in case.indices:
         index.referenced_id = _map_id(index.referenced_id, factor)
@@ -33,11 +35,29 @@ def append_update_to_response(response, update, restore_state):
     Adds the XML from the case_update to the restore response.
     If factor is > 1 it will append that many updates to the response for load testing purposes.
     """
+    for element in get_update_elements(update, restore_state):
+        response.append(element)
+
+
+def get_update_elements(update, restore_state):
+    """
+    Yields the XML for the case_update, repeated ``loadtest_factor`` times.
+
+    With the FAST_CASE_XML setting the XML is written straight to a string
+    instead of being built up as an ElementTree. Cases saved with the
+    STORED_CASE_XML setting on already have their XML so that's used instead.
+    """
+    get_xml = get_case_xml_string if app.config.get('FAST_CASE_XML') else get_case_element
     current_count = 0
     original_update = update
     while current_count < restore_state.loadtest_factor:
-        element = get_case_element(update.case, update.required_updates, restore_state.version)
-        response.append(element)
+        stored_xml = get_case_xml_from_fragments(
+            getattr(update.case, 'xml_fragments', None), update.required_updates, restore_state.version
+        )
+        if stored_xml is not None:
+            yield stored_xml
+        else:
+            yield get_xml(update.case, update.required_updates, restore_state.version)
         current_count += 1
         if current_count < restore_state.loadtest_factor:
             update = transform_loadtest_update(original_update, current_count)
@@ -1,15 +1,18 @@
 from copy import copy
+from functools import partial
 from io import FileIO
 import os
 from uuid import uuid4
 import shutil
 import hashlib
 import logging
+import sys
+import threading
 from datetime import datetime, timedelta
 from wsgiref.util import FileWrapper
 from mobile_endpoint.case.xml import V1, check_version
 from mobile_endpoint.exceptions import NotFound
-from mobile_endpoint.extensions import redis_store
+from mobile_endpoint.restore.cache import get_restore_cache, get_initial_cache_key, get_sync_log_cache_key
 from mobile_endpoint.restore.data_providers import get_restore_providers, get_long_running_providers
 from mobile_endpoint.restore.data_providers.case.load_testing import get_loadtest_factor
 from mobile_endpoint.restore.data_providers.exceptions import BadStateException, MissingSyncLog, InvalidSyncLogException, \
@@ -18,7 +21,7 @@ from mobile_endpoint.synclog.checksum import CaseStateHash
 from mobile_endpoint.synclog.models import SimplifiedSyncLog, LOG_FORMAT_SIMPLIFIED
 from mobile_endpoint.views.response import ResponseNature, get_simple_response_xml
 import xml
-from flask import Response
+from flask import Response, stream_with_context
 from flask import current_app as app
 
 logger = logging.getLogger(__name__)
@@ -31,6 +34,10 @@ INITIAL_SYNC_CACHE_TIMEOUT = 60 * 60  # 1 hour
 # for rapid iteration on fixtures/cases/etc.
 INITIAL_SYNC_CACHE_THRESHOLD = 60  # 1 minute
 
+# how long a steady state payload sits around for (in seconds). These are also
+# invalidated as soon as the phone submits a form that changes its cases.
+SYNC_CACHE_TIMEOUT = 24 * 60 * 60  # 1 day
+
 SYSTEM_PREFIX = "commcare"
 
 
@@ -93,12 +100,34 @@ class RestoreResponse(object):
         for element in iterable:
             self.append(element)
 
+    def get_start_tag(self):
+        # Add 1 to num_items to account for message element
+        items = self.items_template.format(self.num_items + 1) if self.items else ''
+        return self.start_tag_template.format(
+            items=items,
+            username=self.username,
+            nature=ResponseNature.OTA_RESTORE_SUCCESS
+        )
+
     def finalize(self):
         raise NotImplemented()
 
+    def when_complete(self, callback, *args):
+        """
+        Call the callback once the whole payload has been generated
+        """
+        raise NotImplemented()
+
     def get_cache_payload(self, full=False):
         raise NotImplemented()
 
+    def keep_cache_copy(self):
+        """
+        Make sure there's a copy of the payload on disk once it's complete so that
+        it can be cached
+        """
+        raise NotImplemented()
+
     def as_string(self):
         raise NotImplemented()
 
@@ -144,13 +173,7 @@ class FileRestoreResponse(RestoreResponse):
         Creates the final file with start and ending tag
         """
         with open(self.get_filename(), 'w') as response:
-            # Add 1 to num_items to account for message element
-            items = self.items_template.format(self.num_items + 1) if self.items else ''
-            response.write(self.start_tag_template.format(
-                items=items,
-                username=self.username,
-                nature=ResponseNature.OTA_RESTORE_SUCCESS
-            ))
+            response.write(self.get_start_tag())
 
             self.response_body.seek(0)
             shutil.copyfileobj(self.response_body, response)
@@ -165,6 +188,10 @@ class FileRestoreResponse(RestoreResponse):
             'data': self.get_filename() if not full else open(self.get_filename(), 'r')
         }
 
+    def keep_cache_copy(self):
+        # the payload is always written to disk
+        pass
+
     def as_string(self):
         with open(self.get_filename(), 'r') as f:
             return f.read()
@@ -173,6 +200,129 @@ class FileRestoreResponse(RestoreResponse):
         headers = {'Content-Length': os.path.getsize(self.get_filename())}
         return stream_response(open(self.get_filename(), 'r'), headers)
 
+    def when_complete(self, callback, *args):
+        # everything is written by the time the response is finalized
+        callback(*args)
+
+
+class StreamingRestoreResponse(RestoreResponse):
+    """
+    Generates the restore XML while it's being sent instead of writing it to disk first.
+
+    Elements and iterables of elements are only held on to when they're added and are
+    turned into XML as the response is iterated over, so providers that yield their
+    elements lazily only do their work while the response is being sent. Anything that
+    needs the whole payload to have been generated (e.g. saving the sync log) has to be
+    registered with ``when_complete``.
+
+    The item count goes in the opening tag so when it's requested it's worked out from
+    the length of each part before anything is sent. Providers that know how many elements
+    they'll produce without generating them should add a sized iterable (see
+    ``CaseElements``), anything else gets generated into a list first.
+
+    Nothing is written to disk unless ``keep_cache_copy`` is called, in which case the
+    payload is also written to a file as it's sent so that it can be cached.
+    """
+
+    # send the XML in chunks of about this many bytes
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, username=None, items=False):
+        super(StreamingRestoreResponse, self).__init__(username, items)
+        self.parts = []
+        self.callbacks = []
+        self.filename = None
+
+    def close(self):
+        pass
+
+    def append(self, xml_element):
+        self.parts.append((xml_element,))
+
+    def extend(self, iterable):
+        self.parts.append(iterable)
+
+    def __add__(self, other):
+        if not isinstance(other, StreamingRestoreResponse):
+            raise NotImplemented()
+
+        response = StreamingRestoreResponse(self.username, self.items)
+        response.parts = self.parts + other.parts
+        response.callbacks = self.callbacks + other.callbacks
+        response.filename = self.filename or other.filename
+        return response
+
+    def finalize(self):
+        self.finalized = True
+
+    def when_complete(self, callback, *args):
+        self.callbacks.append(partial(callback, *args))
+
+    def _iter_body(self):
+        chunk = []
+        chunk_size = 0
+        for part in self.parts:
+            for xml_element in part:
+                if not isinstance(xml_element, basestring):
+                    xml_element = xml.tostring(xml_element)
+                chunk.append(xml_element)
+                chunk_size += len(xml_element)
+                if chunk_size >= self.CHUNK_SIZE:
+                    yield ''.join(chunk)
+                    chunk = []
+                    chunk_size = 0
+        if chunk:
+            yield ''.join(chunk)
+
+    def _complete(self):
+        for callback in self.callbacks:
+            callback()
+
+    def _count_items(self):
+        self.parts = [part if hasattr(part, '__len__') else list(part) for part in self.parts]
+        self.num_items = sum(len(part) for part in self.parts)
+
+    def __iter__(self):
+        if self.items:
+            self._count_items()
+        cache_copy = FileIO(self.filename, 'w') if self.filename else None
+        try:
+            yield self._copy_chunk(self.get_start_tag(), cache_copy)
+            for chunk in self._iter_body():
+                yield self._copy_chunk(chunk, cache_copy)
+            if cache_copy:
+                cache_copy.write(self.closing_tag)
+                cache_copy.close()
+            self._complete()
+            # only finish the XML once the payload has been completed
+            yield self.closing_tag
+        finally:
+            if cache_copy:
+                # anything that wants to keep it has done so by now
+                cache_copy.close()
+                os.remove(self.filename)
+
+    @staticmethod
+    def _copy_chunk(chunk, cache_copy):
+        if cache_copy:
+            cache_copy.write(chunk)
+        return chunk
+
+    def get_cache_payload(self, full=False):
+        return {
+            'data': self.filename if not full else open(self.filename, 'r')
+        }
+
+    def keep_cache_copy(self):
+        self.filename = os.path.join(app.config['RESTORE_DIR'], '{}.xml'.format(uuid4().hex))
+
+    def as_string(self):
+        return ''.join(self)
+
+    def get_http_response(self):
+        # keep the request context around since the payload is generated while it's sent
+        return Response(stream_with_context(iter(self)), mimetype="text/xml")
+
 
 class CachedResponse(object):
     def __init__(self, payload):
@@ -227,8 +377,9 @@ class RestoreParams(object):
 
 class RestoreCacheSettings(object):
     """
-    Settings related to restore caching. These only apply if doing an initial restore and
-    are not used if `RestoreParams.sync_log_id` is set.
+    Settings related to restore caching. `force_cache` and `cache_timeout` only apply if doing
+    an initial restore and are not used if `RestoreParams.sync_log_id` is set. Steady state
+    restores are always cached.
 
     :param force_cache:     Set to `True` to force the response to be cached.
     :param cache_timeout:   Override the default cache timeout of 1 hour.
@@ -248,8 +399,6 @@ class RestoreState(object):
     This allows the providers to set values on the state, for either logging or performance
     reasons.
     """
-    restore_class = FileRestoreResponse
-
     def __init__(self, project, user, params, dao):
         self.project = project
         self.domain = project.name if project else ''
@@ -263,6 +412,16 @@ class RestoreState(object):
         self.current_sync_log = None
         self.dao = dao
 
+    def log_provider_duration(self, provider, duration):
+        """
+        Record how long a data provider took in ``provider_log['durations']``.
+
+        Providers that generate their elements lazily (e.g. for a streaming restore)
+        only get the time taken to set them up.
+        """
+        durations = self.provider_log.setdefault('durations', {})
+        durations[provider.__class__.__name__] = duration.total_seconds()
+
     def validate_state(self):
         check_version(self.params.version)
         if self.last_sync_log:
@@ -300,6 +459,10 @@ class RestoreState(object):
         else:
             return None
 
+    @property
+    def restore_class(self):
+        return StreamingRestoreResponse if app.config.get('STREAMING_RESTORE') else FileRestoreResponse
+
     @property
     def is_initial(self):
         return self.last_sync_log is None
@@ -347,7 +510,7 @@ class RestoreState(object):
     def finish_sync(self):
         self.duration = datetime.utcnow() - self.start_time
         self.current_sync_log.duration = self.duration.seconds
-        # self.current_sync_log.save()
+        self.dao.commit_restore(self)
 
     def create_sync_log(self):
         previous_log_id = None if self.is_initial else self.last_sync_log.id
@@ -375,6 +538,58 @@ class RestoreState(object):
         return get_loadtest_factor(self.domain, self.user)
 
 
+class SerialProvider(object):
+    """
+    Gets a long running provider's response when it's asked for.
+    """
+    def __init__(self, provider, restore_state):
+        self.provider = provider
+        self.restore_state = restore_state
+        self.duration = None
+
+    def get_response(self):
+        start = datetime.utcnow()
+        response = self.provider.get_response(self.restore_state)
+        self.duration = datetime.utcnow() - start
+        return response
+
+
+class ProviderThread(threading.Thread):
+    """
+    Gets a long running provider's response in its own thread, which is a greenlet
+    when gevent has patched the server (see server.py).
+
+    The thread gets its own app context, and so its own database session.
+    """
+    def __init__(self, app, provider, restore_state):
+        super(ProviderThread, self).__init__(name='restore-{}'.format(provider.__class__.__name__))
+        self.daemon = True
+        self.app = app
+        self.provider = provider
+        self.restore_state = restore_state
+        self.duration = None
+        self._response = None
+        self._exc_info = None
+
+    def run(self):
+        start = datetime.utcnow()
+        with self.app.app_context():
+            try:
+                self._response = self.provider.get_response(self.restore_state)
+            except Exception:
+                self._exc_info = sys.exc_info()
+        self.duration = datetime.utcnow() - start
+
+    def get_response(self):
+        """
+        Wait for the provider to finish and return its response, raising anything it raised.
+        """
+        self.join()
+        if self._exc_info:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._response
+
+
 class RestoreConfig(object):
     """
     A collection of attributes associated with an OTA restore
@@ -399,7 +614,7 @@ class RestoreConfig(object):
         self.cache_timeout = self.cache_settings.cache_timeout
         self.overwrite_cache = self.cache_settings.overwrite_cache
 
-        self.cache = redis_store
+        self.cache = get_restore_cache()
 
     @property
     # @memoized
@@ -431,23 +646,41 @@ class RestoreConfig(object):
 
         with self.restore_state.restore_class(
                 self.user.username, items=self.params.include_item_count) as response:
+            # start the long running providers first so they can run while the others are added
+            long_running_providers = get_long_running_providers()
+            if app.config.get('CONCURRENT_RESTORE_PROVIDERS'):
+                pending = [
+                    ProviderThread(app._get_current_object(), provider, self.restore_state)
+                    for provider in long_running_providers
+                ]
+                for thread in pending:
+                    thread.start()
+            else:
+                pending = [SerialProvider(provider, self.restore_state) for provider in long_running_providers]
+
             normal_providers = get_restore_providers()
             for provider in normal_providers:
-                for element in provider.get_elements(self.restore_state):
-                    response.append(element)
-
-            # in the future these will be done asynchronously so keep them separate
-            long_running_providers = get_long_running_providers()
-            for provider in long_running_providers:
-                partial_response = provider.get_response(self.restore_state)
+                start = datetime.utcnow()
+                response.extend(provider.get_elements(self.restore_state))
+                self.restore_state.log_provider_duration(provider, datetime.utcnow() - start)
+
+            # always merged in the order the providers are listed, whichever finishes first
+            for provider_run in pending:
+                partial_response = provider_run.get_response()
+                self.restore_state.log_provider_duration(provider_run.provider, provider_run.duration)
                 response = response + partial_response
                 partial_response.close()
 
             response.finalize()
 
+        if self.cache.enabled:
+            response.keep_cache_copy()
+        response.when_complete(self._finish_sync, response)
+        return response
+
+    def _finish_sync(self, response):
         self.restore_state.finish_sync()
         self.set_cached_payload_if_necessary(response, self.restore_state.duration)
-        return response
 
     def get_response(self):
         try:
@@ -464,44 +697,28 @@ class RestoreConfig(object):
                                 status=412)  # precondition failed
 
     def _initial_cache_key(self):
-        return hashlib.md5('ota-restore-{user}-{version}'.format(
-            user=self.user.user_id,
-            version=self.version,
-        )).hexdigest()
+        return get_initial_cache_key(self.user.user_id, self.version)
+
+    def _cache_key(self):
+        if self.params.sync_log_id:
+            return get_sync_log_cache_key(self.params.sync_log_id, self.version)
+        return self._initial_cache_key()
 
     def get_cached_payload(self):
-        return CachedResponse(None)
-        # if self.overwrite_cache:
-        #     return CachedResponse(None)
+        if self.overwrite_cache:
+            return CachedResponse(None)
 
-        # if self.sync_log:
-        #     payload = self.sync_log.get_cached_payload(self.version, stream=True)
-        # else:
-        #     payload = self.cache.get(self._initial_cache_key())
-        #
-        # return CachedResponse(payload)
+        payload_path = self.cache.get(self._cache_key())
+        return CachedResponse({'data': payload_path} if payload_path else None)
 
     def set_cached_payload_if_necessary(self, resp, duration):
-        # cache_payload = resp.get_cache_payload(bool(self.sync_log))
-        # if self.sync_log:
-        #     # if there is a sync token, always cache
-        #     try:
-        #         data = cache_payload['data']
-        #         self.sync_log.set_cached_payload(data, self.version)
-        #         try:
-        #             data.close()
-        #         except AttributeError:
-        #             pass
-        #     except ResourceConflict:
-        #         # if one sync takes a long time and another one updates the sync log
-        #         # this can fail. in this event, don't fail to respond, since it's just
-        #         # a caching optimization
-        #         pass
-        # else:
-        #     # on initial sync, only cache if the duration was longer than the threshold
-        #     if self.force_cache or duration > timedelta(seconds=INITIAL_SYNC_CACHE_THRESHOLD):
-        #         self.cache.set(self._initial_cache_key(), cache_payload, self.cache_timeout)
-        pass
+        payload_path = resp.get_cache_payload()['data']
+        if self.params.sync_log_id:
+            # if there is a sync token, always cache
+            self.cache.set(self._cache_key(), payload_path, SYNC_CACHE_TIMEOUT)
+        elif self.force_cache or duration > timedelta(seconds=INITIAL_SYNC_CACHE_THRESHOLD):
+            # on initial sync, only cache if the duration was longer than the threshold
+            self.cache.set(self._cache_key(), payload_path, self.cache_timeout)
 
 
 class User(object):
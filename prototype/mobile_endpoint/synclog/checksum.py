@@ -1,6 +1,5 @@
-import hashlib
+from hashlib import md5
 import binascii
-from copy import copy
 
 
 EMPTY_HASH = ""
@@ -29,6 +28,9 @@ class CaseStateHash(object):
 
 class Checksum(object):
     """
+    The XOR of the md5 of each id. The md5s are kept as a single 128 bit integer
+    so adding (or removing) an id is one XOR no matter how many ids there are.
+
     >>> Checksum(['abc123', '123abc']).hexdigest()
     '409c5c597fa2c2a693b769f0d2ad432b'
 
@@ -49,34 +51,51 @@ class Checksum(object):
     >>> c1.hexdigest() == Checksum(['abc123', '123abc', 'def']).hexdigest()
     True
 
+    >>> c1.remove('def')
+    >>> c1.hexdigest()
+    '409c5c597fa2c2a693b769f0d2ad432b'
+
     >>> Checksum().hexdigest()
     ''
 
     """
 
     def __init__(self, initial_list=None, initial_checksum=None):
-        self._list = map(Checksum.hash, initial_list) if initial_list else []
+        self._value = 0
+        # the digest of nothing is EMPTY_HASH rather than all zeros
+        self._empty = True
+        if initial_list:
+            self.update(initial_list)
         if initial_checksum:
-            self._list.append(bytearray(binascii.unhexlify(initial_checksum)))
+            # str() since postgres gives back the hash as a buffer
+            self._value ^= int(str(initial_checksum), 16)
+            self._empty = False
 
     def add(self, id):
-        self._list.append(Checksum.hash(id))
+        self._value ^= Checksum.hash(id)
+        self._empty = False
+
+    def remove(self, id):
+        """
+        Take back out an id that was added. XORing its hash in again does that.
+        """
+        self._value ^= Checksum.hash(id)
+
+    def update(self, ids):
+        value = self._value
+        for id in ids:
+            value ^= int(md5(id).hexdigest(), 16)
+            self._empty = False
+        self._value = value
 
     @classmethod
     def hash(cls, line):
-        return bytearray([ord(b) for b in hashlib.md5(line).digest()])
-
-    @classmethod
-    def xor(cls, bytes1, bytes2):
-        assert(len(bytes1) == len(bytes2))
-        return bytearray([b1 ^ b2 for (b1, b2) in zip(bytes1, bytes2)])
+        return int(md5(line).hexdigest(), 16)
 
     def digest(self):
-        if not self._list:
-            return EMPTY_HASH
-        x = reduce(Checksum.xor, self._list)
-        return str(x)
+        return binascii.unhexlify(self.hexdigest())
 
     def hexdigest(self):
-        x = binascii.hexlify(self.digest())
-        return x
+        if self._empty:
+            return EMPTY_HASH
+        return '%032x' % self._value
@@ -6,7 +6,8 @@ from jsonobject.properties import DateTimeProperty, StringProperty, IntegerPrope
     SetProperty, ObjectProperty
 import logging
 from mobile_endpoint.case import const
-from mobile_endpoint.synclog.checksum import CaseStateHash, Checksum
+from mobile_endpoint.restore.cache import get_restore_cache, get_sync_log_cache_key, invalidate_cached_payloads
+from mobile_endpoint.synclog.checksum import CaseStateHash, Checksum, EMPTY_HASH
 
 logger = logging.getLogger(__name__)
 
@@ -71,11 +72,11 @@ class AbstractSyncLog(JsonObject):
         """
         raise NotImplementedError()
 
-    def get_payload_attachment_name(self, version):
-        return 'restore_payload_{version}.xml'.format(version=version)
-
     def has_cached_payload(self, version):
-        return self.get_payload_attachment_name(version) in self._doc.get('_attachments', {})
+        return get_restore_cache().get(get_sync_log_cache_key(self.id, version)) is not None
+
+    def invalidate_cached_payloads(self):
+        invalidate_cached_payloads(self.id, self.user_id)
 
     # anything prefixed with 'tests_only' is only used in tests
     def tests_only_get_cases_on_phone(self):
@@ -98,40 +99,78 @@ class IndexTree(JsonObject):
     def __repr__(self):
         return json.dumps(self.indices, indent=2)
 
+    @property
+    def reverse_indices(self):
+        """
+        A map of each case to the set of cases that index it. It's built the first
+        time it's needed and then kept up to date as indices are set and removed.
+        """
+        if getattr(self, '_reverse_indices', None) is None:
+            self._reverse_indices = _reverse_index_map(self.indices)
+        return self._reverse_indices
+
+    def _add_reverse_index(self, from_case_id, to_case_id):
+        if getattr(self, '_reverse_indices', None) is not None:
+            self._reverse_indices.setdefault(to_case_id, set()).add(from_case_id)
+
+    def _remove_reverse_index(self, from_case_id, to_case_id):
+        if getattr(self, '_reverse_indices', None) is None:
+            return
+        if to_case_id in self.indices.get(from_case_id, {}).values():
+            # it's still referenced by another of the case's indices
+            return
+        dependent_cases = self._reverse_indices.get(to_case_id)
+        if dependent_cases is not None:
+            dependent_cases.discard(from_case_id)
+            if not dependent_cases:
+                del self._reverse_indices[to_case_id]
+
     def get_cases_that_directly_depend_on_case(self, case_id, cached_map=None):
-        cached_map = cached_map or _reverse_index_map(self.indices)
+        cached_map = cached_map or self.reverse_indices
         return cached_map.get(case_id, [])
 
     def get_all_cases_that_depend_on_case(self, case_id, cached_map=None):
         """
-        Recursively builds a tree of all cases that depend on this case and returns
-        a flat set of case ids.
+        Follows the reverse indices from this case to build a flat set of the case
+        and all the cases that depend on it, directly or indirectly.
 
-        Allows passing in a cached map of reverse index references if you know you are going
-        to call it more than once in a row to avoid rebuilding that.
+        A reverse index map can still be passed in to use instead of ``reverse_indices``.
         """
-        def _recursive_call(case_id, all_cases, cached_map):
-            all_cases.add(case_id)
-            for dependent_case in self.get_cases_that_directly_depend_on_case(case_id, cached_map=cached_map):
+        cached_map = cached_map or self.reverse_indices
+        all_cases = {case_id}
+        to_check = [case_id]
+        while to_check:
+            for dependent_case in cached_map.get(to_check.pop(), []):
                 if dependent_case not in all_cases:
                     all_cases.add(dependent_case)
-                    _recursive_call(dependent_case, all_cases, cached_map)
-
-        all_cases = set()
-        cached_map = cached_map or _reverse_index_map(self.indices)
-        _recursive_call(case_id, all_cases, cached_map)
+                    to_check.append(dependent_case)
         return all_cases
 
     def delete_index(self, from_case_id, index_name):
         prior_ids = self.indices.pop(from_case_id, {})
-        prior_ids.pop(index_name, None)
+        to_case_id = prior_ids.pop(index_name, None)
         if prior_ids:
             self.indices[from_case_id] = prior_ids
+        if to_case_id is not None:
+            self._remove_reverse_index(from_case_id, to_case_id)
 
     def set_index(self, from_case_id, index_name, to_case_id):
         prior_ids = self.indices.get(from_case_id, {})
+        old_case_id = prior_ids.get(index_name)
         prior_ids[index_name] = to_case_id
         self.indices[from_case_id] = prior_ids
+        if old_case_id is not None and old_case_id != to_case_id:
+            self._remove_reverse_index(from_case_id, old_case_id)
+        self._add_reverse_index(from_case_id, to_case_id)
+
+    def remove_case(self, case_id):
+        """
+        Remove all of a case's indices and return them
+        """
+        indices = self.indices.pop(case_id, {})
+        for to_case_id in indices.values():
+            self._remove_reverse_index(case_id, to_case_id)
+        return indices
 
     def apply_updates(self, other_tree):
         """
@@ -185,14 +224,77 @@ class SimplifiedSyncLog(AbstractSyncLog):
     def get_footprint_of_cases_on_phone(self):
         return list(self.case_ids_on_phone)
 
+    def _get_checksum(self):
+        """
+        The checksum of case_ids_on_phone, kept up to date as cases are added and
+        removed. It starts from the hash that was saved with the sync log if there is one.
+        """
+        checksum = getattr(self, '_checksum', None)
+        if checksum is None:
+            stored_hash = getattr(self, '_hash', None)
+            if stored_hash is not None:
+                checksum = Checksum(initial_checksum=stored_hash)
+            else:
+                checksum = Checksum(self.case_ids_on_phone)
+            self._checksum = checksum
+        return checksum
+
+    def get_state_hash(self):
+        if not self.case_ids_on_phone:
+            # the XOR of the cases that were removed would be all zeros
+            return CaseStateHash(EMPTY_HASH)
+        return CaseStateHash(self._get_checksum().hexdigest())
+
+    def recompute_state_hash(self):
+        """
+        The state hash worked out from scratch from all the cases on the phone
+        """
+        return super(SimplifiedSyncLog, self).get_state_hash()
+
+    def _add_case_on_phone(self, case_id):
+        checksum = self._get_checksum()
+        if case_id not in self.case_ids_on_phone:
+            self.case_ids_on_phone.add(case_id)
+            checksum.add(case_id)
+
+    def _remove_case_on_phone(self, case_id):
+        checksum = self._get_checksum()
+        self.case_ids_on_phone.remove(case_id)
+        checksum.remove(case_id)
+
+    def set_case_ids_on_phone(self, case_ids, previous_log=None):
+        """
+        Replace all the cases on the phone. If they include every case from
+        ``previous_log`` only the ones that aren't in it get hashed.
+        """
+        if previous_log is not None and previous_log.case_ids_on_phone <= case_ids:
+            checksum = copy(previous_log._get_checksum())
+            checksum.update(case_ids - previous_log.case_ids_on_phone)
+        else:
+            checksum = Checksum(case_ids)
+        self.case_ids_on_phone = case_ids
+        self._checksum = checksum
+
     def prune_case(self, case_id):
         """
         Prunes a case from the tree while also pruning any dependencies as a result of this pruning.
         """
+        # pruning a case can leave the cases it indexed on the phone only because
+        # of it so those get pruned next, in the same order as they were indexed
+        to_prune = list(reversed(self._prune_case(case_id)))
+        while to_prune:
+            indexed_case_id = to_prune.pop()
+            # it could have been removed while pruning the cases before it
+            if indexed_case_id in self.dependent_case_ids_on_phone:
+                to_prune.extend(reversed(self._prune_case(indexed_case_id)))
+
+    def _prune_case(self, case_id):
+        """
+        Returns the cases this one indexed that should be pruned after it
+        """
         logger.debug('pruning: {}'.format(case_id))
         self.dependent_case_ids_on_phone.add(case_id)
-        reverse_index_map = _reverse_index_map(self.index_tree.indices)
-        dependencies = self.index_tree.get_all_cases_that_depend_on_case(case_id, cached_map=reverse_index_map)
+        dependencies = self.index_tree.get_all_cases_that_depend_on_case(case_id)
         # we can only potentially remove a case if it's already in dependent case ids
         # and therefore not directly owned
         candidates_to_remove = dependencies & self.dependent_case_ids_on_phone
@@ -202,13 +304,13 @@ class SimplifiedSyncLog(AbstractSyncLog):
             # uses closures for assertions
             logger.debug('removing: {}'.format(case_id))
             assert to_remove in self.dependent_case_ids_on_phone
-            indices = self.index_tree.indices.pop(to_remove, {})
+            indices = self.index_tree.remove_case(to_remove)
             if to_remove != case_id:
                 # if the case had indexes they better also be in our removal list (except for ourselves)
                 for index in indices.values():
                     assert index in candidates_to_remove, \
                         "expected {} in {} but wasn't".format(index, candidates_to_remove)
-            self.case_ids_on_phone.remove(to_remove)
+            self._remove_case_on_phone(to_remove)
             self.dependent_case_ids_on_phone.remove(to_remove)
 
         if not dependencies_not_to_remove:
@@ -218,22 +320,22 @@ class SimplifiedSyncLog(AbstractSyncLog):
             for to_remove in candidates_to_remove:
                 _remove_case(to_remove)
 
-            for this_case_index in this_case_indices.values():
-                if (this_case_index in self.dependent_case_ids_on_phone and
-                        this_case_index not in candidates_to_remove):
-                    self.prune_case(this_case_index)
+            return [
+                this_case_index for this_case_index in this_case_indices.values()
+                if this_case_index in self.dependent_case_ids_on_phone and
+                this_case_index not in candidates_to_remove
+            ]
         else:
             # we have some possible candidates for removal. we should check each of them.
             candidates_to_remove.remove(case_id)  # except ourself
             for candidate in candidates_to_remove:
-                candidate_dependencies = self.index_tree.get_all_cases_that_depend_on_case(
-                    candidate, cached_map=reverse_index_map
-                )
+                candidate_dependencies = self.index_tree.get_all_cases_that_depend_on_case(candidate)
                 if not candidate_dependencies - self.dependent_case_ids_on_phone:
                     _remove_case(candidate)
+            return []
 
     def _add_primary_case(self, case_id):
-        self.case_ids_on_phone.add(case_id)
+        self._add_case_on_phone(case_id)
         if case_id in self.dependent_case_ids_on_phone:
             self.dependent_case_ids_on_phone.remove(case_id)
 
@@ -271,7 +373,7 @@ class SimplifiedSyncLog(AbstractSyncLog):
                         if index.referenced_id:
                             self.index_tree.set_index(case.id, index.identifier, index.referenced_id)
                             if index.referenced_id not in self.case_ids_on_phone:
-                                self.case_ids_on_phone.add(index.referenced_id)
+                                self._add_case_on_phone(index.referenced_id)
                                 self.dependent_case_ids_on_phone.add(index.referenced_id)
                         else:
                             self.index_tree.delete_index(case.id, index.identifier)
@@ -284,15 +386,19 @@ class SimplifiedSyncLog(AbstractSyncLog):
 
         logger.debug('case ids after update: {}'.format(', '.join(self.case_ids_on_phone)))
         logger.debug('dependent case ids after update: {}'.format(', '.join(self.dependent_case_ids_on_phone)))
-        # if made_changes or case_list:
-        #     try:
-        #         if made_changes:
-        #             self.save()
-        #         if case_list:
-        #             self.invalidate_cached_payloads()
-        #     except ResourceConflict:
-        #         logging.exception('doc update conflict saving sync log {id}'.format(
-        #             id=self.id,
-        #         ))
-        #         raise
+        if case_list:
+            # the phone's cases have changed so any restore cached for it is out of date
+            self.invalidate_cached_payloads()
         return made_changes
+
+
+def get_state_hash_mismatches(synclogs):
+    """
+    Yields (synclog, saved hash, recomputed hash) for each sync log whose saved
+    state hash doesn't match the one worked out from all of its cases.
+    """
+    for synclog in synclogs:
+        saved_hash = synclog.get_state_hash()
+        recomputed_hash = synclog.recompute_state_hash()
+        if saved_hash != recomputed_hash:
+            yield synclog, saved_hash, recomputed_hash
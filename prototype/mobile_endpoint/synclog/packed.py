@@ -0,0 +1,75 @@
+"""
+Sync log case ids packed into a single binary string.
+
+Each id is stored as its 16 bytes, sorted so the same ids always pack the same
+way. This is a lot smaller than an array or JSON list of UUID strings and
+getting the set of ids back means hexlifying one string instead of one per id.
+
+The first byte says whether the rest is compressed with zlib.
+"""
+import binascii
+import zlib
+from uuid import UUID
+
+from flask import current_app
+
+_UUID_SIZE = 16
+_RAW = '\x00'
+_ZLIB = '\x01'
+
+
+def pack_uuids(ids, compress=False):
+    """
+    Raises ValueError if any of the ids isn't a UUID in its usual lower case
+    form since that's the only form they can be unpacked to.
+    """
+    packed = []
+    for id in ids:
+        if len(id) != 36 or id != id.lower():
+            raise ValueError(id)
+        packed.append(UUID(id).bytes)
+    packed.sort()
+    data = ''.join(packed)
+    if compress:
+        return _ZLIB + zlib.compress(data)
+    return _RAW + data
+
+
+def get_packed_case_ids(ids):
+    """
+    The ids packed the way the PACKED_SYNCLOG_CASE_IDS and PACKED_SYNCLOG_COMPRESSION
+    settings ask for or None if they should be saved as a list.
+    """
+    if not current_app.config.get('PACKED_SYNCLOG_CASE_IDS'):
+        return None
+    try:
+        return pack_uuids(ids, compress=current_app.config.get('PACKED_SYNCLOG_COMPRESSION'))
+    except ValueError:
+        return None
+
+
+class PackedUUIDSet(object):
+    """
+    Read only set of the ids in a string from ``pack_uuids``
+    """
+
+    def __init__(self, packed):
+        # postgres gives back a buffer
+        packed = str(packed)
+        if packed[:1] == _ZLIB:
+            self._data = zlib.decompress(packed[1:])
+        else:
+            self._data = packed[1:]
+
+    def __len__(self):
+        return len(self._data) // _UUID_SIZE
+
+    def __iter__(self):
+        # plain strings are quicker to build than unicode and equal to the unicode ids
+        hex = binascii.hexlify(self._data)
+        for i in xrange(0, len(hex), 2 * _UUID_SIZE):
+            yield '%s-%s-%s-%s-%s' % (hex[i:i + 8], hex[i + 8:i + 12], hex[i + 12:i + 16],
+                                      hex[i + 16:i + 20], hex[i + 20:i + 32])
+
+    def to_set(self):
+        return set(self)
@@ -1,8 +1,13 @@
 from collections import namedtuple
+from multiprocessing.pool import ThreadPool
 import re
+import time
+from uuid import uuid4
 import iso8601
 import pytz
 import redis
+from flask import current_app
+from redis.exceptions import LockError
 from mobile_endpoint.extensions import redis_store
 
 ISO_DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%fZ'
@@ -95,6 +100,131 @@ def release_lock(lock, degrade_gracefully=False):
                 raise
 
 
+def get_case_lock_key(case_id):
+    return 'case_lock_{}'.format(case_id)
+
+
+class MultiLock(object):
+    """
+    A lock over several keys that is acquired (and released) with a single call
+    to Redis no matter how many keys there are.
+
+    It's all or nothing: if any of the keys is already locked none of them are
+    taken. The keys are compatible with the ones used by ``redis_store.lock`` so
+    the two can be used to lock the same objects.
+    """
+    # KEYS - lock names
+    # ARGV[1] - token
+    # ARGV[2] - timeout in milliseconds
+    # return 1 if all the locks were acquired, otherwise 0
+    LUA_ACQUIRE_SCRIPT = """
+        for i, key in ipairs(KEYS) do
+            if redis.call('exists', key) == 1 then
+                return 0
+            end
+        end
+        for i, key in ipairs(KEYS) do
+            redis.call('set', key, ARGV[1])
+            if ARGV[2] ~= '' then
+                redis.call('pexpire', key, tonumber(ARGV[2]))
+            end
+        end
+        return 1
+    """
+
+    # KEYS - lock names
+    # ARGV - the token for each key
+    # return the number of locks released
+    LUA_RELEASE_SCRIPT = """
+        local released = 0
+        for i, key in ipairs(KEYS) do
+            if redis.call('get', key) == ARGV[i] then
+                redis.call('del', key)
+                released = released + 1
+            end
+        end
+        return released
+    """
+
+    lua_acquire = None
+    lua_release = None
+
+    def __init__(self, redis_client, keys, timeout=None, sleep=0.1):
+        self.redis = redis_client
+        self.keys = sorted(set(keys))
+        self.timeout = timeout
+        self.sleep = sleep
+        self.token = None
+        MultiLock.register_scripts(redis_client)
+
+    @classmethod
+    def register_scripts(cls, redis_client):
+        if cls.lua_acquire is None:
+            cls.lua_acquire = redis_client.register_script(cls.LUA_ACQUIRE_SCRIPT)
+        if cls.lua_release is None:
+            cls.lua_release = redis_client.register_script(cls.LUA_RELEASE_SCRIPT)
+
+    def acquire(self, blocking=True, blocking_timeout=None):
+        token = uuid4().hex
+        timeout = int(self.timeout * 1000) if self.timeout else ''
+        stop_trying_at = time.time() + blocking_timeout if blocking_timeout is not None else None
+        while True:
+            if not self.keys or self.lua_acquire(keys=self.keys, args=[token, timeout], client=self.redis):
+                self.token = token
+                return True
+            if not blocking:
+                return False
+            if stop_trying_at is not None and time.time() > stop_trying_at:
+                return False
+            time.sleep(self.sleep)
+
+    def release(self):
+        release_multi_locks([self])
+
+
+def release_multi_locks(locks):
+    """
+    Release a list of MultiLocks with a single call to Redis.
+    """
+    locks = [lock for lock in locks if lock and lock.token]
+    if not locks:
+        return
+
+    keys, tokens = [], []
+    for lock in locks:
+        keys.extend(lock.keys)
+        tokens.extend([lock.token] * len(lock.keys))
+        lock.token = None
+
+    if not keys:
+        return
+    released = MultiLock.lua_release(keys=keys, args=tokens, client=locks[0].redis)
+    if released != len(keys):
+        raise LockError("Cannot release a lock that's no longer owned")
+
+
+def acquire_locks(keys, timeout_seconds=30, blocking_timeout_seconds=30):
+    """
+    Acquire a blocking lock over all of the keys at once. Keys are sorted so that
+    the lock is always requested in the same order.
+
+    Raises LockError if the keys are still locked after ``blocking_timeout_seconds``.
+    """
+    lock = MultiLock(redis_store, keys, timeout=timeout_seconds)
+    lock = acquire_lock(lock, blocking=True, blocking_timeout=blocking_timeout_seconds)
+    if not lock.token:
+        raise LockError("Timed out waiting for {} lock(s)".format(len(lock.keys)))
+    return lock
+
+
+def release_locks(locks, degrade_gracefully=False):
+    try:
+        release_multi_locks(locks)
+    except redis.ConnectionError:
+        if not degrade_gracefully:
+            raise
+
+
 def get_with_lock(key, getter_fn, timeout_seconds=30):
     lock = redis_store.lock(key, timeout=timeout_seconds)
     lock = acquire_lock(lock, blocking=True)
@@ -110,6 +240,30 @@ def get_with_lock(key, getter_fn, timeout_seconds=30):
         return LockManager(obj, lock)
 
 
+def map_in_app_context(fn, items, workers):
+    """
+    Like ``map`` but with up to ``workers`` calls running at once in threads (greenlets
+    once gevent has patched the server). Each call gets its own app context, and so
+    its own database session. The results are in the same order as ``items``.
+    """
+    items = list(items)
+    if workers <= 1 or len(items) <= 1:
+        return map(fn, items)
+
+    app = current_app._get_current_object()
+
+    def _call(item):
+        with app.app_context():
+            return fn(item)
+
+    pool = ThreadPool(min(workers, len(items)))
+    try:
+        return pool.map(_call, items)
+    finally:
+        pool.close()
+        pool.join()
+
+
 def json_format_datetime(dt):
     """
     includes microseconds (always)
@@ -123,19 +277,34 @@ def json_format_date(date_):
     return date_.strftime(ISO_DATE_FORMAT)
 
 
+def adjust_datetime(value):
+    """
+    format a single datetime-like string uniformly
+    (strings that don't look like datetimes are returned unchanged)
+
+    >>> adjust_datetime('2015-04-08T14:00:01.123+02:00')
+    '2015-04-08T12:00:01.123000Z'
+    >>> adjust_datetime('not a date')
+    'not a date'
+    """
+    # this strips the timezone like we've always done
+    if re_loose_datetime.match(value):
+        return json_format_datetime(
+            iso8601.parse_date(value).astimezone(pytz.utc)
+            .replace(tzinfo=None)
+        )
+    return value
+
+
 def adjust_datetimes(data, parent=None, key=None):
     """
     find all datetime-like strings within data (deserialized json)
     and format them uniformly, in place.
 
     """
-    # this strips the timezone like we've always done
     if isinstance(data, basestring):
         if re_loose_datetime.match(data):
-            parent[key] = json_format_datetime(
-                iso8601.parse_date(data).astimezone(pytz.utc)
-                .replace(tzinfo=None)
-            )
+            parent[key] = adjust_datetime(data)
 
     elif isinstance(data, dict):
         for key, value in data.items():
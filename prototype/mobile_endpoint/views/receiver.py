@@ -1,12 +1,21 @@
+import logging
+
 from flask import request
+from redis.exceptions import LockError
+from werkzeug.exceptions import BadRequest
 from mobile_endpoint.backends.manager import get_dao
 
-from mobile_endpoint.case.case_processing import process_cases_in_form
+from mobile_endpoint.case.case_processing import process_cases_in_form, process_cases_in_forms
 
+from mobile_endpoint.exceptions import CommCareCaseError
 from mobile_endpoint.extensions import requires_auth
-from mobile_endpoint.form.form_processing import create_xform, get_instance_and_attachments, get_request_metadata
+from mobile_endpoint.form.form_processing import create_xform, get_instance_and_attachments, get_request_metadata, \
+    get_instances
+from mobile_endpoint.utils import release_lock
 from mobile_endpoint.views import ota_mod
-from mobile_endpoint.views.response import get_open_rosa_response
+from mobile_endpoint.views.response import get_open_rosa_response, get_open_rosa_batch_response, BatchFormResult
+
+logger = logging.getLogger(__name__)
 
 
 @ota_mod.route('/receiver/<domain>', methods=['POST'])
@@ -26,6 +35,24 @@ def mongo_receiver(domain):
     return _receiver(domain, backend='mongo')
 
 
+@ota_mod.route('/receiver/<domain>/batch', methods=['POST'])
+@requires_auth
+def form_batch_receiver(domain):
+    return _batch_receiver(domain, backend='sql')
+
+
+@ota_mod.route('/couch-receiver/<domain>/batch', methods=['POST'])
+@requires_auth
+def couch_batch_receiver(domain):
+    return _batch_receiver(domain, backend='couch')
+
+
+@ota_mod.route('/mongo-receiver/<domain>/batch', methods=['POST'])
+@requires_auth
+def mongo_batch_receiver(domain):
+    return _batch_receiver(domain, backend='mongo')
+
+
 def _receiver(domain, backend):
     dao = get_dao(backend)
     instance, attachments = get_instance_and_attachments(request)
@@ -42,3 +69,89 @@ def _receiver(domain, backend):
         dao.commit_atomic_submission(xform, case_result)
 
     return get_open_rosa_response(xform, None, None)
+
+
+def _batch_receiver(domain, backend):
+    """
+    Process many forms in one request (e.g. a phone's queue after being offline).
+
+    The cases for all the forms are processed together and everything is committed
+    in one write. A form that can't be processed (e.g. it has an invalid ID or
+    touches a case it isn't allowed to) gets an error result and isn't saved but
+    the rest of the batch still is.
+    """
+    dao = get_dao(backend)
+    instances = get_instances(request)
+    request_meta = get_request_metadata(request)
+    request_meta['domain'] = domain
+
+    results = []
+    xform_locks = []
+    try:
+        batch_forms = {}
+        for instance in instances:
+            try:
+                xform_lock = create_xform(instance, {}, request_meta, dao, batch_forms=batch_forms)
+            except BadRequest as e:
+                results.append(BatchFormResult(None, None, e.description))
+                continue
+            xform = xform_lock.obj
+            xform_locks.append(xform_lock)
+            batch_forms[xform.id] = xform
+            results.append(BatchFormResult(_get_submitted_id(xform), xform, None))
+
+        errors = _process_batch([xform for xform, _ in xform_locks], dao)
+    finally:
+        for _, lock in xform_locks:
+            release_lock(lock, degrade_gracefully=True)
+
+    return get_open_rosa_batch_response([
+        result._replace(xform=None, error=errors[result.xform.id])
+        if result.xform and result.xform.id in errors else result
+        for result in results
+    ])
+
+
+def _get_submitted_id(xform):
+    # duplicates and conflicting forms are saved under a new ID
+    if getattr(xform, 'duplicate_id', None):
+        return xform.duplicate_id
+    # forms without a meta block don't have an instanceID
+    metadata = xform.metadata
+    return metadata.instanceID if metadata and metadata.instanceID else xform.id
+
+
+def _process_batch(xforms, dao):
+    """
+    Process and save the forms together. If that fails fall back to doing them one
+    at a time so one form's error (or a case lock it can't get) doesn't stop the
+    others from being saved.
+
+    :returns:   dict of form ID to error message for the forms that weren't saved
+    """
+    try:
+        _process_and_commit(xforms, dao)
+        return {}
+    except Exception as e:
+        if len(xforms) == 1:
+            return {xforms[0].id: _get_error_message(xforms[0], e)}
+
+    errors = {}
+    for xform in xforms:
+        try:
+            _process_and_commit([xform], dao)
+        except Exception as e:
+            errors[xform.id] = _get_error_message(xform, e)
+    return errors
+
+
+def _get_error_message(xform, error):
+    if not isinstance(error, (CommCareCaseError, LockError)):
+        logger.exception('Error processing form %s in a batch', xform.id)
+    return unicode(error) or type(error).__name__
+
+
+def _process_and_commit(xforms, dao):
+    to_process = [xform for xform in xforms if xform.doc_type == 'XFormInstance']
+    case_result = process_cases_in_forms(to_process, dao) if to_process else None
+    dao.commit_atomic_submissions(xforms, case_result)
@@ -1,4 +1,5 @@
 from __future__ import absolute_import
+from collections import namedtuple
 from xml.etree import ElementTree
 from flask.helpers import make_response
 
@@ -79,6 +80,46 @@ def get_open_rosa_response(instance, responses, errors):
     return response
 
 
+# The outcome of one form in a batch submission. ``xform`` is None if the form wasn't saved.
+BatchFormResult = namedtuple('BatchFormResult', ['instance_id', 'xform', 'error'])
+
+
+def get_open_rosa_batch_response(results):
+    """
+    A single response for a batch submission containing one OpenRosaResponse
+    per form, in submission order.
+
+    Each one is tagged with the instanceID the form was submitted with (if it
+    could be read) and the ID the form was saved under (if it was saved). These
+    differ for duplicate forms which are saved under a new ID.
+    """
+    elem = ElementTree.Element('OpenRosaBatchResponse')
+    elem.attrib = {'xmlns': RESPONSE_XMLNS}
+    for result in results:
+        if result.error:
+            form_response = OpenRosaResponse(
+                message=result.error,
+                nature=ResponseNature.SUBMIT_ERROR,
+                status=201,
+            )
+        elif result.xform.doc_type == "XFormInstance":
+            form_response = OPEN_ROSA_SUCCESS_RESPONSE
+        else:
+            form_response = OpenRosaResponse(
+                message=result.xform.problem,
+                nature=ResponseNature.SUBMIT_ERROR,
+                status=201,
+            )
+        form_elem = form_response.etree()
+        if result.instance_id:
+            form_elem.set('instance_id', result.instance_id)
+        if result.xform:
+            form_elem.set('form_id', result.xform.id)
+        elem.append(form_elem)
+
+    return make_response(ElementTree.tostring(elem, encoding='utf-8'), 201)
+
+
 def get_success_response(doc, responses, errors):
 
     if errors:
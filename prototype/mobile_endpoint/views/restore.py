@@ -35,11 +35,10 @@ def _ota_restore(domain, backend):
         project=Domain(domain),
         user=get_user(user_id),
         params=RestoreParams(**restore_params),
-        cache_settings=RestoreCacheSettings(),
+        cache_settings=RestoreCacheSettings(**get_cache_settings(request)),
     )
-    response = restore_config.get_response()
-    dao.commit_restore(restore_config.restore_state)
-    return response
+    # the sync log is saved once the payload has been generated
+    return restore_config.get_response()
 
 
 def get_restore_params(request):
@@ -56,6 +55,13 @@ def get_restore_params(request):
     }
 
 
+def get_cache_settings(request):
+    return {
+        'force_cache': request.args.get('force_cache') == 'true',
+        'overwrite_cache': request.args.get('overwrite_cache') == 'true',
+    }
+
+
 def get_user(user_id):
     return dummy_user(user_id)
 
@@ -14,11 +14,14 @@ couch = pytest.mark.couch
 sql = pytest.mark.sql
 mongo = pytest.mark.mongo
 rowsize = pytest.mark.rowsize
+benchmark = pytest.mark.benchmark
 
 
 def pytest_addoption(parser):
     parser.addoption("--rowsize", action="store", metavar="model",
         help="only run row size tests")
+    parser.addoption("--benchmark", action="store_true",
+        help="only run benchmarks")
 
 
 def pytest_runtest_setup(item):
@@ -33,6 +36,13 @@ def pytest_runtest_setup(item):
     elif run_rowsize_tests:
         pytest.skip("only running rowsize tests")
 
+    run_benchmarks = item.config.getoption("--benchmark")
+    if item.get_marker("benchmark"):
+        if not run_benchmarks:
+            pytest.skip("need --benchmark option to run")
+    elif run_benchmarks:
+        pytest.skip("only running benchmarks")
+
 
 @pytest.fixture(scope="session")
 def testapp():
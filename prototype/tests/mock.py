@@ -5,7 +5,7 @@ from datetime import datetime
 from uuid import uuid4
 from xml.etree import ElementTree
 from flask.templating import render_template_string
-from mobile_endpoint.backends.manager import get_dao, get_submit_url
+from mobile_endpoint.backends.manager import get_dao, get_submit_url, get_batch_submit_url
 from mobile_endpoint.case.xml import NS_VERSION_MAP, V2
 from mobile_endpoint.utils import json_format_datetime
 
@@ -38,11 +38,42 @@ def post_case_blocks(backend, client, case_blocks, form_extras=None, domain=None
 
     submit_url = get_submit_url(backend, domain)
 
+    form_xml = get_form_xml(case_blocks, form_extras)
+
+    headers = {'Authorization': 'Basic ' + base64.b64encode('admin:secret')}
+    headers.update(form_extras.get('headers', {}))
+    result = client.post(
+        submit_url,
+        headers=headers,
+        data=form_xml
+    )
+    return result
+
+
+def post_case_block_batch(backend, client, forms, domain, headers=None):
+    """
+    Post several forms in one request to the batch receiver.
+
+    :param forms:   list of (case_blocks, form_extras) tuples, one per form
+    """
+    submit_url = get_batch_submit_url(backend, domain)
+    data = '\n'.join(get_form_xml(case_blocks, form_extras or {}) for case_blocks, form_extras in forms)
+
+    request_headers = {'Authorization': 'Basic ' + base64.b64encode('admin:secret')}
+    request_headers.update(headers or {})
+    return client.post(
+        submit_url,
+        headers=request_headers,
+        data=data
+    )
+
+
+def get_form_xml(case_blocks, form_extras):
     now = json_format_datetime(datetime.utcnow())
     if not isinstance(case_blocks, basestring):
         case_blocks = ''.join([ElementTree.tostring(cb) for cb in case_blocks])
 
-    form_xml = render_template_string(MOCK_FORM, **{
+    return render_template_string(MOCK_FORM, **{
         'case_block': case_blocks,
         'time': now,
         'uid': form_extras.get('form_id', str(uuid4())),
@@ -50,15 +81,6 @@ def post_case_blocks(backend, client, case_blocks, form_extras=None, domain=None
         'user_id': form_extras.get('user_id', str(uuid4())),
     })
 
-    headers = {'Authorization': 'Basic ' + base64.b64encode('admin:secret')}
-    headers.update(form_extras.get('headers', {}))
-    result = client.post(
-        submit_url,
-        headers=headers,
-        data=form_xml
-    )
-    return result
-
 class CaseBlock(dict):
     """
     Doctests:
@@ -1,15 +1,22 @@
 # -*- coding: utf-8 -*-
+from collections import namedtuple
 from datetime import datetime
 import hashlib
 import random
 import string
+import time
 from uuid import uuid4
 
 import pytest
 from mobile_endpoint.backends.manager import get_dao, BACKEND_SQL
 
-from mobile_endpoint.models import db, FormData, CaseData, Synclog, CaseIndex
+from mobile_endpoint.case.case_processing import CaseProcessingResult, DirtinessFlag, \
+    process_pending_dirtiness_checks
+from mobile_endpoint.models import db, FormData, CaseData, Synclog, CaseIndex, OwnershipCleanlinessFlag, \
+    PendingDirtinessCheck, compact_synclogs
+from mobile_endpoint.restore.data_providers.case.clean_owners import CleanOwnerCaseSyncOperation
 from mobile_endpoint.synclog.checksum import Checksum
+from mobile_endpoint.synclog.models import SimplifiedSyncLog, IndexTree
 from mobile_endpoint.utils import json_format_datetime
 from tests.conftest import delete_all_data, rowsize, sql
 from tests.utils import create_synclog
@@ -75,6 +82,176 @@ class TestModels(object):
 
         assert CaseData.query.get(case_id).version == 3
 
+    def test_synclog_deltas(self, testapp, monkeypatch):
+        """
+        Sync logs saved as deltas come back the same as they were saved and are
+        saved in full before a log they are based on changes.
+        """
+        monkeypatch.setitem(testapp.config, 'SYNCLOG_SNAPSHOT_INTERVAL', 3)
+        with testapp.app_context():
+            dao = get_dao(BACKEND_SQL)
+            synclogs = _save_synclog_chain(dao, num_logs=5, cases_per_log=3)
+            assert [Synclog.query.get(s.id).delta_depth for s in synclogs] == [0, 1, 2, 0, 1]
+            assert Synclog.query.get(synclogs[1].id).case_ids_on_phone is None
+            for synclog in synclogs:
+                _assert_same_state(dao.get_synclog(synclog.id), synclog)
+
+            updated = dao.get_synclog(synclogs[1].id)
+            updated._add_primary_case(str(uuid4()))
+            dao.save_synclog(updated)
+            assert Synclog.query.get(synclogs[2].id).delta_depth == 0
+            _assert_same_state(dao.get_synclog(synclogs[1].id), updated)
+            _assert_same_state(dao.get_synclog(synclogs[2].id), synclogs[2])
+
+    def test_compact_synclogs(self, testapp, monkeypatch):
+        with testapp.app_context():
+            dao = get_dao(BACKEND_SQL)
+            synclogs = _save_synclog_chain(dao, num_logs=5, cases_per_log=3)
+            assert [Synclog.query.get(s.id).delta_depth for s in synclogs] == [0] * 5
+
+            monkeypatch.setitem(testapp.config, 'SYNCLOG_SNAPSHOT_INTERVAL', 2)
+            assert compact_synclogs() == 2
+            assert [Synclog.query.get(s.id).delta_depth for s in synclogs] == [0, 1, 0, 1, 0]
+            for synclog in synclogs:
+                _assert_same_state(dao.get_synclog(synclog.id), synclog)
+
+            monkeypatch.setitem(testapp.config, 'SYNCLOG_SNAPSHOT_INTERVAL', 1)
+            assert compact_synclogs() == 2
+            assert [Synclog.query.get(s.id).delta_depth for s in synclogs] == [0] * 5
+
+    @pytest.mark.parametrize('compress', [False, True])
+    def test_packed_synclog_case_ids(self, testapp, monkeypatch, compress):
+        monkeypatch.setitem(testapp.config, 'PACKED_SYNCLOG_CASE_IDS', True)
+        monkeypatch.setitem(testapp.config, 'PACKED_SYNCLOG_COMPRESSION', compress)
+        monkeypatch.setitem(testapp.config, 'SYNCLOG_SNAPSHOT_INTERVAL', 2)
+        with testapp.app_context():
+            dao = get_dao(BACKEND_SQL)
+            synclogs = _save_synclog_chain(dao, num_logs=3, cases_per_log=3)
+            row = Synclog.query.get(synclogs[0].id)
+            assert row.packed_case_ids is not None
+            assert row.case_ids_on_phone is None
+            for synclog in synclogs:
+                _assert_same_state(dao.get_synclog(synclog.id), synclog)
+
+            not_uuids = _save_synclog_chain(dao, num_logs=1, cases_per_log=3)[0]
+            not_uuids._add_primary_case('not-a-uuid')
+            dao.save_synclog(not_uuids)
+            row = Synclog.query.get(not_uuids.id)
+            assert row.packed_case_ids is None
+            assert 'not-a-uuid' in row.case_ids_on_phone
+            _assert_same_state(dao.get_synclog(not_uuids.id), not_uuids)
+
+    @pytest.mark.parametrize('upsert', [True, False])
+    def test_commit_dirtiness_flags(self, testapp, monkeypatch, upsert):
+        monkeypatch.setitem(testapp.config, 'UPSERT_CLEANLINESS_FLAGS', upsert)
+        domain = 'test-flags'
+        clean_owner, dirty_owner, hinted_owner = sorted(str(uuid4()) for i in range(3))
+        case_ids = [str(uuid4()) for i in range(4)]
+        with testapp.app_context():
+            with db.session.begin():
+                db.session.add(OwnershipCleanlinessFlag(domain=domain, owner_id=hinted_owner,
+                                                        is_clean=False, hint=case_ids[0]))
+            cases = [_Case(case_ids[1], clean_owner), _Case(case_ids[2], dirty_owner),
+                     _Case(case_ids[3], hinted_owner)]
+            flags = [DirtinessFlag(case_ids[2], dirty_owner), DirtinessFlag(case_ids[3], hinted_owner)]
+            CaseProcessingResult(domain, cases, flags, True).commit_dirtiness_flags()
+            # running it again leaves the flags alone
+            CaseProcessingResult(domain, cases, flags, True).commit_dirtiness_flags()
+
+            db.session.expire_all()
+            saved = {
+                flag.owner_id: (flag.is_clean, flag.hint)
+                for flag in OwnershipCleanlinessFlag.query.filter_by(domain=domain)
+            }
+            assert saved == {
+                clean_owner: (True, None),
+                dirty_owner: (False, case_ids[2]),
+                hinted_owner: (False, case_ids[0]),
+            }
+
+    def test_deferred_dirtiness_checks(self, testapp, monkeypatch):
+        domain = 'test-deferred-flags'
+        parent_id, child_id = str(uuid4()), str(uuid4())
+        parent_owner, child_owner, other_owner = str(uuid4()), str(uuid4()), str(uuid4())
+        dao = _ChildCaseDao([_ChildCase(child_id, child_owner, [_Index(parent_id)])])
+        restore_state = _RestoreState(domain, [child_owner, other_owner], dao)
+        with testapp.app_context():
+            monkeypatch.setitem(testapp.config, 'DEFERRED_DIRTINESS_CHECKS', True)
+            db.session.add(OwnershipCleanlinessFlag(domain=domain, owner_id=other_owner, is_clean=True))
+            # the second submission moves the parent away from the child's owner
+            for owner_id, previous_owner_id in [(child_owner, None), (parent_owner, child_owner)]:
+                result = CaseProcessingResult(domain, [], [], True, {parent_id: (owner_id, previous_owner_id)})
+                result.commit_dirtiness_flags()
+            # only the owners of the queued case are treated as dirty
+            assert PendingDirtinessCheck.get_pending_owner_ids(domain, [child_owner, other_owner]) == {child_owner}
+            assert CleanOwnerCaseSyncOperation(restore_state).cleanliness_flags == {
+                child_owner: False, other_owner: True
+            }
+            monkeypatch.setitem(testapp.config, 'DEFERRED_DIRTINESS_CHECKS', False)
+            assert CleanOwnerCaseSyncOperation(restore_state).cleanliness_flags == {other_owner: True}
+
+            assert process_pending_dirtiness_checks(dao) == 2
+            assert dao.requested == [[parent_id]]
+            assert PendingDirtinessCheck.query.filter_by(domain=domain).count() == 0
+            flag = OwnershipCleanlinessFlag.query.get((domain, child_owner))
+            assert (flag.is_clean, flag.hint) == (False, child_id)
+
+_Case = namedtuple('_Case', ['id', 'owner_id'])
+_ChildCase = namedtuple('_ChildCase', ['id', 'owner_id', 'indices'])
+_Index = namedtuple('_Index', ['referenced_id'])
+_RestoreState = namedtuple('_RestoreState', ['domain', 'owner_ids', 'dao'])
+
+
+class _ChildCaseDao(object):
+    queues_dirtiness_checks = True
+
+    def __init__(self, child_cases):
+        self.child_cases = child_cases
+        self.requested = []
+
+    def get_reverse_index_owners(self, domain, case_ids):
+        self.requested.append(case_ids)
+        return [(case.id, case.owner_id, index.referenced_id)
+                for case in self.child_cases for index in case.indices if index.referenced_id in case_ids]
+
+
+def _save_synclog_chain(dao, num_logs, cases_per_log, previous=None):
+    """
+    Sync logs for one phone that each add some cases, an index and a dependent case
+    """
+    user_id = previous.user_id if previous else str(uuid4())
+    synclogs = []
+    for i in range(num_logs):
+        synclog = SimplifiedSyncLog(
+            id=str(uuid4()),
+            date=datetime.utcnow(),
+            domain='test',
+            user_id=user_id,
+            previous_log_id=previous.id if previous else None,
+            owner_ids_on_phone={user_id},
+            case_ids_on_phone=set(previous.case_ids_on_phone) if previous else set(),
+            dependent_case_ids_on_phone=set(previous.dependent_case_ids_on_phone) if previous else set(),
+            index_tree=IndexTree(indices=dict(previous.index_tree.indices) if previous else {}),
+        )
+        case_ids = [str(uuid4()) for j in range(cases_per_log)]
+        for case_id in case_ids:
+            synclog._add_primary_case(case_id)
+        parent_id = str(uuid4())
+        synclog.index_tree.set_index(case_ids[0], 'parent', parent_id)
+        synclog._add_case_on_phone(parent_id)
+        synclog.dependent_case_ids_on_phone.add(parent_id)
+        dao.save_synclog(synclog)
+        synclogs.append(synclog)
+        previous = synclog
+    return synclogs
+
+
+def _assert_same_state(synclog, expected):
+    assert synclog.case_ids_on_phone == expected.case_ids_on_phone
+    assert synclog.dependent_case_ids_on_phone == expected.dependent_case_ids_on_phone
+    assert synclog.index_tree.indices == expected.index_tree.indices
+    assert synclog.get_state_hash() == expected.get_state_hash()
+
 
 @pytest.mark.usefixtures("testapp", "sqldb")
 class TestDetermineRowSizes(object):
@@ -131,6 +308,44 @@ class TestDetermineRowSizes(object):
 
         db.session.bulk_save_objects(cases)
 
+    @rowsize('synclog')
+    def test_table_size_synclog(self, testapp, monkeypatch):
+        """
+        Save 100 sync logs for each of 10 phones with 20k cases. Run scripts/get_table_sizes.sh
+        to output the resulting DB size. Set SYNCLOG_SNAPSHOT_INTERVAL and the packed case
+        id settings to compare the formats.
+        """
+        # Config that varies the row size
+        snapshot_interval = 10
+        packed_case_ids = False
+        packed_compression = False
+        cases_per_phone = 20000
+        cases_per_sync = 10
+        num_phones = 10
+        syncs_per_phone = 100
+
+        delete_all_data()
+        monkeypatch.setitem(testapp.config, 'SYNCLOG_SNAPSHOT_INTERVAL', snapshot_interval)
+        monkeypatch.setitem(testapp.config, 'PACKED_SYNCLOG_CASE_IDS', packed_case_ids)
+        monkeypatch.setitem(testapp.config, 'PACKED_SYNCLOG_COMPRESSION', packed_compression)
+        with testapp.app_context():
+            dao = get_dao(BACKEND_SQL)
+            save_time = read_time = 0
+            for i in range(num_phones):
+                first, = _save_synclog_chain(dao, num_logs=1, cases_per_log=cases_per_phone)
+                start = time.time()
+                synclogs = _save_synclog_chain(dao, syncs_per_phone, cases_per_sync, previous=first)
+                save_time += time.time() - start
+                db.session.expunge_all()
+                start = time.time()
+                for synclog in synclogs:
+                    dao.get_synclog(synclog.id)
+                read_time += time.time() - start
+        print
+        print 'saved {:.1f} logs/s, read {:.1f} logs/s'.format(
+            num_phones * syncs_per_phone / save_time, num_phones * syncs_per_phone / read_time
+        )
+
 
 def _get_attachment_json(num):
     return {
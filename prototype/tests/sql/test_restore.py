@@ -1,9 +1,59 @@
 # -*- coding: utf-8 -*-
+from contextlib import contextmanager
+from multiprocessing import Process, Queue
+import resource
+from uuid import uuid4
+
 import pytest
-from mobile_endpoint.backends.manager import BACKEND_SQL
-from mobile_endpoint.models import Synclog
-from tests.conftest import sql
-from tests.test_restore import RestoreTestMixin
+from sqlalchemy import event
+
+from mobile_endpoint import create_app
+from mobile_endpoint.backends.manager import BACKEND_SQL, get_dao
+from mobile_endpoint.backends.sql.dao import SQLDao
+from mobile_endpoint.case.xml import V2
+from mobile_endpoint.models import db, Synclog, CaseData
+from mobile_endpoint.restore.restore import RestoreConfig, RestoreParams, RestoreCacheSettings
+from mobile_endpoint.utils import chunked
+from mobile_endpoint.views.restore import Domain
+from tests.conftest import sql, benchmark
+from tests.dummy import dummy_user
+from tests.mock import CaseFactory, CaseStructure, CaseRelationship
+from tests.test_restore import RestoreTestMixin, DOMAIN
+
+
+@contextmanager
+def capture_queries():
+    queries = []
+
+    def _capture(conn, cursor, statement, parameters, context, executemany):
+        queries.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', _capture)
+    try:
+        yield queries
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', _capture)
+
+
+def _get_peak_rss(user_id, streaming, results):
+    """
+    Run a restore in a new process and report the peak RSS (in KB) before and after
+    """
+    if not streaming:
+        SQLDao.iter_compact_cases = SQLDao.get_compact_cases
+    app = create_app('testconfig.py')
+    with app.test_request_context():
+        start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        config = RestoreConfig(
+            SQLDao(),
+            project=Domain(DOMAIN),
+            user=dummy_user(user_id),
+            params=RestoreParams(version=V2),
+            cache_settings=RestoreCacheSettings(overwrite_cache=True),
+        )
+        for chunk in config.get_payload().get_http_response().response:
+            pass
+        results.put((start_rss, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
 
 
 @pytest.mark.usefixtures("testapp", "client", "sqldb", "sql_reset")
@@ -24,3 +74,74 @@ class TestSQLRestore(RestoreTestMixin):
 
     def _get_restore_url_snippet(self):
         return 'restore'
+
+    def test_get_cases_loads_indices_up_front(self, testapp, client):
+        """
+        Getting cases doesn't need another query for each case's indices
+        """
+        with testapp.app_context():
+            factory = CaseFactory(BACKEND_SQL, client, domain=DOMAIN, case_defaults={
+                'user_id': self.user_id,
+                'owner_id': self.user_id,
+                'case_type': 'duck',
+            })
+            cases = factory.create_or_update_cases([
+                CaseStructure(
+                    attrs={'create': True, 'case_type': 'duckling'},
+                    relationships=[CaseRelationship(CaseStructure(attrs={'create': True}))],
+                )
+                for i in range(5)
+            ])
+            child_ids = [case.id for case in cases if case.indices]
+            assert len(child_ids) == 5
+            dao = get_dao(BACKEND_SQL)
+
+            db.session.expunge_all()
+            with capture_queries() as queries:
+                assert all(len(case.indices) == 1 for case in dao.get_cases(child_ids))
+            assert len(queries) == 2
+
+            db.session.expunge_all()
+            with capture_queries() as queries:
+                assert len(dao.get_case(child_ids[0]).indices) == 1
+            assert len(queries) == 1
+
+    @benchmark
+    def test_benchmark_restore_memory(self, testapp, client):
+        """
+        Peak memory for a 100k case restore with and without streaming the cases
+        """
+        num_cases = 100000
+        with testapp.app_context():
+            factory = CaseFactory(BACKEND_SQL, client, domain=DOMAIN, case_defaults={
+                'user_id': self.user_id,
+                'owner_id': self.user_id,
+                'case_type': 'duck',
+            })
+            case, = factory.create_or_update_case(CaseStructure(attrs={'create': True}))
+            template = CaseData.query.get(case.id)
+            with db.session.begin():
+                for chunk in chunked(range(num_cases - 1), 5000):
+                    db.session.execute(CaseData.__table__.insert(), [{
+                        'id': str(uuid4()),
+                        'domain': template.domain,
+                        'closed': False,
+                        'owner_id': template.owner_id,
+                        'server_modified_on': template.server_modified_on,
+                        'version': 0,
+                        'case_json': template.case_json,
+                    } for i in chunk])
+            # don't share any connections with the restore processes
+            db.session.remove()
+            db.get_engine(testapp).dispose()
+
+        print
+        for streaming in [False, True]:
+            results = Queue()
+            process = Process(target=_get_peak_rss, args=(self.user_id, streaming, results))
+            process.start()
+            start_rss, peak_rss = results.get()
+            process.join()
+            print '{}: peak RSS {} KB (started at {} KB)'.format(
+                'streaming' if streaming else 'not streaming', peak_rss, start_rss
+            )
@@ -0,0 +1,236 @@
+import copy
+from datetime import datetime, timedelta
+import random
+import timeit
+from uuid import uuid4
+
+import pytest
+
+from mobile_endpoint.case.case_processing import get_case_updates
+from mobile_endpoint.case.models import CommCareCase, CommCareCaseAction, _deduplicate_actions
+from mobile_endpoint.case.xml.parser import CaseUpdate
+from mobile_endpoint.form.form_processing import _get_xform_json
+from mobile_endpoint.form.models import XFormInstance
+from mobile_endpoint.utils import adjust_datetimes
+from tests.conftest import benchmark
+from tests.mock import CaseBlock
+
+DOMAIN = 'test_domain'
+
+FORM = """<?xml version='1.0' ?>
+<data xmlns="http://openrosa.org/formdesigner/rebuild">
+    {case_blocks}
+    <n0:meta xmlns:n0="http://openrosa.org/jr/xforms">
+        <n0:userID>{user_id}</n0:userID>
+        <n0:instanceID>{form_id}</n0:instanceID>
+    </n0:meta>
+</data>"""
+
+START = datetime(2015, 4, 8, 12)
+
+
+@pytest.fixture(autouse=True)
+def modified_on_from_case_block(monkeypatch):
+    """
+    Case actions are normally dated with the time they were processed which would
+    make processing the same forms twice give different results.
+    """
+    # the date in the case block has already been turned into a datetime when the form was wrapped
+    monkeypatch.setattr(CaseUpdate, 'guess_modified_on', lambda self: self.modified_on_str)
+
+
+def _get_form(case_block, received_on, user_id):
+    form_id = str(uuid4())
+    xml = FORM.format(case_blocks=case_block.as_string(), user_id=user_id, form_id=form_id)
+    json_form = _get_xform_json(xml)
+    adjust_datetimes(json_form)
+    xform = XFormInstance({'form': json_form}, xmlns=json_form['@xmlns'], received_on=received_on)
+    xform['id'] = form_id
+    xform['domain'] = DOMAIN
+    return xform
+
+
+def _process(forms):
+    case = None
+    for xform in forms:
+        case_update, = get_case_updates(xform)
+        if case is None:
+            case = CommCareCase.from_case_update(case_update, xform)
+        else:
+            case.update_from_case_update(case_update, xform)
+        # simulate saving and re-loading the case between forms
+        case = CommCareCase.wrap(case.to_json())
+    return case
+
+
+def _process_both_ways(forms, monkeypatch):
+    """
+    Process the forms as normal and again with every update doing a full rebuild.
+    """
+    rebuilds = []
+    original_rebuild = CommCareCase.rebuild
+
+    def _rebuild(case, *args, **kwargs):
+        rebuilds.append(case.id)
+        return original_rebuild(case, *args, **kwargs)
+
+    monkeypatch.setattr(CommCareCase, 'rebuild', _rebuild)
+    case = _process(forms)
+    num_rebuilds = len(rebuilds)
+
+    monkeypatch.setattr(CommCareCase, '_can_apply_in_order', lambda case, actions: False)
+    rebuilt_case = _process(forms)
+
+    assert case.to_json() == rebuilt_case.to_json()
+    return case, num_rebuilds
+
+
+def _get_forms(case_id, user_id, dates):
+    """
+    One form to create the case, one update form for each of the dates and
+    a form closing the case.
+    """
+    forms = [_get_form(
+        CaseBlock(case_id, create=True, date_modified=START, user_id=user_id, owner_id=user_id,
+                  case_type='duck', case_name='donald', update={'prop': 'initial'}),
+        START, user_id
+    )]
+    for i, date in enumerate(dates):
+        forms.append(_get_form(
+            CaseBlock(case_id, date_modified=date, user_id=user_id, update={
+                'prop': 'value {}'.format(i),
+                'prop_{}'.format(i): 'set',
+            }),
+            START + timedelta(minutes=len(forms)), user_id
+        ))
+    forms.append(_get_form(
+        CaseBlock(case_id, date_modified=START + timedelta(days=1), user_id=user_id, close=True),
+        START + timedelta(minutes=len(forms)), user_id
+    ))
+    return forms
+
+
+def test_in_order_updates(monkeypatch):
+    case_id = str(uuid4())
+    user_id = str(uuid4())
+    dates = [START + timedelta(hours=i) for i in range(1, 21)]
+
+    case, num_rebuilds = _process_both_ways(_get_forms(case_id, user_id, dates), monkeypatch)
+
+    # only the create form needs a rebuild
+    assert num_rebuilds == 1
+    assert case.closed
+    assert case.prop == 'value 19'
+    assert case.prop_0 == 'set'
+    assert len(case.actions) == 23
+    assert len(case.xform_ids) == 22
+    assert case.modified_on == START + timedelta(days=1)
+
+
+def test_out_of_order_update(monkeypatch):
+    case_id = str(uuid4())
+    user_id = str(uuid4())
+    # the second update was made on the phone before the first one
+    dates = [START + timedelta(hours=2), START + timedelta(hours=1), START + timedelta(hours=3)]
+
+    case, num_rebuilds = _process_both_ways(_get_forms(case_id, user_id, dates), monkeypatch)
+
+    assert num_rebuilds == 2
+    assert case.prop == 'value 2'
+    assert [a.date for a in case.actions[2:5]] == sorted(dates)
+
+
+def test_deprecated_actions_rebuild():
+    case_id = str(uuid4())
+    user_id = str(uuid4())
+    forms = _get_forms(case_id, user_id, [START + timedelta(hours=1)])
+    case = _process(forms[:2])
+    case.actions[-1].deprecated = True
+
+    assert not case._can_apply_in_order(get_case_updates(forms[2])[0].get_case_actions(forms[2]))
+    case.update_from_case_update(get_case_updates(forms[2])[0], forms[2])
+    # the deprecated update is gone but the close was still applied
+    assert case.prop == 'initial'
+    assert case.closed
+    assert [a.action_type for a in case.actions] == ['create', 'update', 'close']
+
+
+def _pairwise_deduplicate(action_list):
+    """
+    The original O(n^2) version of _deduplicate_actions
+    """
+    def actions_match(a1, a2):
+        a1doc = copy.copy(a1.to_json())
+        a2doc = copy.copy(a2.to_json())
+        a2doc['server_date'] = a1doc['server_date']
+        a2doc['date'] = a1doc['date']
+        return a1doc == a2doc
+
+    ret = []
+    for a in action_list:
+        found_actions = [other for other in ret if actions_match(a, other)]
+        if found_actions:
+            assert len(found_actions) == 1
+            match = found_actions[0]
+            ret[ret.index(match)] = a if a.server_date < match.server_date else match
+        else:
+            ret.append(a)
+    return ret
+
+
+def _get_actions(num_forms, resubmissions):
+    """
+    Actions from num_forms forms (a create form and then updates) where some
+    of the forms have been received more than once.
+    """
+    user_id = str(uuid4())
+    actions = []
+    for i in range(num_forms):
+        xform_id = str(uuid4())
+        date = START + timedelta(hours=i)
+        for copy_num in range(1 + (i in resubmissions)):
+            server_date = START + timedelta(hours=i, minutes=random.randint(0, 600))
+            actions.append(CommCareCaseAction(
+                action_type='create' if i == 0 else 'update',
+                user_id=user_id,
+                date=date + timedelta(minutes=copy_num),
+                server_date=server_date,
+                xform_id=xform_id,
+                updated_unknown_properties={'prop': 'value {}'.format(i), 'index': {'nested': [i]}},
+            ))
+    random.shuffle(actions)
+    return actions
+
+
+def test_deduplicate_actions():
+    actions = _get_actions(50, set(range(0, 50, 3)))
+    deduplicated = _deduplicate_actions(actions)
+    assert len(deduplicated) == 50
+    assert deduplicated == _pairwise_deduplicate(actions)
+    for action in deduplicated:
+        duplicates = [a for a in actions if a.xform_id == action.xform_id]
+        assert action.server_date == min(a.server_date for a in duplicates)
+
+
+def test_reconcile_actions():
+    case = CommCareCase(id=str(uuid4()), actions=_get_actions(20, {2, 5, 7}))
+    case.reconcile_actions(rebuild=True)
+    assert len(case.actions) == 20
+    assert case.actions[0].action_type == 'create'
+    assert case.prop == 'value 19'
+
+
+@benchmark
+def test_benchmark_reconcile_actions():
+    number = 1
+    for num_forms in [100, 500]:
+        actions = _get_actions(num_forms, set(random.sample(range(num_forms), num_forms / 10)))
+        pairwise = timeit.timeit(lambda: _pairwise_deduplicate(actions), number=number)
+        keyed = timeit.timeit(lambda: _deduplicate_actions(actions), number=number)
+        case = CommCareCase(id=str(uuid4()), actions=actions)
+        reconcile = timeit.timeit(lambda: case.reconcile_actions(), number=number)
+        print
+        print '{} actions:'.format(len(actions))
+        print '  pairwise deduplication: {:.2f} ms'.format(pairwise * 1000 / number)
+        print '  keyed deduplication: {:.2f} ms'.format(keyed * 1000 / number)
+        print '  reconcile_actions: {:.2f} ms'.format(reconcile * 1000 / number)
@@ -0,0 +1,89 @@
+import copy
+import json
+import os
+import timeit
+
+import pytest
+
+from mobile_endpoint.case.compact import CompactCase
+from mobile_endpoint.case.models import CommCareCase
+from mobile_endpoint.case.xml import V1, V2
+from mobile_endpoint.case.xml.serializer import get_case_xml_string, get_case_xml_fragments, \
+    get_case_xml_from_fragments
+from mobile_endpoint.restore.xml import get_case_xml
+from tests.conftest import benchmark
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), 'data', 'case_xml')
+
+with open(os.path.join(DATA_DIR, 'cases.json')) as f:
+    CASES = json.load(f)
+
+GOLDEN_UPDATES = [['create', 'update', 'close'], ['update']]
+
+
+def _golden_file(name, version, updates):
+    return os.path.join(DATA_DIR, '{}-v{}-{}.xml'.format(name, version[0], '-'.join(updates)))
+
+
+def _get_case(name, wrap):
+    return wrap(copy.deepcopy(CASES[name]))
+
+
+@pytest.mark.parametrize('wrap', [CompactCase, CommCareCase.wrap], ids=['compact', 'generic'])
+@pytest.mark.parametrize('updates', GOLDEN_UPDATES, ids='-'.join)
+@pytest.mark.parametrize('version', [V1, V2])
+@pytest.mark.parametrize('name', sorted(CASES))
+def test_golden_files(name, version, updates, wrap):
+    with open(_golden_file(name, version, updates)) as f:
+        expected = f.read()
+    assert get_case_xml(_get_case(name, wrap), updates, version) == expected
+    assert get_case_xml_string(_get_case(name, wrap), updates, version) == expected
+
+
+@pytest.mark.parametrize('updates', [
+    [], ['create'], ['close'], ['create', 'update'], ['update', 'close'], ['create', 'close'],
+], ids=lambda updates: '-'.join(updates) or 'none')
+@pytest.mark.parametrize('version', [V1, V2])
+@pytest.mark.parametrize('name', sorted(CASES))
+def test_matches_element_tree(name, version, updates):
+    case = _get_case(name, CompactCase)
+    assert get_case_xml_string(case, updates, version) == get_case_xml(case, updates, version)
+
+
+def test_namespaced_attribute():
+    case_json = copy.deepcopy(CASES['minimal'])
+    case_json['nested'] = {'@{http://example.com/ns}attr': 'value', '#text': 'text'}
+    case = CompactCase(case_json)
+    assert get_case_xml_string(case, ['update'], V2) == get_case_xml(case, ['update'], V2)
+
+
+@pytest.mark.parametrize('updates', [
+    ['create', 'update'], ['update'], ['create', 'update', 'close'], ['update', 'close'],
+], ids='-'.join)
+@pytest.mark.parametrize('name', sorted(CASES))
+def test_stored_fragments(name, updates):
+    fragments = get_case_xml_fragments(_get_case(name, CommCareCase.wrap))
+    case = _get_case(name, CompactCase)
+    assert get_case_xml_from_fragments(fragments, updates, V2) == get_case_xml(case, updates, V2)
+
+
+@pytest.mark.parametrize('version, updates', [(V1, ['update']), (V2, ['create']), (V2, ['close'])])
+def test_stored_fragments_not_used(version, updates):
+    fragments = get_case_xml_fragments(_get_case('full', CommCareCase.wrap))
+    assert get_case_xml_from_fragments(fragments, updates, version) is None
+    assert get_case_xml_from_fragments(None, ['update'], V2) is None
+
+
+@benchmark
+def test_benchmark_case_xml():
+    """
+    Compare serializing 10k cases through ElementTree and straight to strings
+    """
+    num_cases = 10000
+    cases = [_get_case('full', CompactCase) for i in range(num_cases)]
+    print
+    for serialize in [get_case_xml, get_case_xml_string]:
+        start = timeit.default_timer()
+        for case in cases:
+            serialize(case, ['create', 'update'], V2)
+        print '{}: {:.3f}s'.format(serialize.__name__, timeit.default_timer() - start)
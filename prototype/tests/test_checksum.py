@@ -0,0 +1,61 @@
+import binascii
+import doctest
+import hashlib
+import timeit
+from uuid import uuid4
+
+import pytest
+
+from mobile_endpoint.synclog import checksum
+from mobile_endpoint.synclog.checksum import Checksum
+from tests.conftest import benchmark
+
+
+def _bytearray_hexdigest(ids):
+    """
+    The checksum the way it used to be worked out, with a bytearray for each id
+    """
+    if not ids:
+        return ''
+    hashes = [bytearray(hashlib.md5(id).digest()) for id in ids]
+    return binascii.hexlify(str(reduce(
+        lambda bytes1, bytes2: bytearray([b1 ^ b2 for (b1, b2) in zip(bytes1, bytes2)]), hashes
+    )))
+
+
+def test_doctests():
+    failed, attempted = doctest.testmod(checksum)
+    assert attempted and not failed
+
+
+@pytest.mark.parametrize('ids', [
+    [], ['abc123'], ['abc123', 'abc123'], [str(uuid4()) for i in range(100)],
+], ids=['none', 'one', 'repeated', 'many'])
+def test_matches_bytearray_checksum(ids):
+    assert Checksum(ids).hexdigest() == _bytearray_hexdigest(ids)
+    assert Checksum(ids).digest() == binascii.unhexlify(_bytearray_hexdigest(ids))
+
+
+def test_add_and_remove():
+    ids = [str(uuid4()) for i in range(10)]
+    c = Checksum(ids)
+    c.add('extra')
+    c.remove(ids[0])
+    assert c.hexdigest() == Checksum(ids[1:] + ['extra']).hexdigest()
+    c = Checksum(initial_checksum=c.hexdigest())
+    for id in ids[1:] + ['extra']:
+        c.remove(id)
+    assert c.hexdigest() == '0' * 32
+
+
+@benchmark
+def test_benchmark_checksum():
+    """
+    The state hash for a phone with 50k cases
+    """
+    ids = [str(uuid4()) for i in range(50000)]
+    print
+    for name, hexdigest in [('bytearray', _bytearray_hexdigest), ('integer', lambda ids: Checksum(ids).hexdigest())]:
+        start = timeit.default_timer()
+        hexdigest(ids)
+        print '{}: {:.3f}s'.format(name, timeit.default_timer() - start)
@@ -0,0 +1,149 @@
+import copy
+from datetime import datetime, timedelta
+import gc
+import sys
+import timeit
+import types
+from uuid import uuid4
+
+import pytest
+
+from mobile_endpoint.case.compact import CompactCase, CompactCaseIndex
+from mobile_endpoint.case.models import CommCareCase, CommCareCaseAction, CommCareCaseIndex
+from mobile_endpoint.case.xml import V1, V2
+from mobile_endpoint.restore.xml import get_case_element, tostring
+from tests.conftest import benchmark
+
+DOMAIN = 'test_domain'
+START = datetime(2015, 4, 8, 12)
+
+
+def _get_case(num_actions=5, closed=False):
+    user_id = str(uuid4())
+    case = CommCareCase(
+        domain=DOMAIN,
+        type='duck',
+        name='donald',
+        external_id='d-1',
+        user_id=user_id,
+        owner_id=user_id,
+        closed=closed,
+        opened_on=START,
+        modified_on=START + timedelta(hours=num_actions),
+        server_modified_on=START + timedelta(hours=num_actions, minutes=1),
+        indices=[CommCareCaseIndex(identifier='parent', referenced_type='duck', referenced_id=str(uuid4()))],
+        actions=[
+            CommCareCaseAction(
+                action_type='create' if i == 0 else 'update',
+                user_id=user_id,
+                date=START + timedelta(hours=i),
+                server_date=START + timedelta(hours=i, minutes=1),
+                xform_id=str(uuid4()),
+                sync_log_id=str(uuid4()),
+                updated_unknown_properties={'prop': 'value {}'.format(i)},
+            )
+            for i in range(num_actions)
+        ],
+    )
+    case.id = str(uuid4())
+    case['prop'] = 'value {}'.format(num_actions - 1)
+    case['visit_date'] = '2015-04-08T12:00:01.000000Z'
+    case['weight'] = '1.50'
+    case['dob'] = '2015-04-08'
+    case['alarm'] = '12:30:00'
+    case['not_a_date'] = '2015-02-30'
+    case['nested'] = {'#text': 'text', '@attr': 'attr', 'when': '2015-04-08T12:00:01.000000Z'}
+    case['repeat'] = ['1.50', 'value']
+    # the same as the backends give back when loading the case
+    return CommCareCase.wrap(case.to_json())
+
+
+def _as_sql_row(case):
+    """
+    A CompactCase the way the SQL backend builds it: with some fields in their own columns
+    """
+    case_json = copy.deepcopy(case.to_json())
+    indices = [CompactCaseIndex.wrap(index) for index in case_json.pop('indices')]
+    columns = {att: case_json.pop(att) for att in ['domain', 'owner_id', 'closed', 'server_modified_on']}
+    columns['server_modified_on'] = case.server_modified_on
+    return CompactCase(case_json, indices=indices, id=case.id, **columns)
+
+
+def _as_document(case):
+    return CompactCase(copy.deepcopy(case.to_json()))
+
+
+@pytest.mark.parametrize('to_compact', [_as_sql_row, _as_document])
+def test_compact_case_fields(to_compact):
+    case = _get_case()
+    compact = to_compact(case)
+    for field in ['id', 'domain', 'closed', 'owner_id', 'user_id', 'server_modified_on',
+                  'name', 'type', 'external_id', 'modified_on']:
+        assert getattr(compact, field) == getattr(case, field)
+    assert [index.to_json() for index in compact.indices] == [
+        {'identifier': 'parent', 'referenced_type': 'duck', 'referenced_id': case.indices[0].referenced_id}
+    ]
+    assert [(a.action_type, a.xform_id, a.server_date, a.sync_log_id) for a in compact.actions] == [
+        (a.action_type, a.xform_id, a.server_date, a.sync_log_id) for a in case.actions
+    ]
+    assert compact.dynamic_case_properties() == case.dynamic_case_properties()
+    assert compact.to_generic().to_json() == case.to_json()
+
+
+@pytest.mark.parametrize('to_compact', [_as_sql_row, _as_document])
+def test_compact_case_xml(to_compact):
+    for closed in [False, True]:
+        case = _get_case(closed=closed)
+        compact = to_compact(case)
+        for version in [V1, V2]:
+            for updates in [['create', 'update'], ['update'], ['update', 'close'], ['create', 'update', 'close']]:
+                assert (tostring(get_case_element(compact, updates, version)) ==
+                        tostring(get_case_element(case, updates, version)))
+
+
+def _deep_size(objects):
+    """
+    Approximate the memory used by everything reachable from the objects
+    """
+    seen = set()
+    size = 0
+    pending = list(objects)
+    while pending:
+        obj = pending.pop()
+        # don't count shared things like classes and modules
+        if id(obj) in seen or isinstance(obj, (type, types.ModuleType, types.FunctionType, types.MethodType)):
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        pending.extend(gc.get_referents(obj))
+    return size
+
+
+@benchmark
+def test_benchmark_wrap_cases():
+    """
+    Compare loading 10k cases as CommCareCase and as CompactCase and then
+    serializing them for a restore.
+    """
+    num_cases = 10000
+    case_json = _get_case(num_actions=10).to_json()
+
+    def _run(wrap):
+        # wrapping can modify the JSON so give each run its own copy
+        jsons = [copy.deepcopy(case_json) for i in range(num_cases)]
+        start = timeit.default_timer()
+        cases = [wrap(json) for json in jsons]
+        wrapped = timeit.default_timer()
+        size = _deep_size(cases)
+        serialize_start = timeit.default_timer()
+        for case in cases:
+            tostring(get_case_element(case, ['create', 'update'], V2))
+        return wrapped - start, timeit.default_timer() - serialize_start, size
+
+    print
+    print '{} cases with {} actions each:'.format(num_cases, len(case_json['actions']))
+    for name, wrap in [('CommCareCase.wrap', CommCareCase.wrap), ('CompactCase', CompactCase)]:
+        wrap_time, xml_time, size = _run(wrap)
+        print '  {}: wrap {:.0f} ms, get_case_element {:.0f} ms, {:.1f} MB'.format(
+            name, wrap_time * 1000, xml_time * 1000, size / 1e6
+        )
@@ -0,0 +1,127 @@
+from datetime import datetime
+import timeit
+from uuid import uuid4
+
+from mobile_endpoint.case.case_processing import extract_case_blocks
+from mobile_endpoint.form.form_processing import _get_xform_json, _extract_meta_field
+from mobile_endpoint.form.parser import parse_form
+from mobile_endpoint.utils import adjust_datetimes
+from tests.conftest import benchmark
+
+
+FORM = """<?xml version='1.0' ?>
+<data uiVersion="1" version="7" name="Visit" xmlns="http://openrosa.org/formdesigner/visit">
+    <visit_date>2015-04-08T14:00:01.123+02:00</visit_date>
+    <question1>answer</question1>
+    <empty />
+    <group>
+        <n0:case case_id="{case_id}" date_modified="2015-04-08T12:00:01Z" user_id="{user_id}"
+                 xmlns:n0="http://commcarehq.org/case/transaction/v2">
+            <n0:update>
+                <n0:visit_date>2015-04-08T14:00:01+02:00</n0:visit_date>
+            </n0:update>
+        </n0:case>
+    </group>
+    {children}
+    <device_logs xmlns="http://code.javarosa.org/devicereport">
+        <case case_id="{case_id}"><ignored>ignored</ignored></case>
+        <log><case case_id="not-a-case"/></log>
+    </device_logs>
+    <not_a_case><case>no id</case></not_a_case>
+    <n2:meta xmlns:n2="http://openrosa.org/jr/xforms">
+        <n2:timeStart>2015-04-08T12:00:00.000000Z</n2:timeStart>
+        <n2:timeEnd>2015-04-08T12:00:01.000000Z</n2:timeEnd>
+        <n2:userID>{user_id}</n2:userID>
+        <n2:instanceID>{form_id}</n2:instanceID>
+    </n2:meta>
+</data>"""
+
+CHILD = """
+    <child>
+        <name>child {index}</name>
+        <n1:case case_id="{child_id}" date_modified="2015-04-08T12:00:01Z" user_id="{user_id}"
+                 xmlns:n1="http://commcarehq.org/case/transaction/v2">
+            <n1:create>
+                <n1:case_type>child</n1:case_type>
+                <n1:case_name>child {index}</n1:case_name>
+                <n1:owner_id>{user_id}</n1:owner_id>
+            </n1:create>
+            <n1:index>
+                <n1:parent case_type="mother">{case_id}</n1:parent>
+            </n1:index>
+        </n1:case>
+    </child>"""
+
+
+def _get_form(repeats):
+    case_id = str(uuid4())
+    user_id = str(uuid4())
+    children = ''.join(
+        CHILD.format(index=i, child_id=str(uuid4()), case_id=case_id, user_id=user_id)
+        for i in range(repeats)
+    )
+    return FORM.format(case_id=case_id, user_id=user_id, form_id=str(uuid4()), children=children)
+
+
+def _parse_form_in_three_passes(xml):
+    json_form = _get_xform_json(xml)
+    adjust_datetimes(json_form)
+    return (
+        json_form,
+        extract_case_blocks(json_form),
+        _extract_meta_field(json_form, ('instanceID', 'uuid')),
+    )
+
+
+def _sort_key(case_block):
+    return case_block['@case_id']
+
+
+def test_parse_form_matches_xml2json():
+    for repeats in [0, 1, 5]:
+        xml = _get_form(repeats)
+        json_form, case_blocks, instance_id = _parse_form_in_three_passes(xml)
+
+        parsed = parse_form(xml)
+        assert parsed.json == json_form
+        assert sorted(parsed.case_blocks, key=_sort_key) == sorted(case_blocks, key=_sort_key)
+        assert len(parsed.case_blocks) == repeats + 1
+        assert parsed.instance_id == instance_id
+        assert parse_form(xml.decode('utf-8')) == parsed
+
+
+def test_parse_form_case_blocks_in_document_order():
+    xml = _get_form(3)
+    parsed = parse_form(xml)
+    json_form = parsed.json
+    assert parsed.case_blocks == [json_form['group']['case']] + [child['case'] for child in json_form['child']]
+
+
+def test_parse_form_datetimes():
+    parsed = parse_form(_get_form(1))
+    assert parsed.json['visit_date'] == '2015-04-08T12:00:01.123000Z'
+    assert parsed.case_blocks[0]['@date_modified'] == '2015-04-08T12:00:01.000000Z'
+    assert parsed.case_blocks[0]['update']['visit_date'] == '2015-04-08T12:00:01.000000Z'
+
+
+@benchmark
+def test_benchmark_parse_form():
+    """
+    Compare parsing a large form with the streaming parser against xml2json
+    followed by the datetime and case block passes.
+    """
+    repeats = 500
+    number = 20
+    xml = _get_form(repeats)
+
+    start = datetime.utcnow()
+    three_pass = timeit.timeit(lambda: _parse_form_in_three_passes(xml), number=number)
+    streaming = timeit.timeit(lambda: parse_form(xml), number=number)
+    print
+    print 'Form with {} case blocks ({} bytes), {} runs (total time {}):'.format(
+        repeats + 1, len(xml), number, datetime.utcnow() - start
+    )
+    print '  xml2json + adjust_datetimes + extract_case_blocks: {:.2f} ms per form'.format(
+        three_pass * 1000 / number
+    )
+    print '  parse_form: {:.2f} ms per form'.format(streaming * 1000 / number)
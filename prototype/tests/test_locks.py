@@ -0,0 +1,84 @@
+from uuid import uuid4
+
+import pytest
+from redis.exceptions import LockError
+
+from mobile_endpoint.extensions import redis_store
+from mobile_endpoint.dao import CaseDbCache
+from mobile_endpoint.utils import MultiLock, acquire_locks, release_locks, get_case_lock_key
+
+
+@pytest.mark.usefixtures("testapp")
+class TestMultiLock(object):
+
+    def _keys(self, count):
+        return ['test_lock_{}'.format(uuid4()) for i in range(count)]
+
+    def test_acquire_release(self):
+        keys = self._keys(3)
+        lock = acquire_locks(keys)
+        assert all(redis_store.get(key) == lock.token for key in keys)
+        lock.release()
+        assert not any(redis_store.exists(key) for key in keys)
+
+    def test_all_or_nothing(self):
+        keys = self._keys(3)
+        held = acquire_locks(keys[1:2])
+        lock = MultiLock(redis_store, keys, timeout=30)
+        assert not lock.acquire(blocking=False)
+        assert not redis_store.exists(keys[0])
+        assert not redis_store.exists(keys[2])
+
+        held.release()
+        assert lock.acquire(blocking=False)
+        lock.release()
+
+    def test_compatible_with_single_lock(self):
+        keys = self._keys(2)
+        single = redis_store.lock(keys[0], timeout=30)
+        single.acquire()
+        try:
+            assert not MultiLock(redis_store, keys).acquire(blocking_timeout=0.2)
+        finally:
+            single.release()
+
+    def test_acquire_timeout(self):
+        keys = self._keys(2)
+        held = acquire_locks(keys[:1])
+        try:
+            with pytest.raises(LockError):
+                acquire_locks(keys, blocking_timeout_seconds=0.2)
+            assert not redis_store.exists(keys[1])
+        finally:
+            held.release()
+
+    def test_release_many(self):
+        first, second = self._keys(2), self._keys(2)
+        locks = [acquire_locks(first), acquire_locks(second)]
+        release_locks(locks)
+        assert not any(redis_store.exists(key) for key in first + second)
+
+    def test_release_expired(self):
+        keys = self._keys(2)
+        lock = acquire_locks(keys)
+        redis_store.delete(keys[0])
+        with pytest.raises(LockError):
+            lock.release()
+        assert not redis_store.exists(keys[1])
+
+    def test_case_db_cache_locks_once(self):
+        class NoCasesDao(object):
+            def get_cases(self, case_ids, ordered=False):
+                return []
+
+        first, second, third = [str(uuid4()) for i in range(3)]
+        with CaseDbCache(NoCasesDao(), lock=True) as case_db:
+            case_db.populate([first])
+            assert redis_store.exists(get_case_lock_key(first))
+            # a miss once the locks are held is only read, not locked
+            assert case_db.get(second) is None
+            assert not redis_store.exists(get_case_lock_key(second))
+            with pytest.raises(AssertionError):
+                case_db.populate([third])
+            assert len(case_db.locks) == 1
+        assert not redis_store.exists(get_case_lock_key(first))
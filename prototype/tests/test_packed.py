@@ -0,0 +1,52 @@
+import json
+import timeit
+from uuid import uuid4
+
+import pytest
+
+from mobile_endpoint.synclog.packed import pack_uuids, PackedUUIDSet, get_packed_case_ids
+from tests.conftest import benchmark
+
+
+@pytest.mark.parametrize('compress', [False, True])
+@pytest.mark.parametrize('num_ids', [0, 1, 1000])
+def test_round_trip(num_ids, compress):
+    ids = {unicode(uuid4()) for i in range(num_ids)}
+    packed = PackedUUIDSet(pack_uuids(ids, compress=compress))
+    assert len(packed) == num_ids
+    assert packed.to_set() == ids
+    # postgres gives back a buffer
+    assert PackedUUIDSet(buffer(pack_uuids(ids, compress=compress))).to_set() == ids
+
+
+@pytest.mark.parametrize('id', ['not-a-uuid', str(uuid4()).upper(), uuid4().hex])
+def test_only_packs_uuids(id):
+    with pytest.raises(ValueError):
+        pack_uuids([str(uuid4()), id])
+
+
+def test_packing_turned_off(testapp, monkeypatch):
+    ids = [str(uuid4()) for i in range(10)]
+    with testapp.app_context():
+        monkeypatch.setitem(testapp.config, 'PACKED_SYNCLOG_CASE_IDS', False)
+        assert get_packed_case_ids(ids) is None
+        monkeypatch.setitem(testapp.config, 'PACKED_SYNCLOG_CASE_IDS', True)
+        assert PackedUUIDSet(get_packed_case_ids(ids)).to_set() == set(ids)
+        assert get_packed_case_ids(ids + ['not-a-uuid']) is None
+
+
+@benchmark
+def test_benchmark_packed_case_ids():
+    """
+    The size of 50k case ids and the time to get the set of them back
+    """
+    ids = [unicode(uuid4()) for i in range(50000)]
+    print
+    for name, encoded, decode in [
+        ('json', json.dumps(ids), lambda encoded: set(json.loads(encoded))),
+        ('packed', pack_uuids(ids), lambda encoded: PackedUUIDSet(encoded).to_set()),
+        ('packed+zlib', pack_uuids(ids, compress=True), lambda encoded: PackedUUIDSet(encoded).to_set()),
+    ]:
+        start = timeit.default_timer()
+        decode(encoded)
+        print '{}: {} bytes, {:.3f}s'.format(name, len(encoded), timeit.default_timer() - start)
@@ -0,0 +1,64 @@
+import sqlite3
+
+import pytest
+from sqlalchemy import create_engine, event, exc
+from sqlalchemy.engine.url import make_url
+
+from mobile_endpoint.pool import TimedQueuePool, PooledSQLAlchemy, checkout_stats, configure_pool
+
+
+class _App(object):
+
+    def __init__(self, **config):
+        self.config = dict({'SQLALCHEMY_NATIVE_UNICODE': None}, **config)
+
+
+def _get_pool(**kwargs):
+    return TimedQueuePool(lambda: sqlite3.connect(':memory:'), **kwargs)
+
+
+def test_checkout_stats():
+    checkout_stats.reset()
+    pool = _get_pool(pool_size=1, max_overflow=0, timeout=0.1)
+    connection = pool.connect()
+    with pytest.raises(exc.TimeoutError):
+        pool.connect()
+    stats = checkout_stats.as_dict()
+    assert stats['checkouts'] == 2
+    assert stats['timeouts'] == 1
+    assert stats['max_wait'] >= 0.1
+
+    connection.close()
+    pool.connect().close()
+    assert checkout_stats.as_dict()['checkouts'] == 3
+
+
+def test_settings_kept_when_recreated():
+    pool = _get_pool(pool_size=1)
+    pool.slow_checkout = 0.5
+    pool.stats_interval = 60
+    pool = pool.recreate()
+    assert (pool.slow_checkout, pool.stats_interval) == (0.5, 60)
+
+
+@pytest.mark.parametrize('pgbouncer, expected', [
+    (False, {'options': '-c statement_timeout=5000'}),
+    (True, None),
+])
+def test_statement_timeout(pgbouncer, expected):
+    options = {}
+    app = _App(SQLALCHEMY_STATEMENT_TIMEOUT=5000, SQLALCHEMY_PGBOUNCER=pgbouncer)
+    PooledSQLAlchemy().apply_driver_hacks(app, make_url('postgresql://localhost/test'), options)
+    assert options['poolclass'] is TimedQueuePool
+    assert options.get('connect_args') == expected
+
+
+def test_pre_ping():
+    engine = create_engine('sqlite://', poolclass=TimedQueuePool)
+    configure_pool(_App(SQLALCHEMY_POOL_PRE_PING=True, SQLALCHEMY_POOL_SLOW_CHECKOUT=0.5), engine)
+    assert engine.pool.slow_checkout == 0.5
+
+    statements = []
+    event.listen(engine, 'before_cursor_execute', lambda conn, cursor, statement, *args: statements.append(statement))
+    assert engine.scalar('SELECT 2') == 2
+    assert statements == ['SELECT 1', 'SELECT 2']
@@ -1,10 +1,17 @@
 # -*- coding: utf-8 -*-
 from abc import abstractmethod
+import base64
 from uuid import uuid4
-from mobile_endpoint.backends.manager import get_dao
+from xml.etree import ElementTree
 
-from mobile_endpoint.views.response import OPEN_ROSA_SUCCESS_RESPONSE
-from tests.mock import CaseFactory, CaseStructure, post_case_blocks, CaseRelationship
+from redis.exceptions import LockError
+from mobile_endpoint.backends.manager import get_dao, get_batch_submit_url
+from mobile_endpoint.case.case_processing import process_cases_in_form, extract_case_blocks
+from mobile_endpoint.form.form_processing import create_xform
+from mobile_endpoint.views import receiver
+from mobile_endpoint.views.response import OPEN_ROSA_SUCCESS_RESPONSE, RESPONSE_XMLNS, ResponseNature
+from tests.mock import CaseFactory, CaseStructure, post_case_blocks, CaseRelationship, post_case_block_batch, \
+    get_form_xml
 from tests.utils import create_synclog
 
 DOMAIN = 'test_domain'
@@ -136,6 +143,138 @@ class ReceiverTestMixin(object):
             self._assert_case(case_id, user_id, num_forms=2, closed=True)
             self._assert_synclog(synclog_id, case_ids=[])
 
+    def test_batch_forms(self, testapp, client):
+        user_id = str(uuid4())
+        case_id = str(uuid4())
+        form_ids = [str(uuid4()), str(uuid4())]
+        synclog_id = create_synclog(self._get_backend(), DOMAIN, user_id)
+        with testapp.app_context():
+            factory = CaseFactory(
+                self._get_backend(),
+                client,
+                domain=DOMAIN,
+                case_defaults={
+                    'user_id': user_id,
+                    'owner_id': user_id,
+                    'case_type': 'duck',
+                }
+            )
+            result = post_case_block_batch(self._get_backend(), client, [
+                ([factory.get_case_block(case_id, create=True)], {'form_id': form_ids[0], 'user_id': user_id}),
+                ([factory.get_case_block(case_id, update={'identity': 'mallard'}, close=True)],
+                 {'form_id': form_ids[1], 'user_id': user_id}),
+            ], DOMAIN, headers={'last_sync_token': synclog_id})
+
+        assert result.status_code == 201
+        responses = ElementTree.fromstring(result.data)
+        assert [r.get('form_id') for r in responses] == form_ids
+        for response in responses:
+            message = response.find('{%s}message' % RESPONSE_XMLNS)
+            assert message.get('nature') == ResponseNature.SUBMIT_SUCCESS
+
+        for form_id in form_ids:
+            self._assert_form(form_id, user_id, synclog_id)
+        self._assert_case(case_id, user_id, num_forms=2, closed=True)
+        self._assert_synclog(synclog_id, case_ids=[])
+
+    def test_batch_forms_with_errors(self, testapp, client):
+        """
+        Forms that can't be processed get an error result and the rest are still saved.
+        """
+        user_id = str(uuid4())
+        other_domain_case_id = str(uuid4())
+        case_id = str(uuid4())
+        resubmitted_id, form_id, invalid_id = str(uuid4()), str(uuid4()), 'not-a-uuid'
+        with testapp.app_context():
+            case_defaults = {'user_id': user_id, 'owner_id': user_id, 'case_type': 'duck'}
+            CaseFactory(self._get_backend(), client, domain='other_domain', case_defaults=case_defaults)\
+                .create_or_update_case(CaseStructure(other_domain_case_id, attrs={'create': True}))
+            factory = CaseFactory(self._get_backend(), client, domain=DOMAIN, case_defaults=case_defaults)
+            factory.create_or_update_case(CaseStructure(attrs={'create': True}),
+                                          form_extras={'form_id': resubmitted_id})
+            result = post_case_block_batch(self._get_backend(), client, [
+                ([factory.get_case_block(other_domain_case_id, update={'identity': 'mallard'})],
+                 {'user_id': user_id}),
+                ([factory.get_case_block(case_id, create=True)], {'form_id': form_id, 'user_id': user_id}),
+                ([], {'form_id': invalid_id, 'user_id': user_id}),
+                ([], {'form_id': resubmitted_id, 'user_id': user_id}),
+            ], DOMAIN)
+
+        assert result.status_code == 201
+        responses = ElementTree.fromstring(result.data)
+        natures = [r.find('{%s}message' % RESPONSE_XMLNS).get('nature') for r in responses]
+        assert natures == [
+            ResponseNature.SUBMIT_ERROR,
+            ResponseNature.SUBMIT_SUCCESS,
+            ResponseNature.SUBMIT_ERROR,
+            ResponseNature.SUBMIT_SUCCESS,
+        ]
+        assert [r.get('instance_id') for r in responses][1:] == [form_id, None, resubmitted_id]
+        # the resubmitted form doesn't match the original so it's saved under a new ID
+        assert responses[0].get('form_id') is None
+        assert responses[2].get('form_id') is None
+        assert responses[3].get('form_id') not in (None, resubmitted_id)
+
+        self._assert_form(form_id, user_id)
+        self._assert_case(case_id, user_id)
+
+    def test_batch_form_without_meta(self, testapp, client):
+        user_id = str(uuid4())
+        case_id = str(uuid4())
+        form_id = str(uuid4())
+        no_meta_form = "<?xml version='1.0' ?><data xmlns=\"http://example.com/no-meta\"><q>a</q></data>"
+        with testapp.app_context():
+            factory = CaseFactory(self._get_backend(), client, domain=DOMAIN, case_defaults={
+                'user_id': user_id, 'owner_id': user_id, 'case_type': 'duck',
+            })
+            form_xml = get_form_xml([factory.get_case_block(case_id, create=True)],
+                                    {'form_id': form_id, 'user_id': user_id})
+            result = client.post(
+                get_batch_submit_url(self._get_backend(), DOMAIN),
+                headers={'Authorization': 'Basic ' + base64.b64encode('admin:secret')},
+                data='\n'.join([form_xml, no_meta_form])
+            )
+
+        assert result.status_code == 201
+        responses = ElementTree.fromstring(result.data)
+        natures = [r.find('{%s}message' % RESPONSE_XMLNS).get('nature') for r in responses]
+        assert natures == [ResponseNature.SUBMIT_SUCCESS, ResponseNature.SUBMIT_SUCCESS]
+        assert responses[1].get('form_id') is not None
+        assert responses[1].get('instance_id') == responses[1].get('form_id')
+        self._assert_case(case_id, user_id)
+
+    def test_batch_form_lock_error(self, testapp, client, monkeypatch):
+        """
+        A form whose cases can't be locked gets an error result and the rest are still saved.
+        """
+        user_id = str(uuid4())
+        case_id, locked_case_id = str(uuid4()), str(uuid4())
+        form_id, locked_form_id = str(uuid4()), str(uuid4())
+
+        def process_cases_in_forms(xforms, dao):
+            if any(xform.id == locked_form_id for xform in xforms):
+                raise LockError('Timed out waiting for 1 lock(s)')
+            return receiver.process_cases_in_forms.original(xforms, dao)
+        process_cases_in_forms.original = receiver.process_cases_in_forms
+        monkeypatch.setattr(receiver, 'process_cases_in_forms', process_cases_in_forms)
+
+        with testapp.app_context():
+            factory = CaseFactory(self._get_backend(), client, domain=DOMAIN, case_defaults={
+                'user_id': user_id, 'owner_id': user_id, 'case_type': 'duck',
+            })
+            result = post_case_block_batch(self._get_backend(), client, [
+                ([factory.get_case_block(locked_case_id, create=True)],
+                 {'form_id': locked_form_id, 'user_id': user_id}),
+                ([factory.get_case_block(case_id, create=True)], {'form_id': form_id, 'user_id': user_id}),
+            ], DOMAIN)
+
+        assert result.status_code == 201
+        responses = ElementTree.fromstring(result.data)
+        natures = [r.find('{%s}message' % RESPONSE_XMLNS).get('nature') for r in responses]
+        assert natures == [ResponseNature.SUBMIT_ERROR, ResponseNature.SUBMIT_SUCCESS]
+        self._assert_form(form_id, user_id)
+        self._assert_case(case_id, user_id)
+
     def test_case_index(self, testapp, client):
         user_id = str(uuid4())
         owner_id = str(uuid4())
@@ -163,6 +302,40 @@ class ReceiverTestMixin(object):
                 }
             })
 
+    def test_streaming_form_parser(self, testapp, client, monkeypatch):
+        monkeypatch.setitem(testapp.config, 'STREAMING_FORM_PARSER', True)
+        user_id = str(uuid4())
+        owner_id = str(uuid4())
+        with testapp.app_context():
+            factory = CaseFactory(self._get_backend(), client, domain=DOMAIN, case_defaults={
+                'user_id': user_id,
+                'owner_id': owner_id,
+                'case_type': 'duck',
+            })
+            parent_id, child_id = str(uuid4()), str(uuid4())
+            case_blocks = [
+                factory.get_case_block(parent_id, create=True),
+                factory.get_case_block(child_id, create=True, case_type='duckling', index={
+                    'parent': ('duck', parent_id)
+                }),
+            ]
+            dao = get_dao(self._get_backend())
+            instance = get_form_xml(case_blocks, {'user_id': user_id})
+            with create_xform(instance, {}, {'domain': DOMAIN}, dao) as xform:
+                # the case blocks found while parsing are used instead of searching the form again
+                assert xform._case_blocks is not None
+                assert [block['@case_id'] for block in extract_case_blocks(xform)] == [parent_id, child_id]
+                result = process_cases_in_form(xform, dao)
+                dao.commit_atomic_submission(xform, result)
+
+            self._assert_case(parent_id, owner_id)
+            self._assert_case(child_id, owner_id, indices={
+                'parent': {
+                    'referenced_type': 'duck',
+                    'referenced_id': parent_id,
+                }
+            })
+
     def test_get_reverse_indexed_cases(self, testapp, client):
         """
         This tests Dao.get_reverse_indexed_cases().
@@ -191,3 +364,47 @@ class ReceiverTestMixin(object):
             dao = get_dao(self._get_backend())
             reverse_indexed_case_ids = [c.id for c in dao.get_reverse_indexed_cases(DOMAIN, [parent.id])]
             assert [child.id] == reverse_indexed_case_ids
+
+            other_owner_id = str(uuid4())
+            other_child, = factory.create_or_update_case(
+                CaseStructure(
+                    attrs={'create': True, 'case_type': 'duckling', 'owner_id': other_owner_id},
+                    relationships=[CaseRelationship(CaseStructure(case_id=parent.id))],
+                    walk_related=False,
+                )
+            )
+            assert sorted(dao.get_reverse_index_owners(DOMAIN, [parent.id])) == sorted([
+                (child.id, owner_id, parent.id),
+                (other_child.id, other_owner_id, parent.id),
+            ])
+
+    def test_db_reads_per_form(self, testapp, client):
+        """
+        The number of DB reads needed to process a form shouldn't depend on
+        how many cases (or indices) are in it.
+        """
+        user_id = str(uuid4())
+        owner_id = str(uuid4())
+        with testapp.app_context():
+            factory = CaseFactory(self._get_backend(), client, domain=DOMAIN, case_defaults={
+                'user_id': user_id,
+                'owner_id': owner_id,
+                'case_type': 'duck',
+            })
+            parents = [factory.create_case() for i in range(10)]
+
+            def _get_num_reads(num_children):
+                case_blocks = [
+                    factory.get_case_block(str(uuid4()), create=True, case_type='duckling', index={
+                        'parent': ('duck', parents[i % len(parents)].id)
+                    })
+                    for i in range(num_children)
+                ]
+                dao = get_dao(self._get_backend())
+                instance = get_form_xml(case_blocks, {'user_id': user_id})
+                with create_xform(instance, {}, {'domain': DOMAIN}, dao) as xform:
+                    return process_cases_in_form(xform, dao).num_db_reads
+
+            # one read for the cases, one for their parents and one for child cases
+            assert _get_num_reads(1) == 3
+            assert _get_num_reads(10) == 3
@@ -5,11 +5,17 @@ from uuid import uuid4
 
 import time
 import datetime
+import pytest
 from mobile_endpoint.backends.manager import get_dao
 from mobile_endpoint.case import const
 from mobile_endpoint.case.xml import V2
 
 from mobile_endpoint.restore import xml
+from mobile_endpoint.restore.cleanliness import get_case_footprint_info, FootprintInfo
+from mobile_endpoint.restore.restore import RestoreConfig, RestoreParams, RestoreCacheSettings
+from mobile_endpoint.synclog.models import get_state_hash_mismatches
+from mobile_endpoint.views.restore import Domain
+from tests.conftest import benchmark
 from tests.dummy import dummy_user, dummy_restore_xml
 from tests.mock import CaseFactory, CaseStructure, CaseRelationship
 from tests.utils import check_xml_line_by_line
@@ -21,6 +27,10 @@ class RestoreTestMixin(object):
     user_id = str(uuid4())
     case_id = str(uuid4())
 
+    @pytest.fixture(autouse=True, params=[False, True], ids=['file', 'streaming'])
+    def streaming_restore(self, request, testapp, monkeypatch):
+        monkeypatch.setitem(testapp.config, 'STREAMING_RESTORE', request.param)
+
     @abstractmethod
     def _get_backend(self):
         pass
@@ -88,6 +98,111 @@ class RestoreTestMixin(object):
             dummy_restore_xml(user, synclog.id, case_xml=case_xml, items=4),
             restore_payload,
         )
+        assert synclog.case_ids_on_phone == {self.case_id}
+
+    def test_restore_with_stored_case_xml(self, testapp, client, monkeypatch):
+        """
+        The case XML saved with the case is what gets restored and it's cleared
+        when the case is saved with the setting turned off.
+        """
+        monkeypatch.setitem(testapp.config, 'STORED_CASE_XML', True)
+        with testapp.app_context():
+            factory = CaseFactory(self._get_backend(), client, domain=DOMAIN, case_defaults={
+                'user_id': self.user_id,
+                'owner_id': self.user_id,
+                'case_type': 'duck',
+            })
+            new_case, = factory.create_or_update_case(
+                CaseStructure(self.case_id, attrs={
+                    'create': True,
+                    'case_name': 'Fish',
+                    'update': {'last_name': 'Mooney'}})
+            )
+            dao = get_dao(self._get_backend())
+            stored_case, = dao.get_compact_cases([self.case_id])
+            assert set(stored_case.xml_fragments) == {const.CASE_ACTION_CREATE, const.CASE_ACTION_UPDATE}
+
+        user = dummy_user(self.user_id)
+        restore_payload = generate_restore_response(client, DOMAIN, user, self._get_restore_url_snippet())
+        case_xml = xml.get_case_xml(new_case, [const.CASE_ACTION_CREATE, const.CASE_ACTION_UPDATE], version=V2)
+        check_xml_line_by_line(
+            dummy_restore_xml(user, self._get_one_synclog().id, case_xml=case_xml, items=4),
+            restore_payload,
+        )
+
+        monkeypatch.setitem(testapp.config, 'STORED_CASE_XML', False)
+        with testapp.app_context():
+            factory.create_or_update_case(CaseStructure(self.case_id, attrs={'update': {'last_name': 'Cobb'}}))
+            stored_case, = dao.get_compact_cases([self.case_id])
+            assert stored_case.xml_fragments is None
+
+    def test_restore_with_index(self, testapp, client):
+        """
+        The sync log is saved with the cases and indices that were sent, including
+        when the payload is generated while it's being sent.
+        """
+        with testapp.app_context():
+            factory = CaseFactory(self._get_backend(), client, domain=DOMAIN, case_defaults={
+                'user_id': self.user_id,
+                'owner_id': self.user_id,
+                'case_type': 'duck',
+            })
+            child, parent = factory.create_or_update_case(
+                CaseStructure(
+                    attrs={'create': True, 'case_type': 'duckling'},
+                    relationships=[
+                        CaseRelationship(
+                            CaseStructure(attrs={'case_type': 'duck'})
+                        ),
+                    ])
+            )
+
+        user = dummy_user(self.user_id)
+        restore_payload = generate_restore_response(
+            client, DOMAIN, user, self._get_restore_url_snippet(), items=False
+        )
+        assert child.id in restore_payload and parent.id in restore_payload
+
+        synclog = self._get_one_synclog()
+        assert synclog.case_ids_on_phone == {child.id, parent.id}
+        assert synclog.dependent_case_ids_on_phone == set()
+        assert synclog.index_tree.indices == {child.id: {'parent': parent.id}}
+
+    def test_cached_restore(self, testapp, client):
+        """
+        Repeated restores get the cached payload until the phone submits a form
+        that changes its cases.
+        """
+        user = dummy_user(self.user_id)
+        url_snippet = self._get_restore_url_snippet()
+        # initial syncs are only cached if they're slow or it's forced
+        payload = generate_restore_response(client, DOMAIN, user, url_snippet, force_cache='true')
+        synclog = self._get_one_synclog()
+        assert generate_restore_response(client, DOMAIN, user, url_snippet) == payload
+        assert len(self._get_all_synclogs()) == 1
+
+        # steady state syncs are always cached
+        steady_state_payload = generate_restore_response(client, DOMAIN, user, url_snippet, since=synclog.id)
+        assert generate_restore_response(client, DOMAIN, user, url_snippet, since=synclog.id) == \
+            steady_state_payload
+        assert generate_restore_response(
+            client, DOMAIN, user, url_snippet, since=synclog.id, overwrite_cache='true'
+        ) != steady_state_payload
+        assert len(self._get_all_synclogs()) == 3
+
+        with testapp.app_context():
+            factory = CaseFactory(self._get_backend(), client, domain=DOMAIN, case_defaults={
+                'user_id': self.user_id,
+                'owner_id': self.user_id,
+                'case_type': 'duck',
+            }, form_extras={'headers': {'last_sync_token': synclog.id}})
+            factory.create_or_update_case(CaseStructure(self.case_id, attrs={'create': True}))
+
+        assert self.case_id in generate_restore_response(client, DOMAIN, user, url_snippet)
+        # the phone already has the case but it still gets a new restore
+        assert generate_restore_response(client, DOMAIN, user, url_snippet, since=synclog.id) not in \
+            [steady_state_payload, payload]
+        assert len(self._get_all_synclogs()) == 5
 
     def test_get_last_modified_dates(self, testapp, client):
         """
@@ -119,6 +234,82 @@ class RestoreTestMixin(object):
             id_date_map = dao.get_last_modified_dates(DOMAIN, ids)
             assert set(id_date_map.keys()) == set(ids)
 
+    def test_case_footprint_info(self, testapp, client):
+        """
+        The footprint follows indices through any number of levels, including to
+        cases with other owners.
+        """
+        owner_id = str(uuid4())
+        with testapp.app_context():
+            factory = CaseFactory(self._get_backend(), client, domain=DOMAIN, case_defaults={
+                'user_id': self.user_id,
+                'owner_id': owner_id,
+                'case_type': 'duck',
+            })
+            child, parent, grandparent = factory.create_or_update_case(
+                CaseStructure(
+                    attrs={'create': True, 'case_type': 'duckling'},
+                    relationships=[
+                        CaseRelationship(CaseStructure(
+                            attrs={'create': True},
+                            relationships=[
+                                CaseRelationship(CaseStructure(
+                                    attrs={'create': True, 'owner_id': str(uuid4())},
+                                ))
+                            ],
+                        )),
+                    ])
+            )
+
+            dao = get_dao(self._get_backend())
+            assert get_case_footprint_info(dao, DOMAIN, owner_id) == FootprintInfo(
+                base_ids={child.id, parent.id},
+                all_ids={child.id, parent.id, grandparent.id},
+            )
+
+    @benchmark
+    def test_benchmark_restore_many_owners(self, testapp, client, monkeypatch):
+        """
+        Time the initial restore for a user that owns 50 groups, 10 of which are dirty
+        """
+        group_ids = [str(uuid4()) for i in range(50)]
+        with testapp.app_context():
+            for i, group_id in enumerate(group_ids):
+                factory = CaseFactory(self._get_backend(), client, domain=DOMAIN, case_defaults={
+                    'user_id': self.user_id,
+                    'owner_id': group_id,
+                    'case_type': 'duck',
+                })
+                structures = [CaseStructure(attrs={'create': True}) for j in range(5)]
+                if i % 5 == 0:
+                    # a case with a parent owned by someone else makes the group dirty
+                    structures.append(CaseStructure(
+                        attrs={'create': True, 'case_type': 'duckling'},
+                        relationships=[
+                            CaseRelationship(CaseStructure(attrs={'create': True, 'owner_id': str(uuid4())}))
+                        ]
+                    ))
+                factory.create_or_update_cases(structures)
+
+        user = dummy_user(self.user_id)
+        user.additional_owner_ids = group_ids
+        dao = get_dao(self._get_backend())
+        print
+        for workers in [1, 4]:
+            monkeypatch.setitem(testapp.config, 'RESTORE_FOOTPRINT_WORKERS', workers)
+            with testapp.test_request_context():
+                start = datetime.datetime.utcnow()
+                config = RestoreConfig(
+                    dao,
+                    project=Domain(DOMAIN),
+                    user=user,
+                    params=RestoreParams(version=V2),
+                    cache_settings=RestoreCacheSettings(overwrite_cache=True),
+                )
+                payload = config.get_payload().as_string()
+                assert payload.count('<case ') == 50 * 5 + 10 * 2
+                print '{} footprint workers: {}'.format(workers, datetime.datetime.utcnow() - start)
+
     def test_sync_token(self, testapp, client):
         """
         Tests sync token / sync mode support
@@ -167,16 +358,25 @@ class RestoreTestMixin(object):
             new_restore_payload,
         )
 
+        # the saved state hashes were kept up to date as the cases changed
+        with testapp.app_context():
+            dao = get_dao(self._get_backend())
+            assert list(get_state_hash_mismatches(dao.iter_synclogs())) == []
+        generate_restore_response(client, DOMAIN, user, self._get_restore_url_snippet(),
+                                  since=new_new_synclog.id, state=str(new_new_synclog.get_state_hash()))
+
 
-def generate_restore_response(client, domain, user, url_snippet, since=None):
+def generate_restore_response(client, domain, user, url_snippet, since=None, items=True, **params):
     headers = {'Authorization': 'Basic ' + base64.b64encode('{}:{}'.format(user.username, user.password))}
     result = client.get(
-        'ota/{url_snippet}/{domain}?version=2.0&items=true&user_id={user_id}{since}'.format(
+        'ota/{url_snippet}/{domain}?version=2.0{items}&user_id={user_id}{since}{params}'.format(
             # TODO: I'm sure there is a better way to get different urls for the different backends...
             url_snippet=url_snippet,
             domain=domain,
+            items='&items=true' if items else '',
             user_id=user.user_id,
-            since='&since={}'.format(since) if since else ''),
+            since='&since={}'.format(since) if since else '',
+            params=''.join('&{}={}'.format(key, value) for key, value in sorted(params.items()))),
         headers=headers
     )
     assert result.status_code == 200
@@ -0,0 +1,65 @@
+import os
+from uuid import uuid4
+
+import pytest
+
+from mobile_endpoint.extensions import redis_store
+from mobile_endpoint.restore.cache import RedisFileRestoreCache, evict_payloads
+
+
+def _write(path, size, mtime=None):
+    with open(path, 'w') as f:
+        f.write('x' * size)
+    if mtime is not None:
+        os.utime(path, (mtime, mtime))
+    return path
+
+
+def test_evict_payloads(tmpdir):
+    directory = str(tmpdir)
+    for i, name in enumerate(['oldest', 'older', 'newest']):
+        _write(os.path.join(directory, name), 100, mtime=1000 + i)
+
+    assert evict_payloads(directory, 300) == []
+    assert evict_payloads(directory, 150) == ['oldest', 'older']
+    assert os.listdir(directory) == ['newest']
+
+
+@pytest.mark.usefixtures("testapp")
+class TestRedisFileRestoreCache(object):
+
+    @pytest.fixture
+    def cache(self, tmpdir):
+        return RedisFileRestoreCache(redis_store, str(tmpdir.mkdir('cache')), max_size=250)
+
+    @pytest.fixture
+    def payload(self, tmpdir):
+        return _write(str(tmpdir.join('payload.xml')), 100)
+
+    def test_set_get_delete(self, cache, payload):
+        key = uuid4().hex
+        assert cache.get(key) is None
+        cache.set(key, payload, 30)
+        os.remove(payload)
+        assert open(cache.get(key)).read() == 'x' * 100
+
+        cache.delete([key])
+        assert cache.get(key) is None
+        assert os.listdir(cache.directory) == []
+
+    def test_replace(self, cache, payload):
+        key = uuid4().hex
+        cache.set(key, payload, 30)
+        cache.set(key, payload, 30)
+        assert os.listdir(cache.directory) == [os.path.basename(cache.get(key))]
+
+    def test_least_recently_used_evicted(self, cache, tmpdir):
+        keys = [uuid4().hex for i in range(3)]
+        for i, key in enumerate(keys[:2]):
+            cache.set(key, _write(str(tmpdir.join('payload{}.xml'.format(i))), 100), 30)
+        # make the second payload the least recently used one
+        os.utime(cache.get(keys[1]), (1000, 1000))
+        cache.set(keys[2], _write(str(tmpdir.join('payload2.xml')), 100), 30)
+        assert cache.get(keys[0]) is not None
+        assert cache.get(keys[1]) is None
+        assert cache.get(keys[2]) is not None
@@ -0,0 +1,188 @@
+from datetime import datetime
+import time
+from uuid import uuid4
+from xml.etree import ElementTree
+
+import pytest
+
+from mobile_endpoint.restore import restore
+from mobile_endpoint.restore.data_providers import LongRunningRestoreDataProvider
+from mobile_endpoint.restore.restore import FileRestoreResponse, StreamingRestoreResponse, RestoreConfig
+from mobile_endpoint.restore.xml import safe_element
+from tests.conftest import benchmark
+from tests.dummy import dummy_user
+
+USERNAME = 'mallard'
+
+
+@pytest.fixture
+def restore_dir(testapp, tmpdir, request):
+    context = testapp.app_context()
+    context.push()
+    request.addfinalizer(context.pop)
+    testapp.config['RESTORE_DIR'] = str(tmpdir)
+
+
+def _elements(count, prefix='case'):
+    for i in range(count):
+        yield safe_element(prefix, str(i))
+
+
+def _get_response(response_class, items):
+    """
+    Build up a response the same way RestoreConfig.get_payload does
+    """
+    response = response_class(USERNAME, items=items)
+    response.append('<Sync><restore_id>abc</restore_id></Sync>')
+    response.extend(_elements(2, 'fixture'))
+    partial_response = response_class()
+    partial_response.extend(_elements(5))
+    response = response + partial_response
+    partial_response.close()
+    response.finalize()
+    return response
+
+
+@pytest.mark.usefixtures("restore_dir")
+@pytest.mark.parametrize('items', [False, True])
+def test_streaming_matches_file(items):
+    expected = _get_response(FileRestoreResponse, items).as_string()
+    assert _get_response(StreamingRestoreResponse, items).as_string() == expected
+    root = ElementTree.fromstring(expected)
+    assert len(root) == 9
+    if items:
+        assert root.get('items') == '9'
+
+
+@pytest.mark.parametrize('items', [False, True])
+def test_streaming_is_lazy(items):
+    generated = []
+    completed = []
+
+    def _provider():
+        for i in range(3):
+            generated.append(i)
+            yield safe_element('case', str(i))
+
+    response = StreamingRestoreResponse(USERNAME, items=items)
+    response.extend(_provider())
+    response.finalize()
+    response.when_complete(lambda: completed.append(list(generated)))
+    assert generated == []
+
+    chunks = list(response)
+    assert completed == [[0, 1, 2]]
+    assert chunks[0] == response.get_start_tag()
+    # the payload isn't finished until after the callbacks have run
+    assert chunks[-1] == response.closing_tag
+
+
+class _SizedElements(object):
+    def __init__(self, count, generated):
+        self.count = count
+        self.generated = generated
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        for i in range(self.count):
+            self.generated.append(i)
+            yield safe_element('case', str(i))
+
+
+def test_streaming_item_count_is_lazy():
+    """
+    The item count is sent before any of the elements from a sized part are generated
+    """
+    generated = []
+    response = StreamingRestoreResponse(USERNAME, items=True)
+    response.append(safe_element('fixture', '0'))
+    response.extend(_SizedElements(3, generated))
+    response.finalize()
+
+    chunks = iter(response)
+    start_tag = next(chunks)
+    assert 'items="5"' in start_tag
+    assert generated == []
+    assert ElementTree.fromstring(start_tag + ''.join(chunks)).get('items') == '5'
+    assert generated == [0, 1, 2]
+
+
+class _SlowProvider(LongRunningRestoreDataProvider):
+    def __init__(self, name, delay):
+        self.name = name
+        self.delay = delay
+
+    def get_response(self, restore_state):
+        time.sleep(self.delay)
+        response = restore_state.restore_class()
+        response.append(safe_element(self.name, 'done'))
+        return response
+
+
+class _FailingProvider(LongRunningRestoreDataProvider):
+    def get_response(self, restore_state):
+        raise ValueError('provider failed')
+
+
+class _NoRestoreDao(object):
+    def commit_restore(self, restore_state):
+        pass
+
+
+@pytest.fixture
+def long_running_providers(testapp, restore_dir, monkeypatch):
+    monkeypatch.setitem(testapp.config, 'RESTORE_CACHE', None)
+    providers = [_SlowProvider('slow', 0.2), _SlowProvider('fast', 0)]
+    monkeypatch.setattr(restore, 'get_long_running_providers', lambda: providers)
+    return providers
+
+
+@pytest.mark.parametrize('concurrent', [False, True])
+def test_long_running_providers(testapp, long_running_providers, monkeypatch, concurrent):
+    monkeypatch.setitem(testapp.config, 'CONCURRENT_RESTORE_PROVIDERS', concurrent)
+    config = RestoreConfig(_NoRestoreDao(), user=dummy_user(str(uuid4())))
+    root = ElementTree.fromstring(config.get_payload().as_string())
+
+    # merged in provider order, not in the order they finished
+    assert [child.tag.split('}')[-1] for child in root][-2:] == ['slow', 'fast']
+    durations = config.restore_state.provider_log['durations']
+    assert set(durations) == {
+        'SyncElementProvider', 'RegistrationElementProvider', 'FixtureElementProvider', '_SlowProvider'
+    }
+
+
+def test_concurrent_provider_error(testapp, long_running_providers, monkeypatch):
+    monkeypatch.setitem(testapp.config, 'CONCURRENT_RESTORE_PROVIDERS', True)
+    long_running_providers.append(_FailingProvider())
+    config = RestoreConfig(_NoRestoreDao(), user=dummy_user(str(uuid4())))
+    with pytest.raises(ValueError):
+        config.get_payload()
+
+
+@benchmark
+@pytest.mark.usefixtures("restore_dir")
+def test_benchmark_restore_response(testapp):
+    """
+    Compare time to first byte and total time for a restore with 50k elements
+    """
+    num_elements = 50000
+    print
+    for response_class in [FileRestoreResponse, StreamingRestoreResponse]:
+        with testapp.test_request_context():
+            start = datetime.utcnow()
+            response = response_class(USERNAME, items=False)
+            response.extend(_elements(10))
+            partial_response = response_class()
+            partial_response.extend(_elements(num_elements))
+            response = response + partial_response
+            partial_response.close()
+            response.finalize()
+            body = response.get_http_response().response
+            first = next(iter(body))
+            first_byte = datetime.utcnow() - start
+            size = len(first) + sum(len(chunk) for chunk in body)
+            print '{}: {} bytes, first byte after {}, total {}'.format(
+                response_class.__name__, size, first_byte, datetime.utcnow() - start
+            )
@@ -0,0 +1,128 @@
+from collections import namedtuple
+import timeit
+from uuid import uuid4
+
+from mobile_endpoint.case import const
+from mobile_endpoint.synclog.checksum import Checksum
+from mobile_endpoint.synclog.models import SimplifiedSyncLog, IndexTree, get_state_hash_mismatches
+from tests.conftest import benchmark
+
+
+def _get_synclog(case_ids, dependent_case_ids=None, indices=None):
+    return SimplifiedSyncLog(
+        case_ids_on_phone=set(case_ids),
+        dependent_case_ids_on_phone=set(dependent_case_ids or []),
+        index_tree=IndexTree(indices=indices or {}),
+    )
+
+
+def _saved(synclog):
+    # what the backends' to_generic give back
+    saved = SimplifiedSyncLog.wrap(synclog.to_json())
+    saved._hash = synclog.get_state_hash().hash
+    return saved
+
+
+def test_state_hash_follows_cases():
+    case_ids = [str(uuid4()) for i in range(3)]
+    synclog = _saved(_get_synclog(case_ids[:2]))
+    synclog._add_primary_case(case_ids[2])
+    assert synclog.get_state_hash() == synclog.recompute_state_hash()
+    assert synclog.get_state_hash().hash == Checksum(case_ids).hexdigest()
+
+
+def test_state_hash_after_prune():
+    child, parent, other = str(uuid4()), str(uuid4()), str(uuid4())
+    synclog = _saved(_get_synclog([child, parent, other], [child, parent], {child: {'parent': parent}}))
+    synclog.prune_case(child)
+    assert synclog.case_ids_on_phone == {other}
+    assert synclog.get_state_hash() == synclog.recompute_state_hash()
+
+    synclog.prune_case(other)
+    assert synclog.get_state_hash().hash == ''
+
+
+def test_set_case_ids_on_phone():
+    case_ids = set(str(uuid4()) for i in range(5))
+    previous_log = _saved(_get_synclog(list(case_ids)[:3]))
+    synclog = _get_synclog([])
+    synclog.set_case_ids_on_phone(case_ids, previous_log)
+    assert synclog.get_state_hash() == synclog.recompute_state_hash()
+    assert previous_log.get_state_hash() == previous_log.recompute_state_hash()
+
+
+def test_state_hash_mismatches():
+    good = _saved(_get_synclog([str(uuid4())]))
+    bad = _saved(_get_synclog([str(uuid4())]))
+    bad._hash = Checksum(['other']).hexdigest()
+    (synclog, saved_hash, recomputed_hash), = get_state_hash_mismatches([good, bad])
+    assert synclog is bad
+    assert saved_hash.hash == bad._hash
+    assert recomputed_hash.hash == Checksum(bad.case_ids_on_phone).hexdigest()
+
+
+def test_reverse_indices_kept_up_to_date():
+    tree = IndexTree(indices={'child': {'parent': 'a', 'host': 'b'}, 'other': {'parent': 'a'}})
+    assert tree.reverse_indices == {'a': {'child', 'other'}, 'b': {'child'}}
+    tree.set_index('child', 'parent', 'c')
+    tree.set_index('new', 'parent', 'c')
+    tree.delete_index('other', 'parent')
+    tree.remove_case('missing')
+    assert tree.reverse_indices == {'b': {'child'}, 'c': {'child', 'new'}}
+    tree.remove_case('child')
+    assert tree.reverse_indices == {'c': {'new'}}
+    assert tree.reverse_indices == IndexTree(indices=tree.indices).reverse_indices
+
+
+def test_all_cases_that_depend_on_case():
+    tree = IndexTree(indices={'a': {'parent': 'b'}, 'b': {'parent': 'c'}, 'c': {'parent': 'a'}, 'd': {'parent': 'c'}})
+    assert tree.get_all_cases_that_depend_on_case('c') == {'a', 'b', 'c', 'd'}
+    assert tree.get_all_cases_that_depend_on_case('d') == {'d'}
+
+
+class _CloseAction(object):
+    action_type = const.CASE_ACTION_CLOSE
+    updated_known_properties = {}
+    indices = []
+
+
+class _ClosedCase(object):
+
+    def __init__(self, id):
+        self.id = id
+
+    def get_actions_for_form(self, xform_id):
+        return [_CloseAction()]
+
+
+def _get_synclog_with_parents(num_children):
+    children = [str(uuid4()) for i in range(num_children)]
+    parents = [str(uuid4()) for i in range(num_children)]
+    return children, parents, _get_synclog(
+        children + parents, parents, {child: {'parent': parent} for child, parent in zip(children, parents)}
+    )
+
+
+def test_close_cases(monkeypatch):
+    monkeypatch.setattr(SimplifiedSyncLog, 'invalidate_cached_payloads', lambda self: None)
+    children, parents, synclog = _get_synclog_with_parents(10)
+    synclog.update_phone_lists(namedtuple('XForm', 'id')('form'), [_ClosedCase(id) for id in children[:3]])
+    assert synclog.case_ids_on_phone == set(children[3:] + parents[3:])
+    assert synclog.dependent_case_ids_on_phone == set(parents[3:])
+    assert set(synclog.index_tree.indices) == set(children[3:])
+    assert synclog.get_state_hash() == synclog.recompute_state_hash()
+
+
+@benchmark
+def test_benchmark_close_cases(monkeypatch):
+    """
+    A form closing 200 cases on a phone with 20k cases
+    """
+    monkeypatch.setattr(SimplifiedSyncLog, 'invalidate_cached_payloads', lambda self: None)
+    children, parents, synclog = _get_synclog_with_parents(10000)
+    closed_cases = [_ClosedCase(id) for id in children[:200]]
+    start = timeit.default_timer()
+    synclog.update_phone_lists(namedtuple('XForm', 'id')('form'), closed_cases)
+    print
+    print 'update_phone_lists: {:.3f}s'.format(timeit.default_timer() - start)
+    assert len(synclog.case_ids_on_phone) == 19600
@@ -116,6 +116,21 @@ class Backend(object):
         self.stop()
         self.start()
 
+    def set_app_config(self, **config):
+        """
+        Override the prototype's settings (see deploy/gunicorn_conf.py). They're used
+        once it's restarted and calling this with no settings goes back to its own.
+        """
+        path = os.path.join(self.settings['ENVIRONMENT_ROOT'], 'instance', 'loadtest_config.py')
+        contents = ''.join('{} = {!r}\n'.format(name, value) for name, value in sorted(config.items()))
+        if settings.TEST_SERVER == 'localhost':
+            with open(path, 'w') as f:
+                f.write(contents)
+            # picked up by runserver when it's started
+            os.environ['APP_CONFIG_FILE'] = path
+        else:
+            sh.ssh(settings.TEST_SERVER, 'cat > {}'.format(path), _in=contents)
+
     def load_data(self, dest_folder):
         raise NotImplementedError()
 
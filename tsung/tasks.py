@@ -149,3 +149,35 @@ def awesome_test(backend, user_rate, duration, load=False, notes=None):
             sh.Command('/usr/lib/tsung/bin/tsung_stats.pl')('--title', title)
 
             print(sh.cat('README.md'))
+
+    return log_dir
+
+
+@task
+def pool_size_test(backend_name, user_rate, duration, pool_sizes='5,10,20,40', max_overflow=0, load=False):
+    """
+    Run awesome_test against a prototype backend once for each database pool size
+    and plot the runs together to compare their throughput.
+    """
+    if load:
+        load_db(backend_name)
+
+    backend = _get_backend(backend_name)
+    runs = []
+    try:
+        for pool_size in [int(size) for size in pool_sizes.split(',')]:
+            backend.set_app_config(SQLALCHEMY_POOL_SIZE=pool_size, SQLALCHEMY_MAX_OVERFLOW=int(max_overflow))
+            backend.restart()
+            notes = 'SQLALCHEMY_POOL_SIZE = {}\nSQLALCHEMY_MAX_OVERFLOW = {}'.format(pool_size, max_overflow)
+            log_dir = awesome_test(backend_name, user_rate, duration, notes=notes)
+            if log_dir:
+                runs.append(('pool_size={}'.format(pool_size), log_dir))
+    finally:
+        backend.set_app_config()
+        backend.restart()
+
+    if runs:
+        plot_dir = os.path.join(settings.BUILD_DIR, 'pool_size_test')
+        args = [arg for label, log_dir in runs for arg in (label, os.path.join(log_dir, 'tsung.log'))]
+        sh.tsplot('-d', plot_dir, *args)
+        print("Throughput for each pool size plotted in {}".format(plot_dir))